@@ -8,4 +8,8 @@ For full documentation, see https://waderoberts123.github.io/Hydrostats/
 """
 from hydrostats.metrics import *
 from hydrostats.analyze import *
+from hydrostats._lazy import LazyModule as _LazyModule
+
+# hydrostats.data (and pandas) is only imported once it is used
+data = _LazyModule('hydrostats.data')
 __version__ = '0.79'
@@ -0,0 +1,118 @@
+# python 3.6
+# -*- coding: utf-8 -*-
+"""
+The numba kernels of hydrostats. This module imports numba, so the metrics and ens_metrics modules
+only import it (see hydrostats._lazy) the first time one of the kernels is needed. The kernels are
+cached on disk, so they are only compiled once for each type of input.
+"""
+from __future__ import division
+from hydrostats.metrics import _NAN_FLAG as NAN_FLAG, _INF_FLAG as INF_FLAG, _ZERO_FLAG as ZERO_FLAG, \
+    _NEG_FLAG as NEG_FLAG
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True)
+def treatment_flags(array, flags, remove_zero, remove_neg):
+    # ORs the flags of each row of the 2D array into flags. Comparisons are used instead of
+    # np.isnan and np.isinf so that integer and boolean arrays work.
+    for i in range(array.shape[0]):
+        flag = 0
+        for j in range(array.shape[1]):
+            value = array[i, j]
+            if value != value:
+                flag |= NAN_FLAG
+            elif value == np.inf or value == -np.inf:
+                flag |= INF_FLAG
+            if remove_zero and value == 0:
+                flag |= ZERO_FLAG
+            if remove_neg and value < 0:
+                flag |= NEG_FLAG
+        flags[i] |= flag
+    return flags
+
+
+@numba.njit(parallel=True, cache=True)
+def numba_crps(ens, obs, rows, cols, col_len_array, sad_ens_half, sad_obs, crps, adj):
+    for i in numba.prange(rows):
+        the_obs = obs[i]
+        the_ens = ens[i, :]
+        the_ens = np.sort(the_ens)
+        sum_xj = 0.
+        sum_jxj = 0.
+
+        j = 0
+        while j < cols:
+            sad_obs[i] += np.abs(the_ens[j] - the_obs)
+            sum_xj += the_ens[j]
+            sum_jxj += (j + 1) * the_ens[j]
+            j += 1
+
+        sad_ens_half[i] = 2.0 * sum_jxj - (col_len_array[i] + 1) * sum_xj
+
+    if np.isnan(adj):
+        for i in range(rows):
+            crps[i] = sad_obs[i] / col_len_array[i] - sad_ens_half[i] / \
+                      (col_len_array[i] * col_len_array[i])
+    elif adj > 1:
+        for i in range(rows):
+            crps[i] = sad_obs[i] / col_len_array[i] - sad_ens_half[i] / \
+                      (col_len_array[i] * (col_len_array[i] - 1)) * (1 - 1 / adj)
+    elif adj == 1:
+        for i in range(rows):
+            crps[i] = sad_obs[i] / col_len_array[i]
+    else:
+        for i in range(rows):
+            crps[i] = np.nan
+
+    return crps
+
+
+@numba.njit(cache=True)
+def auroc_numba(fcst, obs):
+    num_start_dates = obs.size
+
+    i_ord = fcst.argsort()
+
+    sum_v = 0.
+    sum_v2 = 0.
+    sum_w = 0.
+    sum_w2 = 0.
+    n = 0
+    m = 0
+    i = 0
+
+    x = 1
+    y = 0
+
+    while True:
+        nn = mm = 0
+        while x > y:
+            j = i_ord[i]
+            if obs[j]:
+                mm += 1
+            else:
+                nn += 1
+            if i == num_start_dates - 1:
+                break
+            jp1 = i_ord[i + 1]
+            if fcst[j] != fcst[jp1]:
+                break
+            i += 1
+        sum_w += nn * (m + mm / 2.0)
+        sum_w2 += nn * (m + mm / 2.0) * (m + mm / 2.0)
+        sum_v += mm * (n + nn / 2.0)
+        sum_v2 += mm * (n + nn / 2.0) * (n + nn / 2.0)
+        n += nn
+        m += mm
+        i += 1
+        if i >= num_start_dates:
+            break
+
+    theta = sum_v / (m * n)
+    v = sum_v2 / ((m - 1) * n * n) - sum_v * sum_v / (m * (m - 1) * n * n)
+    w = sum_w2 / ((n - 1) * m * m) - sum_w * sum_w / (n * (n - 1) * m * m)
+
+    sd_auc = np.sqrt(v / m + w / n)
+
+    return np.array([theta, sd_auc])
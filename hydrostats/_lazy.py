@@ -0,0 +1,38 @@
+# python 3.6
+# -*- coding: utf-8 -*-
+"""
+Deferred imports of the heavy dependencies (matplotlib, pandas and numba), so that importing
+hydrostats only loads what the metrics need. The modules are imported the first time that a
+function actually uses them. The numba kernels are kept in hydrostats._kernels, which is deferred in
+the same way.
+"""
+import importlib
+
+
+class LazyModule(object):
+    """Stand-in for a module that imports it the first time one of its attributes is used.
+
+    Parameters
+    ----------
+    name: str
+        The full name of the module (e.g. 'matplotlib.pyplot').
+
+    setup: function, optional
+        Called with the module right after it is imported.
+    """
+
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            # Keeps introspection (e.g. copy, pickle, doctest) from importing the module
+            raise AttributeError(attr)
+        if self._module is None:
+            module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(module)
+            self._module = module
+        return getattr(self._module, attr)
@@ -6,21 +6,27 @@ time series data. It allows users to make tables with metrics that they choose a
 date ranges. It also allows users to run a time lag analysis of two time series.
 """
 from __future__ import division
-from hydrostats.metrics import list_of_metrics
-from HydroErr.HydroErr import treat_values
-import pandas as pd
-from hydrostats.data import seasonal_period
+from hydrostats.metrics import MetricPlan, BatchStatistics, treat_arrays, treatment_mask, _LagMoments, _LAG_METRICS
+from hydrostats._lazy import LazyModule
 import calendar
 import numpy as np
-import matplotlib.pyplot as plt
+import multiprocessing
+import multiprocessing.pool
+import warnings
 
-__all__ = ['make_table', 'time_lag']
+# pandas and matplotlib are only imported once a function uses them
+pd = LazyModule('pandas')
+plt = LazyModule('matplotlib.pyplot')
+hd = LazyModule('hydrostats.data')
+
+__all__ = ['make_table', 'station_tables', 'model_table', 'annual_table', 'time_lag', 'batch_time_lag', 'lag_cube']
 
 
 def make_table(merged_dataframe, metrics, seasonal_periods=None, mase_m=1, dmod_j=1,
                nse_mod_j=1, h6_mhe_k=1, h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None,
                lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1), kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None,
-               remove_neg=False, remove_zero=False, location=None):
+               remove_neg=False, remove_zero=False, location=None, bootstrap_samples=None, block_size=1,
+               confidence=0.95, random_state=None, processes=None, cache=None, single_pass=False):
     """Create a table of user selected metrics with optional seasonal analysis.
 
     Creates a table with metrics as specified by the user. Seasonal periods can also be
@@ -102,11 +108,47 @@ def make_table(merged_dataframe, metrics, seasonal_periods=None, mase_m=1, dmod_
         The name of the location that will be created as a column in the table that is created.
         Useful for creating a large table with different datasets.
 
+    bootstrap_samples: int, optional
+        If given, the number of bootstrap resamples used to compute a confidence interval for each
+        metric value. The resamples are drawn from the cleaned data of each time range.
+
+    block_size: int, optional
+        The length of the blocks of consecutive values that are resampled together. The default of 1
+        is the plain bootstrap, a larger value gives a moving block bootstrap which keeps the
+        autocorrelation of the flows within each block.
+
+    confidence: float, optional
+        The confidence level of the percentile intervals, 0.95 by default.
+
+    random_state: int or RandomState, optional
+        Seed or numpy RandomState used to draw the resamples, for reproducible intervals.
+
+    processes: int, optional
+        If given, the resamples are evaluated in batches across a pool with this number of
+        processes. The processes are started with the 'spawn' method (see station_tables), so
+        scripts that use them must create the table under an ``if __name__ == '__main__':`` guard.
+
+    cache: hydrostats.metrics.MetricCache, optional
+        If given, the metric values of the full time series and of each seasonal period are looked
+        up in (and stored in) the cache, so repeated tables of the same data are not recomputed.
+        The bootstrap intervals are always recomputed.
+
+    single_pass: bool, optional
+        If True, a boolean membership matrix of the full time series and the seasonal periods is built
+        once and the data is cleaned a single time. The metrics that only need sums over the values
+        (e.g. ME, RMSE, NSE and KGE) are computed for every row of the table with one matrix product
+        (see hydrostats.metrics.MetricPlan.run_groups), and the median, rank and order based metrics
+        (e.g. MdAE, (MB) R and MASE) from the values of each seasonal period. The values agree with
+        the default computation up to floating point rounding, and the removed values are only
+        warned about once. Not used when a cache is given.
+
     Returns
     -------
     DataFrame
         Dataframe with rows containing the metric values at the different time ranges, and columns
-        containing the metrics specified.
+        containing the metrics specified. If bootstrap_samples is given, each metric column is
+        followed by the "<metric> CI Lower" and "<metric> CI Upper" columns with the bounds of its
+        confidence interval.
 
     Notes
     -----
@@ -146,9 +188,6 @@ def make_table(merged_dataframe, metrics, seasonal_periods=None, mase_m=1, dmod_
 
     """
 
-    # Creating a list for all of the metrics for all of the seasons
-    complete_metric_list = []
-
     # Creating an index list
     index_array = ['Full Time Series']
     if seasonal_periods is not None:
@@ -164,44 +203,375 @@ def make_table(merged_dataframe, metrics, seasonal_periods=None, mase_m=1, dmod_
     sim_array = merged_dataframe.iloc[:, 0].values
     obs_array = merged_dataframe.iloc[:, 1].values
 
-    # Getting a list of the full time series
-    full_time_series_list = list_of_metrics(metrics=metrics, abbr=True, sim_array=sim_array,
-                                            obs_array=obs_array, mase_m=mase_m, dmod_j=dmod_j,
-                                            nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
-                                            h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k,
-                                            d1_p_obs_bar_p=d1_p_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
-                                            lm_x_obs_bar_p=lm_x_obs_bar_p, replace_nan=replace_nan,
-                                            replace_inf=replace_inf, remove_neg=remove_neg,
-                                            remove_zero=remove_zero)
+    # Resolving the metrics once for the full time series and all of the seasonal periods
+    plan = MetricPlan(metrics, abbr=True, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
+                      replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+                      remove_zero=remove_zero)
+
+    # Month-day keys of the index, shared by all of the seasonal periods
+    month_day_keys = hd._month_day_keys(merged_dataframe.index) if seasonal_periods else None
+
+    if single_pass and cache is None:
+        # Rows of the full time series and each seasonal period, computed together from sums over the groups
+        membership = np.ones((len(index_array), sim_array.size), dtype=bool)
+        for i, time in enumerate(seasonal_periods or []):
+            membership[i + 1] = hd.seasonal_mask(merged_dataframe, time, month_day_keys=month_day_keys)
+        table_values = plan.run_groups(sim_array, obs_array, membership)
+        period_arrays = [(sim_array[row], obs_array[row]) for row in membership] if bootstrap_samples else []
+    else:
+        # Getting the arrays of the full time series and the seasonal periods
+        period_arrays = [(sim_array, obs_array)]
+        if seasonal_periods is not None:
+            for time in seasonal_periods:
+                period_arrays.append(hd.seasonal_period(merged_dataframe, time, numpy=True,
+                                                        month_day_keys=month_day_keys))
+
+        # Calculating the metrics for each of the time ranges straight into the rows of the table
+        table_values = np.empty((len(period_arrays), len(plan)))
+        for i, (sim_array, obs_array) in enumerate(period_arrays):
+            if cache is not None:
+                cache.run(plan, sim_array, obs_array, out=table_values[i])
+            else:
+                plan.run(sim_array, obs_array, out=table_values[i])
+
+    if not bootstrap_samples:
+        table_df_final = pd.DataFrame(table_values, index=index_array, columns=metrics)
+    else:
+        if not isinstance(random_state, np.random.RandomState):
+            random_state = np.random.RandomState(random_state)
+        pool = _process_pool(processes) if processes else None
+        try:
+            intervals = [_bootstrap_intervals(plan, sim_array, obs_array, bootstrap_samples, block_size, confidence,
+                                              random_state, pool) for sim_array, obs_array in period_arrays]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Placing the lower and upper bounds of the interval after each metric value
+        values = np.dstack((table_values,
+                            np.array([interval[0] for interval in intervals]),
+                            np.array([interval[1] for interval in intervals])))
+        columns = []
+        for metric in metrics:
+            columns.extend([metric, metric + ' CI Lower', metric + ' CI Upper'])
+        table_df_final = pd.DataFrame(values.reshape(len(index_array), -1), index=index_array, columns=columns)
 
-    # Appending the full time series list to the entire list:
-    complete_metric_list.append(full_time_series_list)
+    if location is not None:
+        col_values = [location for i in range(table_df_final.shape[0])]
+        table_df_final.insert(loc=0, column='Location', value=np.array(col_values))
 
-    # Calculating metrics for the seasonal periods
-    if seasonal_periods is not None:
-        for time in seasonal_periods:
-            temp_df = seasonal_period(merged_dataframe, time)
-            sim_array = temp_df.iloc[:, 0].values
-            obs_array = temp_df.iloc[:, 1].values
+    return table_df_final
+
+
+# Number of resampled values that are evaluated at once when bootstrapping
+_BOOTSTRAP_BATCH_ELEMENTS = 2 ** 21
+
+
+def _bootstrap_indices(n, samples, block_size, random_state):
+    # Index matrix of all of the resamples, using the moving block bootstrap if the blocks are longer than 1
+    if block_size <= 1:
+        return random_state.randint(0, n, size=(samples, n))
+    block_size = min(block_size, n)
+    n_blocks = -(-n // block_size)
+    starts = random_state.randint(0, n - block_size + 1, size=(samples, n_blocks, 1))
+    return (starts + np.arange(block_size)).reshape(samples, -1)[:, :n]
+
+
+def _bootstrap_batch(args):
+    # Metrics of a batch of resamples, module level so that it can be sent to a process pool
+    plan, sim_array, obs_array, indices = args
+    return plan.run_batch(sim_array[indices], obs_array[indices])
+
+
+def _bootstrap_intervals(plan, sim_array, obs_array, samples, block_size, confidence, random_state, pool):
+    # Lower and upper percentile bounds of each metric over the bootstrap resamples
+    with warnings.catch_warnings():
+        # The user was already warned about the removed values when the metrics were computed
+        warnings.simplefilter("ignore", UserWarning)
+        sim_array, obs_array = treat_arrays(sim_array, obs_array, **plan.cleaning)
+    if sim_array.size == 0:
+        return np.full((2, len(plan)), np.nan)
+
+    indices = _bootstrap_indices(sim_array.size, samples, block_size, random_state)
+    batch_size = max(1, _BOOTSTRAP_BATCH_ELEMENTS // sim_array.size)
+    tasks = [(plan, sim_array, obs_array, indices[i:i + batch_size]) for i in range(0, samples, batch_size)]
+    if pool is None:
+        results = np.vstack([_bootstrap_batch(task) for task in tasks])
+    else:
+        results = np.vstack(pool.map(_bootstrap_batch, tasks))
+
+    tail = (1 - confidence) / 2 * 100
+    with warnings.catch_warnings():
+        # Metrics without any defined resample values are given NaN bounds
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanpercentile(results, [tail, 100 - tail], axis=0)
+
+
+def station_tables(stations, metrics, seasonal_periods=None, processes=None, threads=False, chunksize=1,
+                   stream=False, **kwargs):
+    """Create the make_table tables of many stations, optionally across a pool of processes or threads.
+
+    Parameters
+    ----------
+    stations: dict or iterable of (str, DataFrame or str) tuples
+        The name of each station and its merged dataframe (see make_table), or the path to a pickle
+        or csv file of the merged dataframe. Files are read by the workers, so only the paths are
+        sent to them.
+
+    metrics: list of str
+        A list of the abbreviations of the metrics to calculate, see make_table.
+
+    seasonal_periods: 2D list of str, optional
+        The seasonal periods to analyze for every station, see make_table.
+
+    processes: int, optional
+        If given, the stations are divided among a pool with this number of workers. Otherwise the
+        tables are created one after the other.
+
+    threads: bool, optional
+        If True, the pool is made of threads instead of processes. Threads do not need to copy the
+        dataframes, but only the parts of the computation that run outside of the Python interpreter
+        lock happen in parallel. The processes are started with the 'spawn' method instead of being
+        forked: a process forked after numba has run a parallel kernel (e.g. ens_crps) in the
+        parent can hang, because the threads of numba's threading layer are not copied into it.
+        Spawned processes import hydrostats again, so scripts that use them must create the tables
+        under an ``if __name__ == '__main__':`` guard.
+
+    chunksize: int, optional
+        The number of stations that are sent to a worker at once.
 
-            seasonal_metric_list = list_of_metrics(
-                metrics=metrics, sim_array=sim_array, abbr=True, obs_array=obs_array,
-                mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
-                h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
-                lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
-                replace_nan=replace_nan, replace_inf=replace_inf,
-                remove_neg=remove_neg, remove_zero=remove_zero
-            )
+    stream: bool, optional
+        If True, a generator is returned that yields the (station, table) pairs in the order of the
+        stations as soon as they are ready, instead of the concatenated table.
 
-            complete_metric_list.append(seasonal_metric_list)
+    kwargs
+        Other keyword arguments of make_table (e.g. remove_neg or bootstrap_samples).
 
-    table_df_final = pd.DataFrame(complete_metric_list, index=index_array, columns=metrics)
+    Returns
+    -------
+    DataFrame or generator
+        The tables of all of the stations stacked in order, with the station name in the Location
+        column, or a generator of the tables if stream is True.
+
+    Examples
+    --------
+    >>> import hydrostats.analyze as ha
+    >>> stations = {'Magdalena': 'magdalena_merged.pkl', 'Amazon': 'amazon_merged.pkl'}
+    >>> table = ha.station_tables(stations, ['ME', 'NSE', 'KGE (2012)'], processes=4, remove_neg=True)
+    """
+    if hasattr(stations, 'items'):
+        stations = stations.items()
+    tasks = ((station, data, metrics, seasonal_periods, kwargs) for station, data in stations)
+    tables = _station_tables(tasks, processes, threads, chunksize)
+    if stream:
+        return tables
+    return pd.concat([table for _, table in tables])
+
+
+def _station_tables(tasks, processes, threads, chunksize):
+    # Yields the tables of the stations in order, closing the pool once they have all been made
+    if not processes:
+        for task in tasks:
+            yield _station_table(task)
+        return
+
+    pool = multiprocessing.pool.ThreadPool(processes) if threads else _process_pool(processes)
+    try:
+        for result in pool.imap(_station_table, tasks, chunksize):
+            yield result
+    except BaseException:
+        # Includes the generator being closed before all of the tables were made
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+
+
+def _process_pool(processes):
+    # Forked workers can hang once numba's threading layer has been started in the parent, so the
+    # processes are spawned. Python 2 only has fork.
+    if hasattr(multiprocessing, 'get_context'):
+        return multiprocessing.get_context('spawn').Pool(processes)
+    return multiprocessing.Pool(processes)
+
+
+def _station_table(task):
+    # Table of a single station, module level so that it can be sent to a process pool
+    station, data, metrics, seasonal_periods, kwargs = task
+    if isinstance(data, str):
+        if data.endswith(('.pkl', '.pickle')):
+            data = pd.read_pickle(data)
+        else:
+            data = pd.read_csv(data, index_col=0, parse_dates=True)
+    return station, make_table(data, metrics, seasonal_periods, location=station, **kwargs)
+
+
+def model_table(merged_dataframe, metrics, obs_column=-1, mase_m=1, dmod_j=1, nse_mod_j=1, h6_mhe_k=1, h6_ahe_k=1,
+                h6_rmshe_k=1, d1_p_obs_bar_p=None, lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1), kge2012_s=(1, 1, 1),
+                replace_nan=None, replace_inf=None, remove_neg=False, remove_zero=False, location=None):
+    """Create a table of user selected metrics comparing many simulations with the same observed data.
+
+    All of the simulations are evaluated together against the one observed column (see
+    hydrostats.metrics.batch_metrics), so the observed column is only read and converted once and
+    all of the models share the same vectorized pass over the data. When every model keeps the same
+    time steps, the statistics of the observed data (e.g. its mean, variance and percentiles) are
+    also computed only once.
+
+    Parameters
+    ----------
+    merged_dataframe: DataFrame
+        A pandas dataframe with a column of simulated data for each model and one column of
+        observed data.
+
+    metrics: list of str
+        A list of the abbreviations of the metrics to calculate, see make_table.
+
+    obs_column: int, optional
+        The position of the column of observed data, the last column by default. All of the other
+        columns are simulations.
+
+    mase_m, dmod_j, nse_mod_j, h6_mhe_k, h6_ahe_k, h6_rmshe_k, d1_p_obs_bar_p, lm_x_obs_bar_p, kge2009_s, kge2012_s
+        The metric parameters, see make_table.
+
+    replace_nan, replace_inf, remove_neg, remove_zero
+        The data cleaning options, see make_table. The values are removed pairwise, so each model
+        is compared with the observed values at the time steps where both are valid.
+
+    location: str, optional
+        The name of the location, added as the first column of the table if given.
+
+    Returns
+    -------
+    DataFrame
+        A dataframe with a row for each model (named after its column) and a column for each metric.
+
+    Examples
+    --------
+    >>> import hydrostats.analyze as ha
+    >>> models_df = merged_df[['SFPT']].assign(Scaled=merged_df['SFPT'] * 1.1, GLOFAS=merged_df['GLOFAS'])
+    >>> ha.model_table(models_df, ['ME', 'NSE', 'KGE (2012)'], remove_neg=True, remove_zero=True)
+                     ME       NSE  KGE (2012)
+    Model
+    SFPT     140.423298  0.873684    0.872871
+    Scaled  1076.937186  0.766063    0.828072
+    """
+    plan = MetricPlan(metrics, abbr=True, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
+                      replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+                      remove_zero=remove_zero)
+
+    obs_position = np.arange(merged_dataframe.shape[1])[obs_column]
+    sim_positions = [i for i in range(merged_dataframe.shape[1]) if i != obs_position]
+    if not sim_positions:
+        raise RuntimeError("The dataframe must have at least one column of simulated data.")
+
+    # One row per model, all paired with the same 1D observed data, so that the observed statistics
+    # are shared by the models that keep the same time steps
+    sim_array = merged_dataframe.iloc[:, sim_positions].values.T
+    obs_array = merged_dataframe.iloc[:, obs_position].values
+    table_values = plan.run_batch(sim_array, obs_array)
+
+    table_df = pd.DataFrame(table_values, index=pd.Index(merged_dataframe.columns[sim_positions], name='Model'),
+                            columns=metrics)
 
     if location is not None:
-        col_values = [location for i in range(table_df_final.shape[0])]
-        table_df_final.insert(loc=0, column='Location', value=np.array(col_values))
+        table_df.insert(loc=0, column='Location', value=location)
 
-    return table_df_final
+    return table_df
+
+
+def annual_table(merged_dataframe, metrics, year_start='01-01', mase_m=1, dmod_j=1, nse_mod_j=1, h6_mhe_k=1,
+                 h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None, lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1),
+                 kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None, remove_neg=False, remove_zero=False,
+                 location=None):
+    """Create a table of user selected metrics for every year (or water year) of the data.
+
+    The rows of the dataframe are grouped into consecutive years that begin on the given month and
+    day, and the metrics of all of the years are computed together with reductions over the
+    contiguous slice of each year, instead of selecting each year separately.
+
+    Parameters
+    ----------
+    merged_dataframe: DataFrame
+        A pandas dataframe that has two columns of predicted data (Col 0) and observed data (Col 1)
+        with a sorted datetime index.
+
+    metrics: list of str
+        A list of the abbreviations of the metrics to calculate, see make_table.
+
+    year_start: str, optional
+        The first day of each year in MM-DD format. Defaults to calendar years, use e.g. '10-01'
+        for water years that begin on October 1st. Years that do not begin on January 1st are
+        named after the calendar year in which they end, so the water year 2001 spans from
+        2000-10-01 to 2001-09-30.
+
+    mase_m, dmod_j, nse_mod_j, h6_mhe_k, h6_ahe_k, h6_rmshe_k, d1_p_obs_bar_p, lm_x_obs_bar_p, kge2009_s, kge2012_s
+        The metric parameters, see make_table.
+
+    replace_nan, replace_inf, remove_neg, remove_zero
+        The data cleaning options, see make_table.
+
+    location: str, optional
+        The name of the location, added as the first column of the table if given.
+
+    Returns
+    -------
+    DataFrame
+        A dataframe with a row for each year that contains data and a column for each metric.
+
+    Examples
+    --------
+    Using the data from the make_table example, the metrics of each water year are computed.
+
+    >>> table = ha.annual_table(merged_df, ['MAE', 'NSE', 'KGE (2012)'], year_start='10-01', remove_neg=True,
+    ...                         remove_zero=True)
+    >>> table.head()
+                        MAE       NSE  KGE (2012)
+    Water Year
+    1980         918.935005  0.186463    0.483687
+    1981        1297.330249  0.853854    0.844600
+    1982        1381.249276  0.762515    0.818867
+    1983        1011.047886  0.862311    0.833161
+    1984         855.968359  0.851315    0.838458
+    """
+    plan = MetricPlan(metrics, abbr=True, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
+                      replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+                      remove_zero=remove_zero)
+
+    # Labeling each row with its year, years that begin after January 1st end in the next calendar year
+    index = merged_dataframe.index
+    years = np.asarray(index.year, dtype=np.int64)
+    month, day = (int(value) for value in year_start.split('-'))
+    if (month, day) != (1, 1):
+        years = years + ((np.asarray(index.month) * 100 + np.asarray(index.day)) >= month * 100 + day)
+    if np.any(np.diff(years) < 0):
+        raise RuntimeError("The index of the dataframe must be sorted.")
+
+    # The rows of each year are a contiguous slice, which is laid out as one padded row of a 2D array
+    labels, starts, lengths = np.unique(years, return_index=True, return_counts=True)
+    offsets = np.arange(lengths.max() if lengths.size else 0)
+    mask = offsets < lengths[:, np.newaxis]
+    rows = np.where(mask, starts[:, np.newaxis] + offsets, 0)
+
+    sim_array = merged_dataframe.iloc[:, 0].values
+    obs_array = merged_dataframe.iloc[:, 1].values
+    table_values = plan.run_batch(sim_array[rows], obs_array[rows], mask=mask)
+
+    table_df = pd.DataFrame(table_values, index=pd.Index(labels, name='Year' if (month, day) == (1, 1)
+                                                         else 'Water Year'), columns=metrics)
+
+    if location is not None:
+        table_df.insert(loc=0, column='Location', value=location)
+
+    return table_df
 
 
 def time_lag(merged_dataframe, metrics, interp_freq='6H', interp_type='pchip',
@@ -209,7 +579,8 @@ def time_lag(merged_dataframe, metrics, interp_freq='6H', interp_type='pchip',
              h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None, lm_x_obs_bar_p=None, replace_nan=None,
              replace_inf=None, remove_neg=False, remove_zero=False, plot=False,
              plot_title='Metric Values as Different Lags', ylabel='Metric Value',
-             xlabel='Number of Lags', save_fig=None, figsize=(10, 6), station=None):
+             xlabel='Number of Lags', save_fig=None, figsize=(10, 6), station=None, overlap=False,
+             search=False, workers=None, threads=True):
     """Check metric values between simulated and observed data at different time lags.
 
     Runs a time lag analysis to check for potential timing errors in the simulated data. Can also create a
@@ -303,6 +674,34 @@ def time_lag(merged_dataframe, metrics, interp_freq='6H', interp_type='pchip',
     station: str
         The station of analysis. Includes the station in the table if given.
 
+    overlap: bool, optional
+        If True, each lag only compares the time steps where the shifted simulated data overlaps the
+        observed data, using views of the two arrays. By default the simulated data is rolled around
+        (with np.roll), so the values shifted past one end of the series are compared with the
+        observed values at the other end.
+
+    search: bool, optional
+        If True, the data is not interpolated to interp_freq. The lags are evaluated at the native
+        time step of the data (every native step within shift_range, which is still given in
+        steps of interp_freq), and the maximum and minimum of each metric are then refined to a
+        fraction of a step by fitting a parabola through the extreme value and its two neighbours.
+        The summary reports the refined values and lag numbers (in steps of interp_freq), and the
+        lag table has a row for each native step. This is much faster and uses less memory on long
+        records, but the data must have a regular time step (otherwise it is interpolated to its
+        median time step).
+
+    workers: int, optional
+        If given, the lags of the metrics that are evaluated one lag at a time (e.g. the medians
+        and the absolute errors) are divided into contiguous blocks and spread across a pool with
+        this number of workers. The results are put back in the order of the lags, so they are the
+        same as without a pool.
+
+    threads: bool, optional
+        If True (the default), the pool of workers is made of threads, which share the data and
+        run the numpy reductions in parallel. If False, a process pool is used instead, which
+        copies the data to each process but also runs the pure Python parts in parallel. The
+        processes are started with the 'spawn' method, see station_tables.
+
     Notes
     -----
     If desired, users can export the tables to a CSV or Excel Workbook. This can be done using the built in methods
@@ -356,8 +755,18 @@ def time_lag(merged_dataframe, metrics, interp_freq='6H', interp_type='pchip',
     """
 
     # Making a new time index to be able to interpolate the time series to the required input
-    new_index = pd.date_range(merged_dataframe.index[0], merged_dataframe.index[-1],
-                              freq=interp_freq)
+    interp_step = pd.Timedelta(pd.tseries.frequencies.to_offset(interp_freq))
+    lag_step = 1
+    if search:
+        # Staying on the native time step, in which a lag is this many steps of interp_freq
+        native_step = pd.Timedelta(np.median(np.diff(merged_dataframe.index.values)))
+        lag_step = native_step / interp_step
+        if lag_step == int(lag_step):
+            lag_step = int(lag_step)
+        new_index = pd.date_range(merged_dataframe.index[0], merged_dataframe.index[-1], freq=native_step)
+    else:
+        new_index = pd.date_range(merged_dataframe.index[0], merged_dataframe.index[-1],
+                                  freq=interp_freq)
 
     # Reindexing the dataframe and interpolating it
     try:
@@ -371,29 +780,21 @@ def time_lag(merged_dataframe, metrics, interp_freq='6H', interp_type='pchip',
     sim_array = merged_dataframe.iloc[:, 0].values
     obs_array = merged_dataframe.iloc[:, 1].values
 
-    sim_array, obs_array = treat_values(sim_array, obs_array, replace_nan=replace_nan, replace_inf=replace_inf,
+    sim_array, obs_array = treat_arrays(sim_array, obs_array, replace_nan=replace_nan, replace_inf=replace_inf,
                                         remove_zero=remove_zero, remove_neg=remove_neg)
 
-    # Creating a list to append the values of shift to
-    shift_list = []
-
-    # Creating a list of all the time shifts specified by the user
-    lag_array = np.arange(shift_range[0], shift_range[1] + 1)
+    # Resolving the metrics once for all of the lags
+    plan = MetricPlan(metrics, abbr=True, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, replace_nan=replace_nan, replace_inf=replace_inf,
+                      remove_neg=remove_neg, remove_zero=remove_zero)
 
-    # Looping through the list of lags and appending the metric value to the shift list
-    for i in lag_array:
-        sim_array_temp = np.roll(sim_array, i)
+    # Creating a list of all the time shifts specified by the user, in steps of the data
+    data_lags = np.arange(int(np.ceil(shift_range[0] / lag_step)), int(np.floor(shift_range[1] / lag_step)) + 1)
+    lag_array = data_lags * lag_step
 
-        lag_metrics = list_of_metrics(
-            metrics=metrics, sim_array=sim_array_temp, obs_array=obs_array, mase_m=mase_m,
-            abbr=True, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k, h6_ahe_k=h6_ahe_k,
-            h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p, lm_x_obs_bar_p=lm_x_obs_bar_p,
-            replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
-            remove_zero=remove_zero
-        )
-        shift_list.append(lag_metrics)
+    final_array = _lag_metrics(plan, sim_array, obs_array, data_lags, overlap, workers, threads)
 
-    final_array = np.array(shift_list)
     if plot:
         plt.figure(figsize=figsize)
 
@@ -414,12 +815,17 @@ def time_lag(merged_dataframe, metrics, interp_freq='6H', interp_type='pchip',
             plt.savefig(save_fig)
             plt.close()
 
-    max_lag_array = np.max(final_array, 0)
-    max_lag_indices = np.argmax(final_array, 0)
-    max_lag_locations = lag_array[max_lag_indices]
-    min_lag_array = np.min(final_array, 0)
-    min_lag_indices = np.argmin(final_array, 0)
-    min_lag_locations = lag_array[min_lag_indices]
+    if search:
+        max_lag_array, max_lag_locations = _refine_extreme(final_array, lag_array)
+        min_lag_array, min_lag_locations = _refine_extreme(-final_array, lag_array)
+        min_lag_array = -min_lag_array
+    else:
+        max_lag_array = np.max(final_array, 0)
+        max_lag_indices = np.argmax(final_array, 0)
+        max_lag_locations = lag_array[max_lag_indices]
+        min_lag_array = np.min(final_array, 0)
+        min_lag_indices = np.argmin(final_array, 0)
+        min_lag_locations = lag_array[min_lag_indices]
 
     data = np.column_stack((max_lag_array, max_lag_locations, min_lag_array, min_lag_locations))
 
@@ -437,5 +843,319 @@ def time_lag(merged_dataframe, metrics, interp_freq='6H', interp_type='pchip',
     return lag_df, summary_df
 
 
+def batch_time_lag(merged_dataframes, metrics, interp_freq='6H', interp_type='pchip', shift_range=(-30, 30),
+                   mase_m=1, dmod_j=1, nse_mod_j=1, h6_mhe_k=1, h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None,
+                   lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1), kge2012_s=(1, 1, 1), replace_nan=None,
+                   replace_inf=None, remove_neg=False, remove_zero=False, overlap=False):
+    """Run the time lag analysis of many stations at once.
+
+    Each merged dataframe is interpolated to interp_freq from its own first time step, as in
+    time_lag. The interpolated series are then stacked as the rows of two 2D arrays, each from its
+    first column and followed by padding, so that all of the stations go through lag_cube together
+    instead of calling time_lag once per station. The records can have different start times and
+    lengths, and each one is shifted within its own record, so the results of each station are the
+    same as time_lag (when there are no values to remove, see lag_cube).
+
+    Parameters
+    ----------
+    merged_dataframes: dict or list of DataFrames
+        The merged dataframes of the stations, each with simulated data (Col 0) and observed data
+        (Col 1) and a datetime index. If a dict is given, the keys are used as the station names,
+        otherwise the stations are numbered from 0.
+
+    metrics: list of str
+        A list of the abbreviations of the metrics to calculate, see time_lag.
+
+    interp_freq, interp_type, shift_range
+        The interpolation and the range of the lags, see time_lag. The lags are whole steps of
+        interp_freq.
+
+    mase_m, dmod_j, nse_mod_j, h6_mhe_k, h6_ahe_k, h6_rmshe_k, d1_p_obs_bar_p, lm_x_obs_bar_p, kge2009_s, kge2012_s
+        The metric parameters, see make_table.
+
+    replace_nan, replace_inf, remove_neg, remove_zero, overlap
+        The data cleaning options and the handling of the ends of the series, see lag_cube.
+
+    Returns
+    -------
+    tuple of (3D ndarray, DataFrame)
+        The metric values of dimension n_station x n_lag x n_metric, with the lags in the order of
+        range(shift_range[0], shift_range[1] + 1), and a summary with a row for each station and
+        metric (a MultiIndex of 'Station' and 'Metric') and the same columns as the summary of
+        time_lag.
+
+    Examples
+    --------
+    >>> import hydrostats.analyze as ha
+    >>> cube, summary_df = ha.batch_time_lag({'Calamar': merged_df, 'Scaled': merged_df * 1.1},
+    ...                                      ['ME', 'r2', 'NSE'], shift_range=(-10, 10))
+    >>> cube.shape
+    (2, 21, 3)
+    """
+    if isinstance(merged_dataframes, dict):
+        stations = list(merged_dataframes.keys())
+        frames = list(merged_dataframes.values())
+    else:
+        frames = list(merged_dataframes)
+        stations = list(range(len(frames)))
+    if not frames:
+        raise RuntimeError("At least one merged dataframe must be given.")
+
+    # Interpolating each station on its own time steps, as time_lag does
+    interpolated = []
+    for station, frame in zip(stations, frames):
+        new_index = pd.date_range(frame.index[0], frame.index[-1], freq=interp_freq)
+        try:
+            frame = frame.reindex(new_index).interpolate(interp_type)
+        except Exception:
+            raise RuntimeError("Error while interpolating station {}, please make sure that you don't have "
+                               "duplicate dates in your time series data.".format(station))
+        interpolated.append(frame)
+
+    # One row per station, starting at the first column and padded at the end
+    lengths = np.array([frame.shape[0] for frame in interpolated])
+    sim_array = np.full((len(frames), lengths.max()), np.nan)
+    obs_array = np.full((len(frames), lengths.max()), np.nan)
+    for row, frame in enumerate(interpolated):
+        sim_array[row, :lengths[row]] = frame.iloc[:, 0].values
+        obs_array[row, :lengths[row]] = frame.iloc[:, 1].values
+
+    cube = lag_cube(sim_array, obs_array, metrics, shift_range=shift_range, lengths=lengths, mase_m=mase_m,
+                    dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k, h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k,
+                    d1_p_obs_bar_p=d1_p_obs_bar_p, lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s,
+                    kge2012_s=kge2012_s, replace_nan=replace_nan, replace_inf=replace_inf,
+                    remove_neg=remove_neg, remove_zero=remove_zero, overlap=overlap)
+
+    # The extremes of every station and metric at once, along the lag axis
+    lag_array = np.arange(int(shift_range[0]), int(shift_range[1]) + 1)
+    data = np.stack((np.max(cube, 1), lag_array[np.argmax(cube, 1)],
+                     np.min(cube, 1), lag_array[np.argmin(cube, 1)]), axis=-1)
+
+    summary_df = pd.DataFrame(data.reshape(-1, 4),
+                              index=pd.MultiIndex.from_product([stations, metrics], names=['Station', 'Metric']),
+                              columns=["Max", "Max Lag Number", "Min", "Min Lag Number"])
+
+    return cube, summary_df
+
+
+def lag_cube(sim_array, obs_array, metrics, shift_range=(-30, 30), lengths=None, mase_m=1, dmod_j=1, nse_mod_j=1,
+             h6_mhe_k=1, h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None, lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1),
+             kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None, remove_neg=False, remove_zero=False,
+             overlap=False):
+    """Compute metrics at different time lags for many simulated and observed series on a common index.
+
+    The metrics that are built from sums of the pairs (e.g. ME, RMSE, r2, NSE and KGE) are computed
+    for every series and every lag at once from FFT cross correlations along the time axis. The
+    other metrics are computed one lag at a time, but for all of the series together (see
+    hydrostats.metrics.batch_metrics), so there is no Python loop over the series.
+
+    Parameters
+    ----------
+    sim_array: 2D ndarray
+        Array of simulated data of dimension n_series x n_time.
+
+    obs_array: 2D ndarray
+        Array of observed data of dimension n_series x n_time.
+
+    metrics: list of str
+        A list of the abbreviations of the metrics to calculate, see time_lag.
+
+    shift_range: tuple of 2 ints, optional
+        The range of the lags, in time steps of the arrays. The simulated data is shifted by every
+        lag from shift_range[0] to shift_range[1].
+
+    lengths: 1D ndarray of int, optional
+        The number of time steps of each series, if the series have different lengths. Each row
+        then holds its series in its first columns, and the columns after it are ignored. The
+        series are shifted within their own lengths (e.g. rolled around their own ends). By default
+        every series uses all of the columns.
+
+    mase_m, dmod_j, nse_mod_j, h6_mhe_k, h6_ahe_k, h6_rmshe_k, d1_p_obs_bar_p, lm_x_obs_bar_p, kge2009_s, kge2012_s
+        The metric parameters, see make_table.
+
+    replace_nan, replace_inf, remove_neg, remove_zero
+        The data cleaning options, see time_lag. Unlike time_lag, the values are not removed before
+        the simulated data is shifted: each lag leaves out the pairs that have an invalid value, so
+        a gap lines up with the same time steps of the other series at every lag. Without invalid
+        values the results are the same as time_lag.
+
+    overlap: bool, optional
+        If True, each lag only compares the time steps where the shifted simulated data overlaps the
+        observed data. By default the simulated data is rolled around, see time_lag.
+
+    Returns
+    -------
+    3D ndarray
+        The metric values of dimension n_series x n_lag x n_metric.
+    """
+    plan = MetricPlan(metrics, abbr=True, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
+                      replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+                      remove_zero=remove_zero)
+
+    sim = np.asarray(sim_array, dtype=np.float64)
+    obs = np.asarray(obs_array, dtype=np.float64)
+    if sim.ndim != 2 or obs.ndim != 2:
+        raise RuntimeError("One or both of the ndarrays are not 2 dimensional.")
+    if sim.shape != obs.shape:
+        raise RuntimeError("The two ndarrays are not the same shape.")
+
+    # Where each row holds its own series, if they have different lengths
+    kept = None
+    if lengths is not None:
+        lengths = np.asarray(lengths, dtype=np.int64)
+        if lengths.shape != (sim.shape[0],) or np.any(lengths < 0) or np.any(lengths > sim.shape[1]):
+            raise RuntimeError("The lengths must give the number of time steps of each row of the ndarrays.")
+        if np.all(lengths == sim.shape[1]):
+            lengths = None
+        else:
+            kept = np.arange(sim.shape[1]) < lengths[:, np.newaxis]
+
+    lag_array = np.arange(int(shift_range[0]), int(shift_range[1]) + 1)
+    cube = np.full((sim.shape[0], lag_array.size, len(plan)), np.nan)
+    moment_columns = [i for i, (metric_func, _) in enumerate(plan.functions) if metric_func in _LAG_METRICS]
+    if not sim.shape[1]:
+        moment_columns = []
+    direct_columns = [i for i in range(len(plan)) if i not in moment_columns]
+
+    if moment_columns:
+        sim_clean, sim_valid = _valid_values(sim, **plan.cleaning)
+        obs_clean, obs_valid = _valid_values(obs, **plan.cleaning)
+        if kept is not None:
+            sim_valid &= kept
+            obs_valid &= kept
+        valid = None if sim_valid.all() and obs_valid.all() else (sim_valid, obs_valid)
+        moments = _LagMoments(sim_clean, obs_clean, lag_array, overlap=overlap, valid=valid, lengths=lengths)
+        for i in moment_columns:
+            metric_func, params = plan.functions[i]
+            cube[:, :, i] = moments.compute(metric_func, **params)
+
+    if direct_columns:
+        if kept is None:
+            pairs = ((sim_lagged, obs_lagged, None)
+                     for sim_lagged, obs_lagged in _lagged_pairs(sim, obs, lag_array, overlap))
+        elif overlap:
+            pairs = ((sim_lagged, obs_lagged, sim_kept & obs_kept)
+                     for (sim_lagged, obs_lagged), (sim_kept, obs_kept)
+                     in zip(_lagged_pairs(sim, obs, lag_array, True), _lagged_pairs(kept, kept, lag_array, True)))
+        else:
+            pairs = _rolled_pairs(sim, obs, lag_array, lengths)
+
+        for row, (sim_lagged, obs_lagged, mask) in enumerate(pairs):
+            if not sim_lagged.shape[1]:
+                continue
+            stats = BatchStatistics(sim_lagged, obs_lagged, mask=mask, **plan.cleaning)
+            for i in direct_columns:
+                metric_func, params = plan.functions[i]
+                cube[:, row, i] = stats.compute(metric_func, **params)
+
+    return cube
+
+
+def _rolled_pairs(sim_array, obs_array, lag_array, lengths):
+    # Like _lagged_pairs with np.roll, but each row is rolled around its own length and the columns
+    # after it are left in place. Also gives where the rows hold their series.
+    columns = np.arange(sim_array.shape[1])
+    kept = columns < lengths[:, np.newaxis]
+    periods = np.maximum(lengths, 1)[:, np.newaxis]
+    for lag in lag_array:
+        rolled = np.where(kept, (columns - lag) % periods, columns)
+        yield np.take_along_axis(sim_array, rolled, axis=1), obs_array, kept
+
+
+def _valid_values(array, replace_nan=None, replace_inf=None, remove_neg=False, remove_zero=False):
+    # The array with the NaN and Inf values replaced, and where its values are kept by the cleaning
+    if replace_nan is not None or replace_inf is not None:
+        array = array.copy()
+        if replace_nan is not None:
+            array[np.isnan(array)] = replace_nan
+        if replace_inf is not None:
+            array[np.isinf(array)] = replace_inf
+    flat = array.ravel()
+    valid = treatment_mask(flat, flat, remove_zero=remove_zero, remove_neg=remove_neg).reshape(array.shape)
+    return array, valid
+
+
+def _lag_metrics(plan, sim_array, obs_array, lag_array, overlap=False, workers=None, threads=True):
+    # Metric values of the simulated data shifted by each lag, one row per lag
+    final_array = np.empty((lag_array.size, len(plan)))
+    moment_columns = [i for i, (metric_func, _) in enumerate(plan.functions) if metric_func in _LAG_METRICS]
+    if not sim_array.size:
+        moment_columns = []
+    direct_columns = [i for i in range(len(plan)) if i not in moment_columns]
+
+    if moment_columns:
+        # The metrics that are built from sums of the pairs are computed for all of the lags at once
+        moments = _LagMoments(sim_array, obs_array, lag_array, overlap=overlap)
+        for i in moment_columns:
+            metric_func, params = plan.functions[i]
+            final_array[:, i] = moments.compute(metric_func, **params)
+
+    if direct_columns and not workers:
+        final_array[:, direct_columns] = _lag_rows((plan, sim_array, obs_array, lag_array, overlap, direct_columns))
+    elif direct_columns:
+        # Contiguous blocks of lags, a few per worker so that they stay busy when some blocks are slower
+        blocks = np.array_split(lag_array, min(lag_array.size, workers * 4))
+        tasks = [(plan, sim_array, obs_array, block, overlap, direct_columns) for block in blocks if block.size]
+        pool = multiprocessing.pool.ThreadPool(workers) if threads else _process_pool(workers)
+        try:
+            final_array[:, direct_columns] = np.vstack(pool.map(_lag_rows, tasks))
+        finally:
+            pool.close()
+            pool.join()
+
+    return final_array
+
+
+def _lag_rows(task):
+    # Metrics of a block of lags, one lag at a time. Module level so that it can be sent to a process pool.
+    plan, sim_array, obs_array, lag_array, overlap, columns = task
+    rows = np.empty((lag_array.size, len(columns)))
+    for row, (sim_lagged, obs_lagged) in enumerate(_lagged_pairs(sim_array, obs_array, lag_array, overlap)):
+        if not sim_lagged.size:
+            rows[row] = np.nan
+            continue
+        stats = plan.statistics(sim_lagged, obs_lagged)
+        for j, i in enumerate(columns):
+            metric_func, params = plan.functions[i]
+            rows[row, j] = stats.compute(metric_func, **params)
+    return rows
+
+
+def _refine_extreme(final_array, lag_array):
+    # Maximum of each column and its lag, refined with the vertex of the parabola through the
+    # maximum and its two neighbours. Maxima at either end of the lags are not refined.
+    indices = np.argmax(final_array, 0)
+    columns = np.arange(final_array.shape[1])
+    values = final_array[indices, columns].astype(np.float64)
+    locations = lag_array[indices].astype(np.float64)
+
+    inner = (indices > 0) & (indices < final_array.shape[0] - 1)
+    before = final_array[np.where(inner, indices - 1, indices), columns]
+    after = final_array[np.where(inner, indices + 1, indices), columns]
+    curvature = before - 2 * values + after
+    inner &= curvature < 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        offset = np.where(inner, 0.5 * (before - after) / curvature, 0.)
+    step = lag_array[1] - lag_array[0] if lag_array.size > 1 else 1
+
+    return values - 0.25 * (before - after) * offset, locations + offset * step
+
+
+def _lagged_pairs(sim_array, obs_array, lag_array, overlap):
+    # The simulated value at i - lag paired with the observed value at i for each lag. The overlapping
+    # parts are slices, so they are views of the arrays and no data is copied.
+    # The arrays may also be 2D with one series per row, then the lags are along the rows.
+    n = sim_array.shape[-1]
+    for lag in lag_array:
+        if not overlap:
+            yield np.roll(sim_array, lag, axis=-1), obs_array
+        elif lag >= 0:
+            yield sim_array[..., :max(n - lag, 0)], obs_array[..., min(lag, n):]
+        else:
+            yield sim_array[..., min(-lag, n):], obs_array[..., :max(n + lag, 0)]
+
+
 if __name__ == "__main__":
     pass
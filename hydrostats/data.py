@@ -7,10 +7,12 @@ daily and monthly summary statistics, and get seasonal periods of a time series.
 """
 from __future__ import division
 import pandas as pd
+import numpy as np
 from numpy import inf, nan
 
-__all__ = ['julian_to_gregorian', 'merge_data', 'daily_average', 'daily_std_error', 'daily_std_dev', 'monthly_average',
-           'monthly_std_error', 'monthly_std_dev', 'remove_nan_df', 'seasonal_period']
+__all__ = ['julian_to_gregorian', 'merge_data', 'merge_data_chunks', 'daily_average', 'daily_std_error',
+           'daily_std_dev', 'monthly_average', 'monthly_std_error', 'monthly_std_dev', 'remove_nan_df',
+           'seasonal_period', 'seasonal_mask']
 
 
 def julian_to_gregorian(dataframe, frequency=None, inplace=False):
@@ -136,7 +138,7 @@ def julian_to_gregorian(dataframe, frequency=None, inplace=False):
 
 def merge_data(sim_fpath=None, obs_fpath=None, sim_df=None, obs_df=None, interpolate=None,
                column_names=('Simulated', 'Observed'), simulated_tz=None, observed_tz=None, interp_type='pchip',
-               return_tz="Etc/UTC", julian=False, julian_freq=None):
+               return_tz="Etc/UTC", julian=False, julian_freq=None, date_format=None):
     """Merges two dataframes or csv files, depending on the input.
 
     Parameters
@@ -194,10 +196,19 @@ def merge_data(sim_fpath=None, obs_fpath=None, sim_df=None, obs_df=None, interpo
     julian_freq: str
         A string representing the frequency of the julian dates so that they can be rounded. See examples for usage.
 
+    date_format: str or tuple of 2 str, optional
+        The strftime format of the dates in the csv files (e.g. '%Y-%m-%d %H:%M:%S'), or a tuple with
+        the format of the simulated file and the format of the observed file. If given, the files
+        are read with a faster path: the values are read directly as floats with the C csv engine
+        and the dates are parsed a single time with the given format instead of inferring it. Dates
+        that do not match the format become NaT. Only used with sim_fpath and obs_fpath when julian
+        is False.
+
     Notes
     -----
-    The only acceptable time frequencies in the data are 15min, 30min, 45min, and any number of hours or
-    days in between.
+    When interpolating, the selected time series is interpolated directly to the times of the other
+    time series that fall within its span, so the times of the data do not need to be on a regular
+    grid (e.g. multiples of 15 minutes).
 
     There are three scenarios to consider when merging your data:
 
@@ -228,7 +239,14 @@ def merge_data(sim_fpath=None, obs_fpath=None, sim_df=None, obs_df=None, interpo
 
     """
     # Reading the data into dataframes if from file
-    if sim_fpath is not None and obs_fpath is not None:
+    if sim_fpath is not None and obs_fpath is not None and date_format is not None and not julian:
+        # Reading the data with a known schema
+        if isinstance(date_format, str):
+            date_format = (date_format, date_format)
+        sim_df_copy = _read_timeseries_csv(sim_fpath, column_names[0], date_format[0])
+        obs_df_copy = _read_timeseries_csv(obs_fpath, column_names[1], date_format[1])
+
+    elif sim_fpath is not None and obs_fpath is not None:
         # Importing data into a data-frame
         sim_df_copy = pd.read_csv(sim_fpath, delimiter=",", header=None, names=[column_names[0]],
                                   index_col=0, infer_datetime_format=True, skiprows=1)
@@ -279,12 +297,12 @@ def merge_data(sim_fpath=None, obs_fpath=None, sim_df=None, obs_df=None, interpo
         # Scenario 2
 
         if interpolate == 'simulated':
-            # Resampling and interpolating the observed data to match
-            sim_df_copy = sim_df_copy.resample("15min").interpolate(interp_type)
+            # Interpolating the simulated data to the times of the observed data
+            sim_df_copy = _interpolate_to_index(sim_df_copy, obs_df_copy.index, interp_type)
 
         elif interpolate == 'observed':
-            # Resampling and interpolating the observed data to match
-            obs_df_copy = obs_df_copy.resample("15min").interpolate(interp_type)
+            # Interpolating the observed data to the times of the simulated data
+            obs_df_copy = _interpolate_to_index(obs_df_copy, sim_df_copy.index, interp_type)
 
         else:
             raise RuntimeError("The interpolate argument must be either 'simulated' or 'observed'.")
@@ -303,12 +321,12 @@ def merge_data(sim_fpath=None, obs_fpath=None, sim_df=None, obs_df=None, interpo
         obs_df_copy.index = obs_df_copy.index.tz_localize(observed_tz).tz_convert(return_tz)
 
         if interpolate == 'simulated':
-            # Resampling the simulated DataFrame to 15 minute time increments, then interpolating
-            sim_df_copy = sim_df_copy.resample("15min").interpolate(interp_type)
+            # Interpolating the simulated data to the times of the observed data
+            sim_df_copy = _interpolate_to_index(sim_df_copy, obs_df_copy.index, interp_type)
 
         elif interpolate == 'observed':
-            # Resampling the observed DataFrame to 15 minute time increments, then interpolating
-            obs_df_copy = obs_df_copy.resample("15min").interpolate(interp_type)
+            # Interpolating the observed data to the times of the simulated data
+            obs_df_copy = _interpolate_to_index(obs_df_copy, sim_df_copy.index, interp_type)
 
         else:
             raise RuntimeError("You must specify the interpolation argument to be either 'simulated' or "
@@ -321,6 +339,143 @@ def merge_data(sim_fpath=None, obs_fpath=None, sim_df=None, obs_df=None, interpo
         return merged_df
 
 
+def _interpolate_to_index(df, index, interp_type):
+    # Interpolates the values of a single column DataFrame to the times of another index, only within
+    # the span of the data (as a resample of the data followed by a join with the index would).
+    source = df.dropna().sort_index()
+    source = source[~source.index.duplicated()]
+    target = pd.DatetimeIndex(index)
+    if source.empty:
+        return pd.DataFrame(np.nan, index=target, columns=df.columns)
+
+    x = source.index.asi8
+    x_new = target.asi8
+    inside = (x_new >= x[0]) & (x_new <= x[-1])
+
+    if interp_type in ('linear', 'time'):
+        # Relative to the first time, so that the nanoseconds keep their precision as floats
+        values = np.interp((x_new - x[0]).astype(np.float64), (x - x[0]).astype(np.float64),
+                           source.iloc[:, 0].values.astype(np.float64))
+    else:
+        # The other methods interpolate along the values of the index, so only the times of the data
+        # and of the index are needed
+        union = source.index.union(target[inside])
+        values = source.reindex(union).interpolate(interp_type).reindex(target).iloc[:, 0].values
+
+    return pd.DataFrame(np.where(inside, values, np.nan), index=target, columns=df.columns)
+
+
+def merge_data_chunks(sim_fpath, obs_fpath, chunksize=100000, column_names=('Simulated', 'Observed'),
+                      date_format=None):
+    """Merges two csv files a chunk at a time, for files that are too large to read at once.
+
+    Both files are read in chunks of rows, and the chunks are lined up with a merge join on the
+    dates, so only about a chunk of each file is in memory at a time. The files must have the same
+    layout as in merge_data (dates in the left column, values in the right column and a header
+    row), and the dates in each file must be sorted. The merged chunks are the same rows as the
+    scenario 1 result of merge_data, split into consecutive pieces.
+
+    Parameters
+    ----------
+    sim_fpath: str
+        The filepath to the simulated csv of data.
+
+    obs_fpath: str
+        The filepath to the observed csv of data.
+
+    chunksize: int, optional
+        The number of rows that are read from each file at a time.
+
+    column_names: tuple of str
+        Tuple of length two containing the column names of the merged chunks, see merge_data.
+
+    date_format: str or tuple of 2 str, optional
+        The strftime format of the dates, or a tuple with the formats of the simulated and observed
+        files, see merge_data. If None, the format of the dates is inferred.
+
+    Returns
+    -------
+    generator of DataFrames
+        The merged chunks, in the order of the dates. Chunks without any matching dates are skipped.
+
+    Examples
+    --------
+    The chunks can be written to a file as they are merged, and the metrics can be computed a
+    chunk at a time with hydrostats.metrics.MetricAccumulator.
+
+    >>> import hydrostats.data as hd
+    >>> import hydrostats.metrics as hm
+    >>> accumulator = hm.MetricAccumulator(['ME', 'NSE', 'KGE (2012)'], abbr=True)
+    >>> for i, chunk in enumerate(hd.merge_data_chunks('sim_15min.csv', 'obs_15min.csv', chunksize=500000)):
+    ...     chunk.to_csv('merged.csv', mode='w' if i == 0 else 'a', header=i == 0)
+    ...     accumulator.update(chunk.iloc[:, 0].values, chunk.iloc[:, 1].values)
+    >>> accumulator.values()
+    """
+    if date_format is None or isinstance(date_format, str):
+        date_format = (date_format, date_format)
+    readers = [_read_timeseries_csv(sim_fpath, column_names[0], date_format[0], chunksize=chunksize),
+               _read_timeseries_csv(obs_fpath, column_names[1], date_format[1], chunksize=chunksize)]
+    buffers = [pd.DataFrame(columns=[column_names[0]], index=pd.DatetimeIndex([]), dtype=np.float64),
+               pd.DataFrame(columns=[column_names[1]], index=pd.DatetimeIndex([]), dtype=np.float64)]
+    done = [False, False]
+
+    while True:
+        # Reading the next chunk of each file that is not ahead of the other one
+        reading = [not done[i] and (buffers[i].empty or buffers[1 - i].empty or
+                                    buffers[i].index[-1] <= buffers[1 - i].index[-1]) for i in (0, 1)]
+        for i in (0, 1):
+            if not reading[i]:
+                continue
+            chunk = next(readers[i], None)
+            if chunk is None:
+                done[i] = True
+                continue
+            # Dates that could not be parsed never match
+            chunk = chunk[chunk.index.notna()]
+            if not chunk.index.is_monotonic_increasing or \
+                    (not buffers[i].empty and not chunk.empty and chunk.index[0] < buffers[i].index[-1]):
+                raise RuntimeError("The dates in {} are not sorted.".format((sim_fpath, obs_fpath)[i]))
+            else:
+                buffers[i] = pd.concat((buffers[i], chunk))
+
+        # All of the rows before the end of the files that are still being read are complete. The
+        # rows at the end are kept, as the next chunk can start with the same date.
+        if all(done):
+            cut = [buffer.shape[0] for buffer in buffers]
+        elif any(buffers[i].empty and not done[i] for i in (0, 1)):
+            continue
+        else:
+            boundary = min(buffers[i].index[-1] for i in (0, 1) if not done[i])
+            cut = [buffer.index.searchsorted(boundary, side='left') for buffer in buffers]
+
+        merged_df = pd.DataFrame.join(buffers[0].iloc[:cut[0]], buffers[1].iloc[:cut[1]], how='inner').dropna()
+        buffers = [buffers[0].iloc[cut[0]:], buffers[1].iloc[cut[1]:]]
+        if not merged_df.empty:
+            merged_df.columns = column_names
+            yield merged_df
+
+        if all(done) or any(done[i] and buffers[i].empty for i in (0, 1)):
+            return
+
+
+def _read_timeseries_csv(fpath, column_name, date_format, chunksize=None):
+    # Reads a csv of dates and values with a header row, parsing the dates once with a known (or
+    # inferred) format. With a chunksize, returns an iterator of the chunks instead.
+    reader = pd.read_csv(fpath, header=None, skiprows=1, usecols=[0, 1], names=['Datetime', column_name],
+                         dtype={'Datetime': str, column_name: np.float64}, engine='c', chunksize=chunksize)
+    if chunksize is None:
+        return _timeseries_frame(reader, column_name, date_format)
+    return (_timeseries_frame(chunk, column_name, date_format) for chunk in reader)
+
+
+def _timeseries_frame(df, column_name, date_format):
+    if date_format is None:
+        index = pd.to_datetime(df['Datetime'], infer_datetime_format=True, errors='coerce')
+    else:
+        index = pd.to_datetime(df['Datetime'], format=date_format, errors='coerce')
+    return pd.DataFrame({column_name: df[column_name].values}, index=pd.DatetimeIndex(index.values))
+
+
 def daily_average(df, rolling=False, **kwargs):
     """Calculates daily seasonal averages of the timeseries data in a DataFrame
 
@@ -713,7 +868,7 @@ def remove_nan_df(merged_dataframe):
     return merged_dataframe
 
 
-def seasonal_period(merged_dataframe, daily_period, time_range=None, numpy=False):
+def seasonal_period(merged_dataframe, daily_period, time_range=None, numpy=False, month_day_keys=None):
     """Creates a dataframe with a specified seasonal period
 
     Parameters
@@ -730,7 +885,14 @@ def seasonal_period(merged_dataframe, daily_period, time_range=None, numpy=False
         A tuple of string values representing the start and end dates of the time range. Format is YYYY-MM-DD.
 
     numpy: bool
-        If True, two numpy arrays will be returned instead of a pandas dataframe
+        If True, two numpy arrays will be returned instead of a pandas dataframe. When the selected
+        rows are contiguous (e.g. a single season selected with the time range) the arrays are views
+        of the dataframe columns, otherwise they only contain the selected values.
+
+    month_day_keys: 1D ndarray of int, optional
+        The month * 100 + day of each date in the index of the dataframe (e.g. 401 for April 1st).
+        Pass these when selecting several seasonal periods from the same dataframe so that they are
+        only computed once, see seasonal_mask.
 
     Returns
     -------
@@ -808,34 +970,87 @@ def seasonal_period(merged_dataframe, daily_period, time_range=None, numpy=False
     [62 rows x 2 columns]
 
     """
-    # Making a copy to avoid changing the original df
-    merged_df_copy = merged_dataframe.copy()
+    positions = np.flatnonzero(seasonal_mask(merged_dataframe, daily_period, time_range=time_range,
+                                             month_day_keys=month_day_keys))
+    if positions.size and positions[-1] - positions[0] + 1 == positions.size:
+        # Contiguous rows are selected with a slice so that the numpy arrays are views
+        positions = slice(positions[0], positions[-1] + 1)
 
-    if time_range:
-        # Setting the time range
-        merged_df_copy = merged_df_copy.loc[time_range[0]: time_range[1]]
+    if numpy:
+        return merged_dataframe.iloc[:, 0].values[positions], merged_dataframe.iloc[:, 1].values[positions]
+    else:
+        # Making a copy to avoid changing the original df
+        return merged_dataframe.iloc[positions].copy()
+
+
+def seasonal_mask(merged_dataframe, daily_period, time_range=None, month_day_keys=None):
+    """Creates a boolean mask of the rows of a dataframe that are in a seasonal period
+
+    Parameters
+    ----------
+
+    merged_dataframe: DataFrame
+        A pandas DataFrame with a datetime index.
+
+    daily_period: tuple of str
+        A list of length two with strings representing the start and end dates of the seasonal period (e.g.
+        (01-01, 01-31) for Jan 1 to Jan 31.
+
+    time_range: tuple of str
+        A tuple of string values representing the start and end dates of the time range. Format is YYYY-MM-DD.
+
+    month_day_keys: 1D ndarray of int, optional
+        The month * 100 + day of each date in the index of the dataframe (e.g. 401 for April 1st). If
+        not given they are computed from the index.
 
-    # Setting a placeholder for the datetime string values
-    merged_df_copy.insert(loc=0, column='placeholder', value=merged_df_copy.index.strftime('%m-%d'))
+    Returns
+    -------
+    1D ndarray of bool
+        True for each row of the dataframe that is part of the seasonal period, see seasonal_period.
+
+    Examples
+    --------
+    >>> import pandas as pd
+    >>> import numpy as np
+    >>> import hydrostats.data as hd
+    >>> example_df = pd.DataFrame(data=np.random.rand(6, 2), index=pd.date_range('2000-01-29', periods=6))
+    >>> hd.seasonal_mask(example_df, ('02-01', '02-28'))
+    array([False, False, False,  True,  True,  True])
+    """
+    # Integer month * 100 + day keys of the index, e.g. 401 for April 1st
+    if month_day_keys is None:
+        keys = _month_day_keys(merged_dataframe.index)
+    else:
+        keys = np.asarray(month_day_keys)
 
     # getting the start and end of the seasonal period
-    start = daily_period[0]
-    end = daily_period[1]
+    start = _month_day_key(daily_period[0])
+    end = _month_day_key(daily_period[1])
 
     # Getting the seasonal period
     if start < end:
-        merged_df_copy = merged_df_copy.loc[(merged_df_copy['placeholder'] >= start) &
-                                            (merged_df_copy['placeholder'] <= end)]
+        mask = (keys >= start) & (keys <= end)
     else:
-        merged_df_copy = merged_df_copy.loc[(merged_df_copy['placeholder'] >= start) |
-                                            (merged_df_copy['placeholder'] <= end)]
-    # Dropping the placeholder
-    merged_df_copy = merged_df_copy.drop(columns=['placeholder'])
+        mask = (keys >= start) | (keys <= end)
 
-    if numpy:
-        return merged_df_copy.iloc[:, 0].values, merged_df_copy.iloc[:, 1].values
-    else:
-        return merged_df_copy
+    if time_range:
+        # Setting the time range
+        in_range = np.zeros(mask.shape, dtype=bool)
+        in_range[merged_dataframe.index.slice_indexer(time_range[0], time_range[1])] = True
+        mask &= in_range
+
+    return mask
+
+
+def _month_day_keys(index):
+    # Integer month * 100 + day of each date in a datetime index
+    return np.asarray(index.month, dtype=np.int64) * 100 + np.asarray(index.day, dtype=np.int64)
+
+
+def _month_day_key(month_day):
+    # Integer key of a 'MM-DD' string
+    month, day = month_day.split('-')
+    return int(month) * 100 + int(day)
 
 
 if __name__ == "__main__":
@@ -8,11 +8,14 @@ warned which start dates have been removed in the warnings that display during t
 execution.
 """
 from __future__ import division
-from hydrostats.metrics import pearson_r
+from hydrostats.metrics import pearson_r, treatment_flags, _warn_treatment
+from hydrostats._lazy import LazyModule
 import numpy as np
-from numba import jit, prange
 import warnings
 
+# Compiled with numba, which is only imported when one of the kernels is used
+_kernels = LazyModule('hydrostats._kernels')
+
 __all__ = ["ens_me", "ens_mae", "ens_mse", "ens_rmse", "ens_pearson_r", "crps_hersbach",
            "crps_kernel", "ens_crps", "ens_brier", "auroc", "skill_score"]
 
@@ -472,44 +475,12 @@ def ens_crps(obs, fcst_ens, adj=np.nan, remove_neg=False, remove_zero=False, llv
     return output
 
 
-@jit(nopython=True, parallel=True)
 def numba_crps(ens, obs, rows, cols, col_len_array, sad_ens_half, sad_obs, crps, adj):
-    for i in prange(rows):
-        the_obs = obs[i]
-        the_ens = ens[i, :]
-        the_ens = np.sort(the_ens)
-        sum_xj = 0.
-        sum_jxj = 0.
-
-        j = 0
-        while j < cols:
-            sad_obs[i] += np.abs(the_ens[j] - the_obs)
-            sum_xj += the_ens[j]
-            sum_jxj += (j + 1) * the_ens[j]
-            j += 1
-
-        sad_ens_half[i] = 2.0 * sum_jxj - (col_len_array[i] + 1) * sum_xj
-
-    if np.isnan(adj):
-        for i in range(rows):
-            crps[i] = sad_obs[i] / col_len_array[i] - sad_ens_half[i] / \
-                      (col_len_array[i] * col_len_array[i])
-    elif adj > 1:
-        for i in range(rows):
-            crps[i] = sad_obs[i] / col_len_array[i] - sad_ens_half[i] / \
-                      (col_len_array[i] * (col_len_array[i] - 1)) * (1 - 1 / adj)
-    elif adj == 1:
-        for i in range(rows):
-            crps[i] = sad_obs[i] / col_len_array[i]
-    else:
-        for i in range(rows):
-            crps[i] = np.nan
-
-    return crps
+    return _kernels.numba_crps(ens, obs, rows, cols, col_len_array, sad_ens_half, sad_obs, crps, adj)
 
 
 def python_crps(ens, obs, rows, cols, col_len_array, sad_ens_half, sad_obs, crps, adj):
-    for i in prange(rows):
+    for i in range(rows):
         the_obs = obs[i]
         the_ens = ens[i, :]
         the_ens = np.sort(the_ens)
@@ -1155,54 +1126,8 @@ def auroc(fcst_ens=None, obs=None, threshold=None, ens_threshold=None, obs_thres
     return results
 
 
-@jit(nopython=True)
 def auroc_numba(fcst, obs):
-    num_start_dates = obs.size
-
-    i_ord = fcst.argsort()
-
-    sum_v = 0.
-    sum_v2 = 0.
-    sum_w = 0.
-    sum_w2 = 0.
-    n = 0
-    m = 0
-    i = 0
-
-    x = 1
-    y = 0
-
-    while True:
-        nn = mm = 0
-        while x > y:
-            j = i_ord[i]
-            if obs[j]:
-                mm += 1
-            else:
-                nn += 1
-            if i == num_start_dates - 1:
-                break
-            jp1 = i_ord[i + 1]
-            if fcst[j] != fcst[jp1]:
-                break
-            i += 1
-        sum_w += nn * (m + mm / 2.0)
-        sum_w2 += nn * (m + mm / 2.0) * (m + mm / 2.0)
-        sum_v += mm * (n + nn / 2.0)
-        sum_v2 += mm * (n + nn / 2.0) * (n + nn / 2.0)
-        n += nn
-        m += mm
-        i += 1
-        if i >= num_start_dates:
-            break
-
-    theta = sum_v / (m * n)
-    v = sum_v2 / ((m - 1) * n * n) - sum_v * sum_v / (m * (m - 1) * n * n)
-    w = sum_w2 / ((n - 1) * m * m) - sum_w * sum_w / (n * (n - 1) * m * m)
-
-    sd_auc = np.sqrt(v / m + w / n)
-
-    return np.array([theta, sd_auc])
+    return _kernels.auroc_numba(fcst, obs)
 
 
 def skill_score(scores, bench_scores, perf_score, eff_sample_size=None, remove_nan_inf=False):
@@ -1384,59 +1309,15 @@ def treat_data(obs, fcst_ens, remove_zero, remove_neg):
         warnings.warn("All zero values in either 'obs' or 'fcst', "
                       "function might run, but check if data OK.")
 
-    all_treatment_array = np.ones(obs.size, dtype=bool)
-
-    # Treat missing data in obs and fcst_ens, rows in fcst_ens or obs that contain nan values
-    if np.any(np.isnan(obs)) or np.any(np.isnan(fcst_ens)):
-        nan_indices_fcst = ~(np.any(np.isnan(fcst_ens), axis=1))
-        nan_indices_obs = ~np.isnan(obs)
-        all_nan_indices = np.logical_and(nan_indices_fcst, nan_indices_obs)
-        all_treatment_array = np.logical_and(all_treatment_array, all_nan_indices)
-
-        warnings.warn("Row(s) {} contained NaN values and the row(s) have been "
-                      "removed (zero indexed).".format(np.where(~all_nan_indices)[0]))
-
-    if np.any(np.isinf(obs)) or np.any(np.isinf(fcst_ens)):
-        inf_indices_fcst = ~(np.any(np.isinf(fcst_ens), axis=1))
-        inf_indices_obs = ~np.isinf(obs)
-        all_inf_indices = np.logical_and(inf_indices_fcst, inf_indices_obs)
-        all_treatment_array = np.logical_and(all_treatment_array, all_inf_indices)
-
-        warnings.warn("Row(s) {} contained Inf or -Inf values and the row(s) have been "
-                      "removed (zero indexed).".format(np.where(~all_inf_indices)[0]))
-
-    # Treat zero data in obs and fcst_ens, rows in fcst_ens or obs that contain zero values
-    if remove_zero:
-        if (obs == 0).any() or (fcst_ens == 0).any():
-            zero_indices_fcst = ~(np.any(fcst_ens == 0, axis=1))
-            zero_indices_obs = ~(obs == 0)
-            all_zero_indices = np.logical_and(zero_indices_fcst, zero_indices_obs)
-            all_treatment_array = np.logical_and(all_treatment_array, all_zero_indices)
-
-            warnings.warn("Row(s) {} contained zero values and the row(s) have been "
-                          "removed (zero indexed).".format(np.where(~all_zero_indices)[0]))
-
-    # Treat negative data in obs and fcst_ens, rows in fcst_ens or obs that contain negative values
-    # warnings.filterwarnings("ignore")  # Ignore Runtime warnings for comparison
-    if remove_neg:
-        with np.errstate(invalid='ignore'):
-            obs_bool = obs < 0
-            fcst_ens_bool = fcst_ens < 0
-        if obs_bool.any() or fcst_ens_bool.any():
-            neg_indices_fcst = ~(np.any(fcst_ens_bool, axis=1))
-            neg_indices_obs = ~obs_bool
-            all_neg_indices = np.logical_and(neg_indices_fcst, neg_indices_obs)
-            all_treatment_array = np.logical_and(all_treatment_array, all_neg_indices)
-
-            # warnings.filterwarnings("always")  # Turn warnings back on
-
-            warnings.warn("Row(s) {} contained negative values and the row(s) have been "
-                          "removed (zero indexed).".format(np.where(~all_neg_indices)[0]))
-        else:
-            pass  # warnings.filterwarnings("always")  # Turn warnings back on
-    else:
-        pass  # warnings.filterwarnings("always")  # Turn warnings back on
+    # Flagging the rows in fcst_ens or obs that contain NaN, Inf, zero or negative values in a single
+    # pass over the data
+    flags = treatment_flags(fcst_ens, obs, remove_zero=remove_zero, remove_neg=remove_neg)
+    if not flags.any():
+        return obs, fcst_ens
+
+    _warn_treatment(flags, remove_zero, remove_neg, label='zero indexed')
 
+    all_treatment_array = flags == 0
     obs = obs[all_treatment_array]
     fcst_ens = fcst_ens[all_treatment_array, :]
 
@@ -5,150 +5,2010 @@ The metrics module contains all of the metrics included in the HydroErr package.
 Each metric is contained in function, and every metric has the ability to treat missing values as
 well as remove zero and negative values from the timeseries data.
 """
+from __future__ import division
 from HydroErr import *
-from HydroErr.HydroErr import metric_names, metric_abbr, function_list
+from HydroErr.HydroErr import metric_names, metric_abbr, function_list, treat_values
+import HydroErr.HydroErr as _hydroerr
+import numpy as np
+from hydrostats._lazy import LazyModule
+import warnings
+import copy
+import hashlib
+import threading
+from collections import OrderedDict
 
+__all__ = list(_hydroerr.__all__) + ['metric_names', 'metric_abbr', 'function_list', 'list_of_metrics',
+                                     'batch_metrics', 'parameter_sweep', 'MetricPlan', 'MetricCache',
+                                     'MetricAccumulator', 'PairStatistics', 'BatchStatistics', 'treatment_mask',
+                                     'treatment_flags', 'treat_arrays']
 
-def list_of_metrics(metrics, sim_array, obs_array, abbr=False, mase_m=1, dmod_j=1,
-                    nse_mod_j=1, h6_mhe_k=1, h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None,
-                    lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1), kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None, remove_neg=False,
-                    remove_zero=False):
+# Compiled with numba, which is only imported when one of the kernels is used
+_kernels = LazyModule('hydrostats._kernels')
+
+
+# Bit flags given to each row by the data cleaning kernel
+_NAN_FLAG = 1
+_INF_FLAG = 2
+_ZERO_FLAG = 4
+_NEG_FLAG = 8
+
+# Smaller inputs are cleaned with numpy, which avoids importing numba and compiling the kernel for
+# the small arrays that most metric calls get
+_KERNEL_MIN_SIZE = 100000
+
+
+def _treatment_flags_numpy(array, flags, remove_zero, remove_neg):
+    # The same as hydrostats._kernels.treatment_flags with numpy reductions along the rows
+    checks = [(array != array, _NAN_FLAG), (np.abs(array) == np.inf, _INF_FLAG)]
+    if remove_zero:
+        checks.append((array == 0, _ZERO_FLAG))
+    if remove_neg:
+        checks.append((array < 0, _NEG_FLAG))
+    for found, flag in checks:
+        flags[np.any(found, axis=1)] |= flag
+    return flags
+
+
+def _as_rows(array):
+    # 2D view of the data with one row per time step, without copying numeric arrays
+    array = np.asarray(array)
+    if array.dtype.kind not in 'biuf':
+        array = array.astype(np.float64)
+    if array.ndim == 1:
+        array = array[:, np.newaxis]
+    return array
+
+
+def treatment_flags(sim_array, obs_array, remove_zero=False, remove_neg=False):
+    """Flag the rows of two arrays that contain NaN, Inf, zero or negative values.
+
+    Large arrays are scanned a single time by a compiled kernel, and small ones (less than
+    _KERNEL_MIN_SIZE values in all) with numpy. The arrays can be 1D (one value per
+    time step) or 2D (e.g. an ensemble forecast with one row per start date), and they must have the
+    same number of rows.
+
+    Parameters
+    ----------
+    sim_array: 1D or 2D ndarray
+        Array of simulated (or forecast) data.
+
+    obs_array: 1D or 2D ndarray
+        Array of observed data.
+
+    remove_zero: bool, optional
+        If True, rows containing a zero value are flagged.
+
+    remove_neg: bool, optional
+        If True, rows containing a negative value are flagged.
+
+    Returns
+    -------
+    1D ndarray of uint8
+        The flags of each row. Bit 1 is set for NaN values, bit 2 for Inf values, bit 4 for zero
+        values and bit 8 for negative values, so rows with a flag of zero are valid.
+    """
+    sim = _as_rows(sim_array)
+    obs = _as_rows(obs_array)
+    if sim.shape[0] != obs.shape[0]:
+        raise RuntimeError("The two ndarrays do not have the same number of rows.")
+    flags = np.zeros(sim.shape[0], dtype=np.uint8)
+    kernel = _kernels.treatment_flags if sim.size + obs.size >= _KERNEL_MIN_SIZE else _treatment_flags_numpy
+    kernel(sim, flags, remove_zero, remove_neg)
+    return kernel(obs, flags, remove_zero, remove_neg)
+
+
+def treatment_mask(sim_array, obs_array, remove_zero=False, remove_neg=False):
+    """Find the rows of two arrays that do not contain NaN, Inf, zero or negative values.
+
+    The mask can be used to index the arrays (e.g. sim_array[mask]) or passed to functions that take
+    a mask, such as batch_metrics. See treatment_flags for the description of the parameters.
+
+    Returns
+    -------
+    1D ndarray of bool
+        True for the rows that are kept and False for the rows that are removed.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> sim = np.array([5, np.nan, 9, 2, 4.5, 6.7])
+    >>> obs = np.array([4.7, 6, 10, 0, 4, np.inf])
+    >>> hm.treatment_mask(sim, obs, remove_zero=True)
+    array([ True, False,  True, False,  True, False])
+    """
+    return treatment_flags(sim_array, obs_array, remove_zero=remove_zero, remove_neg=remove_neg) == 0
+
+
+def _warn_treatment(flags, remove_zero, remove_neg, label='Rows are zero indexed'):
+    # Warns about the removed rows in the same way as HydroErr.treat_values
+    messages = [(_NAN_FLAG, True, "contained NaN values"),
+                (_INF_FLAG, True, "contained Inf or -Inf values"),
+                (_ZERO_FLAG, remove_zero, "contained zero values"),
+                (_NEG_FLAG, remove_neg, "contained negative values")]
+    for flag, enabled, message in messages:
+        if enabled:
+            rows = np.where(flags & flag)[0]
+            if rows.size:
+                warnings.warn("Row(s) {} {} and the row(s) have been removed ({}).".format(rows, message, label),
+                              UserWarning, stacklevel=3)
+
+
+def treat_arrays(sim_array, obs_array, replace_nan=None, replace_inf=None, remove_neg=False, remove_zero=False):
+    """Remove the NaN, Inf, zero and negative values from a pair of 1D arrays.
+
+    This gives the same result as HydroErr.treat_values. When no values are replaced, the rows to
+    remove are found with treatment_mask and the arrays are only copied if
+    there are rows to remove.
+
+    Returns
+    -------
+    tuple of 1D ndarrays
+        The treated simulated and observed arrays.
+    """
+    if replace_nan is not None or replace_inf is not None:
+        return treat_values(sim_array, obs_array, replace_nan=replace_nan, replace_inf=replace_inf,
+                            remove_neg=remove_neg, remove_zero=remove_zero)
+
+    sim = np.asarray(sim_array)
+    obs = np.asarray(obs_array)
+    if sim.ndim != 1:
+        raise ValueError("The simulated array is not one dimensional.")
+    if obs.ndim != 1:
+        raise ValueError("The observed array is not one dimensional.")
+    if sim.size != obs.size:
+        raise ValueError("The two ndarrays are not the same size.")
+
+    flags = treatment_flags(sim, obs, remove_zero=remove_zero, remove_neg=remove_neg)
+    if not flags.any():
+        return sim, obs
+
+    _warn_treatment(flags, remove_zero, remove_neg)
+    keep = flags == 0
+    return sim[keep], obs[keep]
+
+
+class PairStatistics(object):
+    """Shared intermediate statistics of a cleaned simulated and observed pair of arrays.
+
+    The simulated and observed arrays are cleaned a single time when the object is created. Each
+    intermediate statistic (residuals, sums of squares, cross products, means, anomalies, sorted
+    values, etc.) is computed the first time a metric needs it and is then reused by every other
+    metric, so that computing many metrics costs little more than computing the most expensive one.
+
+    Parameters
+    ----------
+    sim_array: 1D ndarray
+        Array of simulated data.
+
+    obs_array: 1D ndarray
+        Array of observed data.
+
+    replace_nan: float, optional
+        If given, indicates which value to replace NaN values with in the two arrays. If None, when
+        a NaN value is found at the i-th position in the observed OR simulated array, the i-th value
+        of the observed and simulated array are removed before the computation.
+
+    replace_inf: float, optional
+        If given, indicates which value to replace Inf values with in the two arrays. If None, when
+        an inf value is found at the i-th position in the observed OR simulated array, the i-th
+        value of the observed and simulated array are removed before the computation.
+
+    remove_neg: boolean, optional
+        If True, when a negative value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+
+    remove_zero: boolean, optional
+        If true, when a zero value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> sim = np.array([5, 7, 9, 2, 4.5, 6.7])
+    >>> obs = np.array([4.7, 6, 10, 2.5, 4, 6.8])
+    >>> stats = hm.PairStatistics(sim, obs)
+    >>> stats.compute(hm.nse)
+    0.923333988598388
+    >>> stats.compute(hm.dmod, j=2)
+    0.9789712067292139
+    """
+
+    def __init__(self, sim_array, obs_array, replace_nan=None, replace_inf=None, remove_neg=False,
+                 remove_zero=False):
+        sim, obs = treat_arrays(sim_array, obs_array, replace_nan=replace_nan, replace_inf=replace_inf,
+                                remove_neg=remove_neg, remove_zero=remove_zero)
+        self.sim = np.asarray(sim, dtype=np.float64)
+        self.obs = np.asarray(obs, dtype=np.float64)
+        self.n = self.sim.size
+        self._h6_cache = {}
+
+    def __getattr__(self, name):
+        # Only called for statistics that have not been computed yet
+        try:
+            statistic = _STATISTICS[name]
+        except KeyError:
+            raise AttributeError(name)
+        value = statistic(self)
+        setattr(self, name, value)
+        return value
+
+    # The reductions used by the metric derivations. They are the same numpy reductions that are
+    # used in HydroErr, so the derived metrics match the individual metric functions.
+    sum = staticmethod(np.sum)
+    mean = staticmethod(np.mean)
+    median = staticmethod(np.median)
+    percentile = staticmethod(np.percentile)
+    min = staticmethod(np.min)
+    max = staticmethod(np.max)
+    dot = staticmethod(np.dot)
+    norm = staticmethod(np.linalg.norm)
+    var = staticmethod(np.var)
+    std = staticmethod(np.std)
+
+    def h6(self, k):
+        """The H6 error array for the parameter k."""
+        if k not in self._h6_cache:
+            self._h6_cache[k] = (self.ratio - 1) / np.power(0.5 * (1 + np.power(self.ratio, k)), 1 / k)
+        return self._h6_cache[k]
+
+    def fallback(self, metric_func, **params):
+        """Compute a metric with the HydroErr function on the cleaned arrays."""
+        return metric_func(self.sim, self.obs, **params)
+
+    def compute(self, metric_func, **params):
+        """Compute a HydroErr metric from the shared statistics.
+
+        Parameters
+        ----------
+        metric_func: function
+            A metric function from the HydroErr package (e.g. hydrostats.metrics.nse).
+
+        params: optional
+            The parameters of the metric (e.g. j for the dmod function).
+
+        Returns
+        -------
+        float
+            The value of the metric.
+        """
+        derivation = _FUSED_METRICS.get(metric_func)
+        if derivation is None:
+            # Metrics that cannot be derived from the shared statistics use the cleaned arrays directly
+            return self.fallback(metric_func, **params)
+        return derivation(self, **params)
+
+
+class _SweepStatistics(PairStatistics):
+    # Reductions along the last axis, so that a column of parameter values gives one metric value
+    # per parameter value. On 1D arrays they are the same as the PairStatistics reductions.
+    sum = staticmethod(lambda x: np.sum(x, axis=-1))
+    mean = staticmethod(lambda x: np.mean(x, axis=-1))
+
+    def h6(self, k):
+        if np.ndim(k) == 0:
+            return PairStatistics.h6(self, k)
+        return (self.ratio - 1) / np.power(0.5 * (1 + np.power(self.ratio, k)), 1 / k)
+
+
+def _check_pair(sim_array, obs_array):
     if sim_array.ndim != 1 or obs_array.ndim != 1:
         raise RuntimeError("One or both of the ndarrays are not 1 dimensional.")
     if sim_array.size != obs_array.size:
         raise RuntimeError("The two ndarrays are not the same size.")
 
-    metrics_list = []
-
-    if not abbr:
-        for metric in metrics:
-            if metric == 'Mean Absolute Scaled Error':
-                metrics_list.append(mase(sim_array, obs_array, m=mase_m,
-                                         replace_nan=replace_nan, replace_inf=replace_inf,
-                                         remove_neg=remove_neg, remove_zero=remove_zero))
-
-            elif metric == 'Modified Index of Agreement':
-                metrics_list.append(dmod(sim_array, obs_array, j=dmod_j,
-                                         replace_nan=replace_nan, replace_inf=replace_inf,
-                                         remove_neg=remove_neg, remove_zero=remove_zero))
-
-            elif metric == 'Modified Nash-Sutcliffe Efficiency':
-                metrics_list.append(nse_mod(sim_array, obs_array, j=nse_mod_j,
-                                            replace_nan=replace_nan, replace_inf=replace_inf,
-                                            remove_neg=remove_neg, remove_zero=remove_zero))
-
-            elif metric == 'Legate-McCabe Efficiency Index':
-                metrics_list.append(lm_index(sim_array, obs_array, obs_bar_p=lm_x_obs_bar_p,
-                                             replace_nan=replace_nan, replace_inf=replace_inf,
-                                             remove_neg=remove_neg, remove_zero=remove_zero))
-
-            elif metric == 'Mean H6 Error':
-                metrics_list.append(h6_mhe(sim_array, obs_array, k=h6_mhe_k,
-                                           replace_nan=replace_nan, replace_inf=replace_inf,
-                                           remove_neg=remove_neg, remove_zero=remove_zero
-                                           ))
-
-            elif metric == 'Mean Absolute H6 Error':
-                metrics_list.append(h6_mahe(sim_array, obs_array, k=h6_ahe_k,
-                                            replace_nan=replace_nan, replace_inf=replace_inf,
-                                            remove_neg=remove_neg, remove_zero=remove_zero
-                                            ))
-
-            elif metric == 'Root Mean Square H6 Error':
-                metrics_list.append(h6_rmshe(sim_array, obs_array, k=h6_rmshe_k,
-                                             replace_nan=replace_nan, replace_inf=replace_inf,
-                                             remove_neg=remove_neg, remove_zero=remove_zero
-                                             ))
-
-            elif metric == 'Legate-McCabe Index of Agreement':
-                metrics_list.append(d1_p(sim_array, obs_array, obs_bar_p=d1_p_obs_bar_p,
-                                         replace_nan=replace_nan, replace_inf=replace_inf,
-                                         remove_neg=remove_neg, remove_zero=remove_zero
-                                         ))
-            elif metric == 'Kling-Gupta Efficiency (2009)':
-                metrics_list.append(kge_2009(sim_array, obs_array, s=kge2009_s,
-                                             replace_nan=replace_nan, replace_inf=replace_inf,
-                                             remove_neg=remove_neg, remove_zero=remove_zero
-                                             ))
-            elif metric == 'Kling-Gupta Efficiency (2012)':
-                metrics_list.append(kge_2012(sim_array, obs_array, s=kge2012_s,
-                                             replace_nan=replace_nan, replace_inf=replace_inf,
-                                             remove_neg=remove_neg, remove_zero=remove_zero
-                                             ))
+
+class BatchStatistics(PairStatistics):
+    """Shared intermediate statistics of many simulated and observed series at once.
+
+    The two 2D arrays have one series per row and one time step per column. Every row is cleaned
+    in a single vectorized pass, and the metrics are computed for all of the rows at once with
+    reductions along the time axis. Metrics that cannot be derived from the shared statistics are
+    computed row by row on the cleaned data.
+
+    Parameters
+    ----------
+    sim_array: 2D ndarray
+        Array of simulated data of dimension n_series x n_time.
+
+    obs_array: 1D or 2D ndarray
+        Array of observed data of dimension n_series x n_time, or a 1D array of length n_time with
+        the observed data of every series. When the 1D observed data is kept at the same time steps
+        in every series, the observed statistics are only computed once and shared by all of the
+        series.
+
+    mask: 2D ndarray of bool, optional
+        If given, only the values where the mask is True are used for each series. Must be the same
+        shape as the simulated array.
+
+    replace_nan: float, optional
+        If given, indicates which value to replace NaN values with in the two arrays. If None, when
+        a NaN value is found at the i-th position in the observed OR simulated array, the i-th value
+        of the observed and simulated array are removed before the computation.
+
+    replace_inf: float, optional
+        If given, indicates which value to replace Inf values with in the two arrays. If None, when
+        an inf value is found at the i-th position in the observed OR simulated array, the i-th
+        value of the observed and simulated array are removed before the computation.
+
+    remove_neg: boolean, optional
+        If True, when a negative value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+
+    remove_zero: boolean, optional
+        If true, when a zero value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+    """
+
+    def __init__(self, sim_array, obs_array, mask=None, replace_nan=None, replace_inf=None,
+                 remove_neg=False, remove_zero=False):
+        sim = np.array(sim_array, dtype=np.float64)
+        obs = np.array(obs_array, dtype=np.float64)
+
+        # A 1D observed array is shared by all of the series
+        shared = obs.ndim == 1
+        if sim.ndim != 2 or obs.ndim not in (1, 2):
+            raise RuntimeError("One or both of the ndarrays are not 2 dimensional.")
+        if obs.shape[-1] != sim.shape[1] or (not shared and sim.shape != obs.shape):
+            raise RuntimeError("The two ndarrays are not the same shape.")
+
+        valid = np.ones(sim.shape, dtype=bool) if mask is None else np.array(mask, dtype=bool)
+        if valid.shape != sim.shape:
+            raise RuntimeError("The mask is not the same shape as the ndarrays.")
+
+        for array in (sim, obs):
+            if replace_nan is not None:
+                array[np.isnan(array)] = replace_nan
+            if replace_inf is not None:
+                array[np.isinf(array)] = replace_inf
+
+        # Every time step of every series is a row for the cleaning kernel
+        if shared:
+            valid &= treatment_mask(sim.ravel(), sim.ravel(), remove_zero=remove_zero,
+                                    remove_neg=remove_neg).reshape(sim.shape)
+            valid &= treatment_mask(obs, obs, remove_zero=remove_zero, remove_neg=remove_neg)
+        else:
+            valid &= treatment_mask(sim.ravel(), obs.ravel(), remove_zero=remove_zero,
+                                    remove_neg=remove_neg).reshape(sim.shape)
+
+        if shared and sim.shape[0] and np.all(valid == valid[0]):
+            # The same time steps are kept in every series, so the observed data stays a single row
+            # and its statistics broadcast against the rows of the simulated data
+            if not valid[0].all():
+                sim = sim[:, valid[0]]
+                obs = obs[valid[0]]
+                valid = np.ones(sim.shape, dtype=bool)
+            obs = obs[np.newaxis, :]
+        elif shared:
+            obs = np.broadcast_to(obs, sim.shape)
+
+        # Moving the valid values of each series to the front of the row keeps the order of the time
+        # steps, so each row holds its cleaned series followed by padding.
+        if not valid.all():
+            order = np.argsort(~valid, axis=1, kind='mergesort')
+            valid = np.take_along_axis(valid, order, axis=1)
+            sim = np.where(valid, np.take_along_axis(sim, order, axis=1), 1.)
+            obs = np.where(valid, np.take_along_axis(obs, order, axis=1), 1.)
+        self.valid = valid
+        self.complete = bool(valid.all())
+        self.sim = sim
+        self.obs = obs
+        self.n = self.valid.sum(axis=1, keepdims=True)
+        self._h6_cache = {}
+
+    def _valid(self, x):
+        # Arrays built from lagged differences are shorter, their last element lines up with the
+        # last time step.
+        return self.valid[:, self.valid.shape[1] - x.shape[-1]:]
+
+    def _masked(self, x, fill):
+        if self.complete:
+            return x
+        return np.where(self._valid(x), x, fill)
+
+    def _count(self, x):
+        if self.complete:
+            # The same in every row, so that the statistics of a shared observed row stay one row
+            return x.shape[-1]
+        return self._valid(x).sum(axis=1, keepdims=True)
+
+    def sum(self, x):
+        return np.sum(self._masked(x, 0.), axis=1, keepdims=True)
+
+    def mean(self, x):
+        return self.sum(x) / self._count(x)
+
+    def percentile(self, x, q):
+        if self.complete:
+            return np.percentile(x, q, axis=1, keepdims=True)
+        # Linear interpolation between the closest ranks of the valid values, as in np.percentile
+        valid = self._valid(x)
+        count = self._count(x)
+        ordered = np.sort(np.where(valid, x, np.inf), axis=1)
+        position = q / 100 * np.maximum(count - 1, 0)
+        lower = np.floor(position).astype(int)
+        upper = np.minimum(lower + 1, np.maximum(count - 1, 0))
+        below = np.take_along_axis(ordered, lower, axis=1)
+        above = np.take_along_axis(ordered, upper, axis=1)
+        fraction = position - lower
+        result = np.where(fraction >= 0.5, above - (above - below) * (1 - fraction),
+                          below + (above - below) * fraction)
+        return np.where(np.any(valid & np.isnan(x), axis=1, keepdims=True), np.nan, result)
+
+    def median(self, x):
+        return self.percentile(x, 50)
+
+    def min(self, x):
+        return np.min(self._masked(x, np.inf), axis=1, keepdims=True)
+
+    def max(self, x):
+        return np.max(self._masked(x, -np.inf), axis=1, keepdims=True)
+
+    def dot(self, x, y):
+        return self.sum(x * y)
+
+    def norm(self, x):
+        return np.sqrt(self.sum(x * x))
+
+    def var(self, x):
+        return self.mean((x - self.mean(x)) ** 2)
+
+    def std(self, x, ddof=0):
+        return np.sqrt(self.sum((x - self.mean(x)) ** 2) / (self._count(x) - ddof))
+
+    def row(self, i):
+        """The cleaned simulated and observed arrays of the i-th series."""
+        n = self.n[i, 0]
+        return self.sim[i, :n], self.obs[min(i, self.obs.shape[0] - 1), :n]
+
+    def fallback(self, metric_func, **params):
+        result = np.full((self.sim.shape[0], 1), np.nan)
+        for i in range(self.sim.shape[0]):
+            if self.n[i, 0]:
+                sim, obs = self.row(i)
+                result[i, 0] = PairStatistics(sim, obs).compute(metric_func, **params)
+        return result
+
+    def compute(self, metric_func, **params):
+        """Compute a HydroErr metric for every series.
+
+        Parameters
+        ----------
+        metric_func: function
+            A metric function from the HydroErr package (e.g. hydrostats.metrics.nse).
+
+        params: optional
+            The parameters of the metric (e.g. j for the dmod function).
+
+        Returns
+        -------
+        1D ndarray
+            The value of the metric for each series.
+        """
+        if metric_func in _ROW_WISE_METRICS:
+            result = self.fallback(metric_func, **params)
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result = PairStatistics.compute(self, metric_func, **params)
+        result = np.broadcast_to(result, self.n.shape).ravel()
+        # Series without any valid values do not have a metric value
+        return np.where(self.n[:, 0] > 0, result, np.nan)
+
+
+def _mb_r_total(stats):
+    # Sum of |sim_j - obs_i| over every i and j, computed from the sorted simulated values
+    sorted_sim = stats.sorted_sim
+    cumulative = np.concatenate(([0.], np.cumsum(sorted_sim)))
+    below = np.searchsorted(sorted_sim, stats.obs)
+    return np.sum(stats.obs * below - cumulative[below] + (cumulative[-1] - cumulative[below]) -
+                  stats.obs * (stats.n - below))
+
+
+# Intermediate statistics, computed lazily by PairStatistics. The expressions mirror the ones used in
+# HydroErr so that the fused metrics give the same values as the individual functions.
+_STATISTICS = {
+    'diff': lambda s: s.sim - s.obs,
+    'abs_diff': lambda s: np.abs(s.diff),
+    'sq_diff': lambda s: s.diff ** 2,
+    'sae': lambda s: s.sum(s.abs_diff),
+    'sse': lambda s: s.sum(s.sq_diff),
+    'mse': lambda s: s.sse / s.n,
+    'rmse': lambda s: np.sqrt(s.mse),
+    'sim_mean': lambda s: s.mean(s.sim),
+    'obs_mean': lambda s: s.mean(s.obs),
+    'sim_anom': lambda s: s.sim - s.sim_mean,
+    'obs_anom': lambda s: s.obs - s.obs_mean,
+    'abs_obs_anom': lambda s: np.abs(s.obs_anom),
+    'ss_sim': lambda s: s.sum(s.sim_anom ** 2),
+    'ss_obs': lambda s: s.sum(s.obs_anom ** 2),
+    'sp': lambda s: s.sum(s.obs_anom * s.sim_anom),
+    'sim_sd': lambda s: np.sqrt(s.ss_sim / (s.n - 1)),
+    'obs_sd': lambda s: np.sqrt(s.ss_obs / (s.n - 1)),
+    'sim_sd_pop': lambda s: np.sqrt(s.ss_sim / s.n),
+    'obs_sd_pop': lambda s: np.sqrt(s.ss_obs / s.n),
+    'pearson': lambda s: s.sp / (np.sqrt(s.ss_obs) * np.sqrt(s.ss_sim)),
+    'agree_denom': lambda s: np.abs(s.sim - s.obs_mean) + s.abs_obs_anom,
+    'rel': lambda s: s.diff / s.obs,
+    'abs_rel': lambda s: np.abs(s.rel),
+    'ratio': lambda s: s.sim / s.obs,
+    'log_diff': lambda s: np.log1p(s.sim) - np.log1p(s.obs),
+    'norm_diff': lambda s: s.obs / s.obs_mean - s.sim / s.sim_mean,
+    'obs_grad': lambda s: s.obs[..., 1:] - s.obs[..., :s.obs.shape[-1] - 1],
+    'sorted_sim': lambda s: np.sort(s.sim),
+    'h1': lambda s: s.rel,
+    'h2': lambda s: s.diff / s.sim,
+    'h3': lambda s: s.diff / (0.5 * (s.sim + s.obs)),
+    'h4': lambda s: s.diff / np.sqrt(s.sim * s.obs),
+    'h5': lambda s: s.diff / np.reciprocal(0.5 * (np.reciprocal(s.obs) + np.reciprocal(s.sim))),
+    'h7': lambda s: (s.ratio - 1) / s.min(s.ratio),
+    'h8': lambda s: (s.ratio - 1) / s.max(s.ratio),
+    'h10': lambda s: s.log_diff,
+}
+
+
+def _kge_2009(stats, s=(1, 1, 1)):
+    if np.any((stats.obs_mean == 0) | (stats.obs_sd == 0)):
+        # Let HydroErr warn the user about the undefined value
+        return stats.fallback(kge_2009, s=s)
+    pr = stats.pearson
+    alpha = stats.sim_sd / stats.obs_sd
+    beta = stats.sim_mean / stats.obs_mean
+    return 1 - np.sqrt((s[0] * (pr - 1)) ** 2 + (s[1] * (alpha - 1)) ** 2 + (s[2] * (beta - 1)) ** 2)
+
+
+def _kge_2012(stats, s=(1, 1, 1)):
+    if np.any((stats.obs_mean == 0) | (stats.obs_sd_pop == 0) | (stats.sim_mean == 0)):
+        # Let HydroErr warn the user about the undefined value
+        return stats.fallback(kge_2012, s=s)
+    pr = stats.pearson
+    beta = stats.sim_mean / stats.obs_mean
+    gam = (stats.sim_sd_pop / stats.sim_mean) / (stats.obs_sd_pop / stats.obs_mean)
+    return 1 - np.sqrt((s[0] * (pr - 1)) ** 2 + (s[1] * (gam - 1)) ** 2 + (s[2] * (beta - 1)) ** 2)
+
+
+def _dr(stats):
+    a = stats.sae
+    b = 2 * stats.sum(stats.abs_obs_anom)
+    if np.ndim(a) == 0:
+        if a <= b:
+            return 1 - (a / b)
+        return (b / a) - 1
+    return np.where(a <= b, 1 - (a / b), (b / a) - 1)
+
+
+def _lm_index(stats, obs_bar_p=None):
+    if obs_bar_p is not None:
+        return 1 - (stats.sae / stats.sum(np.abs(stats.obs - obs_bar_p)))
+    return 1 - (stats.sae / stats.sum(stats.abs_obs_anom))
+
+
+def _d1_p(stats, obs_bar_p=None):
+    if obs_bar_p is not None:
+        b = np.abs(stats.sim - obs_bar_p) + np.abs(stats.obs - obs_bar_p)
+        return 1 - (stats.sae / stats.sum(b))
+    return 1 - (stats.sae / stats.sum(stats.agree_denom))
+
+
+def _mase(stats, m=1):
+    end = stats.obs.shape[-1] - m
+    b = np.abs(stats.obs[..., m:] - stats.obs[..., :end])
+    return (stats.sae / stats.n) / (stats.sum(b) / (stats.n - m))
+
+
+def _h_mean(h):
+    return lambda s: s.mean(getattr(s, h))
+
+
+def _h_abs_mean(h):
+    return lambda s: s.mean(np.abs(getattr(s, h)))
+
+
+def _h_rms(h):
+    return lambda s: np.sqrt(s.mean(getattr(s, h) ** 2))
+
+
+# Metrics that can be derived from the shared statistics. All other metrics are computed by calling
+# the HydroErr function on the cleaned arrays.
+_FUSED_METRICS = {
+    me: lambda s: s.mean(s.diff),
+    mae: lambda s: s.sae / s.n,
+    mse: lambda s: s.mse,
+    mle: lambda s: s.mean(s.log_diff),
+    male: lambda s: s.mean(np.abs(s.log_diff)),
+    msle: lambda s: s.mean(s.log_diff ** 2),
+    mde: lambda s: s.median(s.diff),
+    mdae: lambda s: s.median(s.abs_diff),
+    mdse: lambda s: s.median(s.sq_diff),
+    ed: lambda s: s.norm(s.diff),
+    ned: lambda s: s.norm(s.norm_diff),
+    rmse: lambda s: s.rmse,
+    rmsle: lambda s: np.sqrt(s.mean(s.log_diff ** 2)),
+    nrmse_range: lambda s: s.rmse / (s.max(s.obs) - s.min(s.obs)),
+    nrmse_mean: lambda s: s.rmse / s.obs_mean,
+    nrmse_iqr: lambda s: s.rmse / (s.percentile(s.obs, 75) - s.percentile(s.obs, 25)),
+    irmse: lambda s: s.rmse / s.std(s.obs_grad, ddof=1),
+    mase: _mase,
+    r_squared: lambda s: s.sp ** 2 / (s.ss_obs * s.ss_sim),
+    pearson_r: lambda s: s.pearson,
+    acc: lambda s: s.dot(s.sim_anom, s.obs_anom / (s.obs_sd * s.sim_sd * s.n)),
+    mape: lambda s: (100 / s.n) * s.sum(s.abs_rel),
+    mapd: lambda s: s.sae / s.sum(np.abs(s.obs)),
+    maape: lambda s: s.mean(np.arctan(s.abs_rel)),
+    smape1: lambda s: (100 / s.n) * s.sum(s.abs_diff / (np.abs(s.sim) + np.abs(s.obs))),
+    smape2: lambda s: (100 / s.n) * s.sum(np.abs(s.h3)),
+    d: lambda s: 1 - (s.sse / s.sum(s.agree_denom ** 2)),
+    d1: lambda s: 1 - s.sae / s.sum(s.agree_denom),
+    dmod: lambda s, j=1: 1 - (s.sum(s.abs_diff ** j) / s.sum(s.agree_denom ** j)),
+    drel: lambda s: 1 - (s.sum(s.rel ** 2) / s.sum((s.agree_denom / s.obs_mean) ** 2)),
+    dr: _dr,
+    watt_m: lambda s: (2 / np.pi) * np.arcsin(
+        1 - (s.mse / (s.obs_sd ** 2 + s.sim_sd ** 2 + (s.sim_mean - s.obs_mean) ** 2))),
+    mb_r: lambda s: 1 - ((s.n ** 2) * (s.sae / s.n) / _mb_r_total(s)),
+    nse: lambda s: 1 - (s.sse / s.ss_obs),
+    nse_mod: lambda s, j=1: 1 - (s.sum(s.abs_diff ** j) / s.sum(s.abs_obs_anom ** j)),
+    nse_rel: lambda s: 1 - (s.sum(s.rel ** 2) / s.sum((s.obs_anom / s.obs_mean) ** 2)),
+    kge_2009: _kge_2009,
+    kge_2012: _kge_2012,
+    lm_index: _lm_index,
+    d1_p: _d1_p,
+    ve: lambda s: 1 - (s.sae / s.sum(s.obs)),
+    sa: lambda s: np.arccos(s.dot(s.sim, s.obs) / (s.norm(s.sim) * s.norm(s.obs))),
+    sc: lambda s: np.arccos(s.dot(s.obs_anom, s.sim_anom) / (s.norm(s.obs_anom) * s.norm(s.sim_anom))),
+    sid: lambda s: s.dot(s.norm_diff, (np.log10(s.obs) - np.log10(s.obs_mean)) -
+                         (np.log10(s.sim) - np.log10(s.sim_mean))),
+    h6_mhe: lambda s, k=1: s.mean(s.h6(k)),
+    h6_mahe: lambda s, k=1: s.mean(np.abs(s.h6(k))),
+    h6_rmshe: lambda s, k=1: np.sqrt(s.mean(s.h6(k) ** 2)),
+    mean_var: lambda s: s.var(s.log_diff),
+}
+
+for _h in ('h1', 'h2', 'h3', 'h4', 'h5', 'h7', 'h8', 'h10'):
+    _FUSED_METRICS[globals()[_h + '_mhe']] = _h_mean(_h)
+    _FUSED_METRICS[globals()[_h + '_mahe']] = _h_abs_mean(_h)
+    _FUSED_METRICS[globals()[_h + '_rmshe']] = _h_rms(_h)
+
+# Metrics that need the sorted order of each series, these are computed one series at a time when
+# many series are evaluated together.
+_ROW_WISE_METRICS = {mb_r}
+
+
+# Lookup tables from the metric names and abbreviations to the metric functions, built once when the
+# module is imported. 'H6 (AHE)' is kept as an alias of 'H6 (MAHE)' for backwards compatibility.
+_METRICS_BY_NAME = dict(zip(metric_names, function_list))
+_METRICS_BY_ABBR = dict(zip(metric_abbr, function_list))
+_METRICS_BY_ABBR['H6 (AHE)'] = h6_mahe
+
+# The metrics that take a parameter, with the name of the parameter in the metric function and the
+# keyword that sets it in list_of_metrics and MetricPlan
+_METRIC_PARAMETERS = {
+    mase: ('m', 'mase_m'),
+    dmod: ('j', 'dmod_j'),
+    nse_mod: ('j', 'nse_mod_j'),
+    lm_index: ('obs_bar_p', 'lm_x_obs_bar_p'),
+    h6_mhe: ('k', 'h6_mhe_k'),
+    h6_mahe: ('k', 'h6_ahe_k'),
+    h6_rmshe: ('k', 'h6_rmshe_k'),
+    d1_p: ('obs_bar_p', 'd1_p_obs_bar_p'),
+    kge_2009: ('s', 'kge2009_s'),
+    kge_2012: ('s', 'kge2012_s'),
+}
+
+
+def _freeze(value):
+    # Hashable representation of the metric parameters and cleaning options. NaN does not compare
+    # equal to itself, so the values are compared by their repr.
+    if isinstance(value, dict):
+        return tuple((key, _freeze(value[key])) for key in sorted(value))
+    if value is None or isinstance(value, bool):
+        return value
+    return repr(np.asarray(value, dtype=np.float64).tolist())
+
+
+class MetricPlan(object):
+    """A list of metrics resolved once so that it can be computed on many pairs of arrays.
+
+    The metric names (or abbreviations) are looked up a single time when the plan is created and the
+    metric parameters are bound to each metric function. Running the plan then only cleans the data
+    and computes the metrics, which makes it well suited for computing the same metrics many times,
+    e.g. for each seasonal period in a table or for each lag in a time lag analysis.
+
+    Parameters
+    ----------
+    metrics: list of str
+        The names (or abbreviations if abbr is True) of the metrics to compute.
+
+    abbr: bool, optional
+        If True, the metrics are given as abbreviations instead of full names.
+
+    mase_m, dmod_j, nse_mod_j, h6_mhe_k, h6_ahe_k, h6_rmshe_k, d1_p_obs_bar_p, lm_x_obs_bar_p, kge2009_s, kge2012_s
+        The metric parameters, see list_of_metrics.
+
+    replace_nan, replace_inf, remove_neg, remove_zero
+        The data cleaning options that are applied every time the plan is run, see list_of_metrics.
+
+    Raises
+    ------
+    ValueError
+        If one of the metrics is not a known metric name or abbreviation.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> sim = np.array([5, 7, 9, 2, 4.5, 6.7])
+    >>> obs = np.array([4.7, 6, 10, 2.5, 4, 6.8])
+    >>> plan = hm.MetricPlan(['ME', 'NSE', 'd (Mod.)'], abbr=True, dmod_j=2)
+    >>> plan.run(sim, obs)
+    [0.03333333333333336, 0.923333988598388, 0.9789712067292139]
+    """
+
+    def __init__(self, metrics, abbr=False, mase_m=1, dmod_j=1, nse_mod_j=1, h6_mhe_k=1, h6_ahe_k=1,
+                 h6_rmshe_k=1, d1_p_obs_bar_p=None, lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1),
+                 kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None, remove_neg=False, remove_zero=False):
+        parameters = {'mase_m': mase_m, 'dmod_j': dmod_j, 'nse_mod_j': nse_mod_j, 'h6_mhe_k': h6_mhe_k,
+                      'h6_ahe_k': h6_ahe_k, 'h6_rmshe_k': h6_rmshe_k, 'd1_p_obs_bar_p': d1_p_obs_bar_p,
+                      'lm_x_obs_bar_p': lm_x_obs_bar_p, 'kge2009_s': kge2009_s, 'kge2012_s': kge2012_s}
+        lookup = _METRICS_BY_ABBR if abbr else _METRICS_BY_NAME
+
+        self.metrics = list(metrics)
+        self.functions = []
+        for metric in self.metrics:
+            try:
+                metric_func = lookup[metric]
+            except (KeyError, TypeError):
+                raise ValueError("{!r} is not a valid metric {}.".format(metric, 'abbreviation' if abbr else 'name'))
+
+            params = {}
+            if metric_func in _METRIC_PARAMETERS:
+                argument, keyword = _METRIC_PARAMETERS[metric_func]
+                params[argument] = parameters[keyword]
+            self.functions.append((metric_func, params))
+
+        self.cleaning = {'replace_nan': replace_nan, 'replace_inf': replace_inf, 'remove_neg': remove_neg,
+                         'remove_zero': remove_zero}
+
+        # Identifies the metrics, their parameters and the cleaning options, e.g. for MetricCache
+        self.key = (tuple((metric_func.__name__, _freeze(params)) for metric_func, params in self.functions),
+                    _freeze(self.cleaning))
+
+    def __len__(self):
+        return len(self.functions)
+
+    def statistics(self, sim_array, obs_array):
+        """Clean a pair of 1D arrays with the cleaning options of the plan and return their PairStatistics."""
+        _check_pair(sim_array, obs_array)
+        return PairStatistics(sim_array, obs_array, **self.cleaning)
+
+    def run(self, sim_array, obs_array, out=None):
+        """Compute the metrics of the plan for a pair of 1D arrays and return them as a list.
+
+        If out is given, the values are written into it instead and out is returned, so that many
+        results can be stored in one preallocated array without building intermediate lists. See
+        out_indices for the accepted buffers.
+        """
+        stats = self.statistics(sim_array, obs_array)
+        if out is None:
+            return [stats.compute(metric_func, **params) for metric_func, params in self.functions]
+
+        for index, (metric_func, params) in zip(self.out_indices(out), self.functions):
+            out[index] = stats.compute(metric_func, **params)
+        return out
+
+    def out_indices(self, out):
+        """Return the index of each metric of the plan in an output buffer given to run.
+
+        The buffer is either a float array with one value per metric, or a structured array (or a
+        record of one) with a field named after each metric.
+        """
+        names = out.dtype.names
+        if names is None:
+            if np.shape(out) != (len(self.functions),):
+                raise ValueError("The output array must have the shape ({},), one value per metric."
+                                 .format(len(self.functions)))
+            return range(len(self.functions))
+
+        missing = [metric for metric in self.metrics if metric not in names]
+        if missing:
+            raise ValueError("The output array does not have a field for the metrics {}.".format(missing))
+        return self.metrics
+
+    def sweep(self, sim_array, obs_array):
+        """Compute the metrics of the plan for a pair of 1D arrays, over grids of parameter values.
+
+        The parameters of the plan can be given as sequences of values (as a 2D array of shape
+        n_values x 3 for kge2009_s and kge2012_s). The data is cleaned once and the intermediate
+        statistics are shared between all of the metrics and parameter values, and the parameter
+        values of each metric are evaluated together with broadcasted reductions. See
+        parameter_sweep.
+        """
+        _check_pair(sim_array, obs_array)
+        stats = _SweepStatistics(sim_array, obs_array, **self.cleaning)
+
+        results = []
+        for metric_func, params in self.functions:
+            if not params:
+                results.append(stats.compute(metric_func))
+                continue
+
+            (name, value), = params.items()
+            grid = np.asarray(value, dtype=np.float64) if value is not None else None
+            if grid is None or grid.ndim == (1 if name == 's' else 0):
+                results.append(stats.compute(metric_func, **params))
+            elif name == 's':
+                # The weights of each component are rows of the transposed grid, so they broadcast
+                results.append(np.broadcast_to(stats.compute(metric_func, s=grid.T), grid.shape[:1]).copy())
+            elif name == 'm':
+                # The lagged differences have a different length for each value of m
+                results.append(np.array([stats.compute(metric_func, m=int(m)) for m in grid]))
             else:
-                index = metric_names.index(metric)
-                metric_func = function_list[index]
-                metrics_list.append(metric_func(sim_array, obs_array, replace_nan=replace_nan,
-                                                replace_inf=replace_inf, remove_neg=remove_neg,
-                                                remove_zero=remove_zero))
-
-    else:
-        for metric in metrics:
-            if metric == 'MASE':
-                metrics_list.append(mase(sim_array, obs_array, m=mase_m,
-                                         replace_nan=replace_nan, replace_inf=replace_inf,
-                                         remove_neg=remove_neg, remove_zero=remove_zero))
-
-            elif metric == 'd (Mod.)':
-                metrics_list.append(dmod(sim_array, obs_array, j=dmod_j,
-                                         replace_nan=replace_nan, replace_inf=replace_inf,
-                                         remove_neg=remove_neg, remove_zero=remove_zero))
-
-            elif metric == 'NSE (Mod.)':
-                metrics_list.append(nse_mod(sim_array, obs_array, j=nse_mod_j,
-                                            replace_nan=replace_nan,
-                                            replace_inf=replace_inf,
-                                            remove_neg=remove_neg, remove_zero=remove_zero))
-
-            elif metric == "E1'":
-                metrics_list.append(lm_index(sim_array, obs_array, obs_bar_p=lm_x_obs_bar_p,
-                                             replace_nan=replace_nan,
-                                             replace_inf=replace_inf,
-                                             remove_neg=remove_neg,
-                                             remove_zero=remove_zero))
-
-            elif metric == 'H6 (MHE)':
-                metrics_list.append(h6_mhe(sim_array, obs_array, k=h6_mhe_k,
-                                           replace_nan=replace_nan, replace_inf=replace_inf,
-                                           remove_neg=remove_neg, remove_zero=remove_zero
-                                           ))
-
-            elif metric == 'H6 (AHE)':
-                metrics_list.append(h6_mahe(sim_array, obs_array, k=h6_ahe_k,
-                                            replace_nan=replace_nan, replace_inf=replace_inf,
-                                            remove_neg=remove_neg, remove_zero=remove_zero
-                                            ))
-
-            elif metric == 'H6 (RMSHE)':
-                metrics_list.append(h6_rmshe(sim_array, obs_array, k=h6_rmshe_k,
-                                             replace_nan=replace_nan,
-                                             replace_inf=replace_inf,
-                                             remove_neg=remove_neg, remove_zero=remove_zero
-                                             ))
-
-            elif metric == "D1'":
-                metrics_list.append(d1_p(sim_array, obs_array, obs_bar_p=d1_p_obs_bar_p,
-                                         replace_nan=replace_nan, replace_inf=replace_inf,
-                                         remove_neg=remove_neg, remove_zero=remove_zero
-                                         ))
-            elif metric == 'KGE (2009)':
-                metrics_list.append(kge_2009(sim_array, obs_array, s=kge2009_s,
-                                             replace_nan=replace_nan, replace_inf=replace_inf,
-                                             remove_neg=remove_neg, remove_zero=remove_zero
-                                             ))
-            elif metric == 'KGE (2012)':
-                metrics_list.append(kge_2012(sim_array, obs_array, s=kge2012_s,
-                                             replace_nan=replace_nan, replace_inf=replace_inf,
-                                             remove_neg=remove_neg, remove_zero=remove_zero
-                                             ))
+                results.append(stats.compute(metric_func, **{name: grid[:, np.newaxis]}))
+
+        return results
+
+    def run_batch(self, sim_array, obs_array, mask=None):
+        """Compute the metrics of the plan for each row of two 2D arrays, see batch_metrics."""
+        stats = BatchStatistics(sim_array, obs_array, mask=mask, **self.cleaning)
+
+        results = np.empty((stats.sim.shape[0], len(self.functions)))
+        for i, (metric_func, params) in enumerate(self.functions):
+            results[:, i] = stats.compute(metric_func, **params)
+
+        return results
+
+    def run_groups(self, sim_array, obs_array, membership):
+        """Compute the metrics of the plan for groups of the time steps of a pair of 1D arrays.
+
+        Each row of the 2D boolean membership array selects the time steps of one group (e.g. the
+        full time series and each seasonal period of a table), and the groups can overlap. The
+        arrays are cleaned a single time. The metrics that only need sums over the pairs (see
+        MetricAccumulator) are computed for every group from one matrix product of the membership
+        with the elementwise terms. The median, rank and order based metrics are computed from the
+        values of each group. Returns a 2D array of dimension n_groups x n_metrics.
+        """
+        _check_pair(sim_array, obs_array)
+        membership = np.asarray(membership, dtype=bool)
+        sim = np.asarray(sim_array, dtype=np.float64)
+        obs = np.asarray(obs_array, dtype=np.float64)
+        if self.cleaning['replace_nan'] is not None or self.cleaning['replace_inf'] is not None:
+            sim = sim.copy()
+            obs = obs.copy()
+            for array in (sim, obs):
+                if self.cleaning['replace_nan'] is not None:
+                    array[np.isnan(array)] = self.cleaning['replace_nan']
+                if self.cleaning['replace_inf'] is not None:
+                    array[np.isinf(array)] = self.cleaning['replace_inf']
+        flags = treatment_flags(sim, obs, remove_zero=self.cleaning['remove_zero'],
+                                remove_neg=self.cleaning['remove_neg'])
+        if flags.any():
+            _warn_treatment(flags, self.cleaning['remove_zero'], self.cleaning['remove_neg'])
+            keep = flags == 0
+            sim, obs, membership = sim[keep], obs[keep], membership[:, keep]
+        stats = PairStatistics(sim, obs)
+
+        results = np.empty((membership.shape[0], len(self.functions)))
+        summed = [i for i, (metric_func, params) in enumerate(self.functions)
+                  if metric_func in _STREAMING_METRICS and metric_func not in _ORDER_METRICS and
+                  params.get('obs_bar_p', 0) is not None]
+        if summed:
+            groups = _GroupStatistics.from_membership(stats, membership,
+                                                      [self.functions[i] for i in summed])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for i in summed:
+                    metric_func, params = self.functions[i]
+                    results[:, i] = [_STREAMING_METRICS[metric_func][1](group, **params) for group in groups]
+
+        others = [i for i in range(len(self.functions)) if i not in summed]
+        if others:
+            for row, selected in enumerate(membership):
+                group_stats = PairStatistics(sim[selected], obs[selected])
+                for i in others:
+                    metric_func, params = self.functions[i]
+                    results[row, i] = group_stats.compute(metric_func, **params)
+
+        return results
+
+
+def _content_hash(*arrays):
+    # Digest of the values, dtypes and shapes of the arrays
+    digest = hashlib.sha1()
+    for array in arrays:
+        array = np.asarray(array)
+        if array.dtype.kind not in 'biuf':
+            array = array.astype(np.float64)
+        array = np.ascontiguousarray(array)
+        digest.update('{}{}'.format(array.dtype.str, array.shape).encode())
+        digest.update(array.view(np.uint8) if array.size else b'')
+    return digest.hexdigest()
+
+
+class MetricCache(object):
+    """A size bounded, least recently used cache of metric results.
+
+    The results are keyed by a hash of the contents of the simulated and observed arrays, together
+    with the metrics, their parameters and the data cleaning options, so the same request on equal
+    data is only computed once even if the arrays are different objects. The cache can be given to
+    list_of_metrics and to hydrostats.analyze.make_table.
+
+    Parameters
+    ----------
+    maxsize: int, optional
+        The maximum number of results that are kept. When it is reached the least recently used
+        result is discarded.
+
+    Attributes
+    ----------
+    hits: int
+        The number of requests that were answered from the cache.
+
+    misses: int
+        The number of requests that had to be computed.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> sim = np.array([5, 7, 9, 2, 4.5, 6.7])
+    >>> obs = np.array([4.7, 6, 10, 2.5, 4, 6.8])
+    >>> cache = hm.MetricCache(maxsize=256)
+    >>> hm.list_of_metrics(['ME', 'NSE'], sim, obs, abbr=True, cache=cache)
+    [0.03333333333333336, 0.923333988598388]
+    >>> hm.list_of_metrics(['ME', 'NSE'], sim.copy(), obs.copy(), abbr=True, cache=cache)
+    [0.03333333333333336, 0.923333988598388]
+    >>> cache.hits, cache.misses
+    (1, 1)
+    >>> cache.invalidate(sim, obs)
+    1
+    """
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError("The maximum size of the cache must be at least 1.")
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._results)
+
+    def run(self, plan, sim_array, obs_array, out=None):
+        """Return the results of a MetricPlan for a pair of arrays, computing them if they are not cached.
+
+        If out is given, the values are written into it and out is returned, see MetricPlan.run.
+        """
+        key = (_content_hash(sim_array, obs_array), plan.key)
+        with self._lock:
+            values = self._results.pop(key, None)
+            if values is not None:
+                self._results[key] = values
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        if values is None:
+            values = plan.run(sim_array, obs_array)
+            with self._lock:
+                self._results[key] = values
+                while len(self._results) > self.maxsize:
+                    self._results.popitem(last=False)
+
+        if out is None:
+            return list(values)
+        for index, value in zip(plan.out_indices(out), values):
+            out[index] = value
+        return out
+
+    def invalidate(self, sim_array=None, obs_array=None):
+        """Discard the cached results of a pair of arrays, or all of the results if no arrays are given.
+
+        Returns the number of results that were discarded.
+        """
+        with self._lock:
+            if sim_array is None and obs_array is None:
+                removed = len(self._results)
+                self._results.clear()
+                return removed
+
+            data_hash = _content_hash(sim_array, obs_array)
+            stale = [key for key in self._results if key[0] == data_hash]
+            for key in stale:
+                del self._results[key]
+            return len(stale)
+
+    def clear(self):
+        """Discard all of the cached results and reset the hit and miss counters."""
+        with self._lock:
+            self._results.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """Return a dictionary with the hits, misses, maximum size and current size of the cache."""
+        return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.maxsize, 'currsize': len(self._results)}
+
+
+# Elementwise terms whose running sums are kept by MetricAccumulator. The terms in
+# _PARAMETRIC_TERMS depend on a metric parameter, and a separate sum is kept for each value.
+_RUNNING_TERMS = {
+    'diff': lambda s: s.diff,
+    'abs_diff': lambda s: s.abs_diff,
+    'sq_diff': lambda s: s.sq_diff,
+    'abs_log_diff': lambda s: np.abs(s.log_diff),
+    'sq_log_diff': lambda s: s.log_diff ** 2,
+    'abs_rel': lambda s: s.abs_rel,
+    'sq_rel': lambda s: s.rel ** 2,
+    'arctan_abs_rel': lambda s: np.arctan(s.abs_rel),
+    'smape1': lambda s: s.abs_diff / (np.abs(s.sim) + np.abs(s.obs)),
+    'abs_obs': lambda s: np.abs(s.obs),
+    'obs_log_ratio': lambda s: s.obs * (np.log10(s.obs) - np.log10(s.sim)),
+    'sim_log_ratio': lambda s: s.sim * (np.log10(s.obs) - np.log10(s.sim)),
+    'log_log1p_sim': lambda s: np.log(np.log1p(s.sim)),
+    'log_log1p_obs': lambda s: np.log(np.log1p(s.obs)),
+    'ratio_error': lambda s: s.ratio - 1,
+    'abs_ratio_error': lambda s: np.abs(s.ratio - 1),
+    'sq_ratio_error': lambda s: (s.ratio - 1) ** 2,
+    'h6': lambda s, k=1: s.h6(k),
+    'abs_h6': lambda s, k=1: np.abs(s.h6(k)),
+    'sq_h6': lambda s, k=1: s.h6(k) ** 2,
+    'lm_denom': lambda s, obs_bar_p=None: np.abs(s.obs - obs_bar_p),
+    'd1_p_denom': lambda s, obs_bar_p=None: np.abs(s.sim - obs_bar_p) + np.abs(s.obs - obs_bar_p),
+}
+_PARAMETRIC_TERMS = {'h6', 'abs_h6', 'sq_h6', 'lm_denom', 'd1_p_denom'}
+
+for _h in ('h1', 'h2', 'h3', 'h4', 'h5', 'h10'):
+    _RUNNING_TERMS[_h] = (lambda h: lambda s: getattr(s, h))(_h)
+    _RUNNING_TERMS['abs_' + _h] = (lambda h: lambda s: np.abs(getattr(s, h)))(_h)
+    _RUNNING_TERMS['sq_' + _h] = (lambda h: lambda s: getattr(s, h) ** 2)(_h)
+
+
+def _running_kge(a, s, variability, undefined):
+    # The statistics can also be arrays (e.g. one value per lag), then undefined is checked elementwise
+    if np.any(undefined):
+        warnings.warn("The observed mean, the observed standard deviation or the simulated mean is 0. "
+                      "Therefore the KGE value cannot be computed.")
+        if np.ndim(undefined) == 0:
+            return np.nan
+    with np.errstate(divide='ignore', invalid='ignore'):
+        beta = a.sim_mean / a.obs_mean
+        kge = 1 - np.sqrt((s[0] * (a.pearson - 1)) ** 2 + (s[1] * (variability - 1)) ** 2 +
+                          (s[2] * (beta - 1)) ** 2)
+    return np.where(undefined, np.nan, kge) if np.ndim(undefined) else kge
+
+
+def _running_mean(term):
+    return lambda a: a.term(term) / a.n
+
+
+def _running_rms(term):
+    return lambda a: np.sqrt(a.term(term) / a.n)
+
+
+def _running_sga(a):
+    obs_grad_mean, sim_grad_mean = a.grad_mean
+    dot = a.grad_comoment[0, 1] + a.n_grad * obs_grad_mean * sim_grad_mean
+    norm_obs = np.sqrt(a.grad_comoment[0, 0] + a.n_grad * obs_grad_mean ** 2)
+    norm_sim = np.sqrt(a.grad_comoment[1, 1] + a.n_grad * sim_grad_mean ** 2)
+    return np.arccos(dot / (norm_obs * norm_sim))
+
+
+# Metrics that can be computed from the running statistics of MetricAccumulator, with the terms
+# that they need the running sums of. The metrics that depend on the median, on percentiles, on the
+# ranks of the values or on absolute deviations from the final mean are not included.
+_STREAMING_METRICS = {
+    me: (('diff',), _running_mean('diff')),
+    mae: (('abs_diff',), lambda a: a.sae / a.n),
+    mse: (('sq_diff',), lambda a: a.mse),
+    mle: ((), lambda a: a.mean[2]),
+    male: (('abs_log_diff',), _running_mean('abs_log_diff')),
+    msle: (('sq_log_diff',), _running_mean('sq_log_diff')),
+    ed: (('sq_diff',), lambda a: np.sqrt(a.sse)),
+    ned: ((), lambda a: np.sqrt(np.maximum(
+        a.ss_obs / a.obs_mean ** 2 + a.ss_sim / a.sim_mean ** 2 - 2 * a.sp / (a.obs_mean * a.sim_mean), 0))),
+    rmse: (('sq_diff',), lambda a: a.rmse),
+    rmsle: (('sq_log_diff',), _running_rms('sq_log_diff')),
+    nrmse_range: (('sq_diff',), lambda a: a.rmse / (a.obs_max - a.obs_min)),
+    nrmse_mean: (('sq_diff',), lambda a: a.rmse / a.obs_mean),
+    irmse: (('sq_diff',), lambda a: a.rmse / np.sqrt(a.grad_comoment[0, 0] / (a.n_grad - 1))),
+    mase: (('abs_diff',), lambda a, m=1: (a.sae / a.n) / (a.lag_sum / (a.n - m))),
+    r_squared: ((), lambda a: a.sp ** 2 / (a.ss_obs * a.ss_sim)),
+    pearson_r: ((), lambda a: a.pearson),
+    acc: ((), lambda a: a.sp / (a.obs_sd * a.sim_sd * a.n)),
+    mape: (('abs_rel',), lambda a: (100 / a.n) * a.term('abs_rel')),
+    mapd: (('abs_diff', 'abs_obs'), lambda a: a.sae / a.term('abs_obs')),
+    maape: (('arctan_abs_rel',), _running_mean('arctan_abs_rel')),
+    smape1: (('smape1',), lambda a: (100 / a.n) * a.term('smape1')),
+    smape2: (('abs_h3',), lambda a: (100 / a.n) * a.term('abs_h3')),
+    watt_m: (('sq_diff',), lambda a: (2 / np.pi) * np.arcsin(
+        1 - (a.mse / (a.obs_sd ** 2 + a.sim_sd ** 2 + (a.sim_mean - a.obs_mean) ** 2)))),
+    nse: (('sq_diff',), lambda a: 1 - (a.sse / a.ss_obs)),
+    nse_rel: (('sq_rel',), lambda a: 1 - (a.term('sq_rel') / (a.ss_obs / a.obs_mean ** 2))),
+    kge_2009: ((), lambda a, s=(1, 1, 1): _running_kge(
+        a, s, a.sim_sd / a.obs_sd, a.obs_mean == 0 or a.obs_sd == 0)),
+    kge_2012: ((), lambda a, s=(1, 1, 1): _running_kge(
+        a, s, (a.sim_sd_pop / a.sim_mean) / (a.obs_sd_pop / a.obs_mean),
+        a.obs_mean == 0 or a.obs_sd == 0 or a.sim_mean == 0)),
+    lm_index: (('abs_diff', 'lm_denom'), lambda a, obs_bar_p=None: 1 - (
+        a.sae / a.term('lm_denom', obs_bar_p=obs_bar_p))),
+    d1_p: (('abs_diff', 'd1_p_denom'), lambda a, obs_bar_p=None: 1 - (
+        a.sae / a.term('d1_p_denom', obs_bar_p=obs_bar_p))),
+    ve: (('abs_diff',), lambda a: 1 - (a.sae / (a.n * a.obs_mean))),
+    sa: ((), lambda a: np.arccos((a.sp + a.n * a.sim_mean * a.obs_mean) / (
+        np.sqrt(a.ss_sim + a.n * a.sim_mean ** 2) * np.sqrt(a.ss_obs + a.n * a.obs_mean ** 2)))),
+    sc: ((), lambda a: np.arccos(a.sp / (np.sqrt(a.ss_obs) * np.sqrt(a.ss_sim)))),
+    sid: (('obs_log_ratio', 'sim_log_ratio'), lambda a: (a.term('obs_log_ratio') / a.obs_mean -
+                                                         a.term('sim_log_ratio') / a.sim_mean)),
+    sga: ((), _running_sga),
+    h6_mhe: (('h6',), lambda a, k=1: a.term('h6', k=k) / a.n),
+    h6_mahe: (('abs_h6',), lambda a, k=1: a.term('abs_h6', k=k) / a.n),
+    h6_rmshe: (('sq_h6',), lambda a, k=1: np.sqrt(a.term('sq_h6', k=k) / a.n)),
+    h7_mhe: (('ratio_error',), lambda a: a.term('ratio_error') / a.n / a.ratio_min),
+    h7_mahe: (('abs_ratio_error',), lambda a: a.term('abs_ratio_error') / a.n / np.abs(a.ratio_min)),
+    h7_rmshe: (('sq_ratio_error',), lambda a: np.sqrt(a.term('sq_ratio_error') / a.n) / np.abs(a.ratio_min)),
+    h8_mhe: (('ratio_error',), lambda a: a.term('ratio_error') / a.n / a.ratio_max),
+    h8_mahe: (('abs_ratio_error',), lambda a: a.term('abs_ratio_error') / a.n / np.abs(a.ratio_max)),
+    h8_rmshe: (('sq_ratio_error',), lambda a: np.sqrt(a.term('sq_ratio_error') / a.n) / np.abs(a.ratio_max)),
+    g_mean_diff: (('log_log1p_sim', 'log_log1p_obs'), lambda a: np.exp(
+        np.exp(a.term('log_log1p_sim') / a.n) - np.exp(a.term('log_log1p_obs') / a.n))),
+    mean_var: ((), lambda a: a.comoment[2, 2] / a.n),
+}
+
+# Streaming metrics that depend on the order of the values (lagged differences and gradients)
+_ORDER_METRICS = {mase, irmse, sga}
+
+for _h in ('h1', 'h2', 'h3', 'h4', 'h5', 'h10'):
+    _STREAMING_METRICS[globals()[_h + '_mhe']] = ((_h,), _running_mean(_h))
+    _STREAMING_METRICS[globals()[_h + '_mahe']] = (('abs_' + _h,), _running_mean('abs_' + _h))
+    _STREAMING_METRICS[globals()[_h + '_rmshe']] = (('sq_' + _h,), _running_rms('sq_' + _h))
+
+
+def _combine_moments(n_a, mean_a, comoment_a, n_b, mean_b, comoment_b):
+    # Pairwise update of the means and co-moment matrices of two sets of samples (Chan et al.)
+    n = n_a + n_b
+    if n_b == 0:
+        return n_a, mean_a, comoment_a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (n_b / n)
+    comoment = comoment_a + comoment_b + np.outer(delta, delta) * (n_a * n_b / n)
+    return n, mean, comoment
+
+
+def _moments(variables):
+    # Means and co-moment matrix of the rows of a 2D array
+    mean = variables.mean(axis=1)
+    centered = variables - mean[:, np.newaxis]
+    return variables.shape[1], mean, centered.dot(centered.T)
+
+
+class MetricAccumulator(object):
+    """Running statistics of a simulated and observed pair of series that is received in chunks.
+
+    Each call to update cleans the new chunk and folds it into running means, co-moments (using the
+    pairwise form of Welford's algorithm), sums, minimums and maximums. The metrics are computed
+    from these running statistics, so reading the metrics takes the same time no matter how long
+    the record is. The values agree with the ones from list_of_metrics on the full record up to
+    floating point rounding.
+
+    The accumulators of consecutive parts of a record can be combined with merge, and their partial
+    state can be serialized with to_dict and restored with from_dict. This allows a single long
+    record to be split between processes or machines.
+
+    Only the metrics that can be computed from running statistics are supported. The median based
+    metrics (MdE, MdAE, MdSE, NRMSE (IQR)), the rank based metrics (R (Spearman), (MB) R) and the
+    metrics that use absolute deviations from the mean of the full record (d, d1, d (Mod.),
+    d (Rel.), dr, NSE (Mod.), and E1' and D1' without an obs_bar_p) are not.
+
+    Parameters
+    ----------
+    metrics: list of str
+        The names (or abbreviations if abbr is True) of the metrics to compute.
+
+    abbr: bool, optional
+        If True, the metrics are given as abbreviations instead of full names.
+
+    mase_m, h6_mhe_k, h6_ahe_k, h6_rmshe_k, d1_p_obs_bar_p, lm_x_obs_bar_p, kge2009_s, kge2012_s
+        The metric parameters, see list_of_metrics.
+
+    replace_nan, replace_inf, remove_neg, remove_zero
+        The data cleaning options that are applied to each chunk, see list_of_metrics.
+
+    Raises
+    ------
+    ValueError
+        If one of the metrics is unknown or cannot be computed from running statistics.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> sim = np.array([5, 7, 9, 2, 4.5, 6.7])
+    >>> obs = np.array([4.7, 6, 10, 2.5, 4, 6.8])
+    >>> accumulator = hm.MetricAccumulator(['ME', 'NSE', 'KGE (2012)'], abbr=True)
+    >>> accumulator.update(sim[:4], obs[:4])
+    >>> accumulator.update(sim[4:], obs[4:])
+    >>> accumulator.values()
+    [0.03333333333333336, 0.923333988598388, 0.9132923608280755]
+    """
+
+    def __init__(self, metrics, abbr=False, mase_m=1, h6_mhe_k=1, h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None,
+                 lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1), kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None,
+                 remove_neg=False, remove_zero=False):
+        # Kept to recreate the accumulator from its serialized state
+        self.options = {'abbr': abbr, 'mase_m': mase_m, 'h6_mhe_k': h6_mhe_k, 'h6_ahe_k': h6_ahe_k,
+                        'h6_rmshe_k': h6_rmshe_k, 'd1_p_obs_bar_p': d1_p_obs_bar_p, 'lm_x_obs_bar_p': lm_x_obs_bar_p,
+                        'kge2009_s': tuple(kge2009_s), 'kge2012_s': tuple(kge2012_s), 'replace_nan': replace_nan,
+                        'replace_inf': replace_inf, 'remove_neg': remove_neg, 'remove_zero': remove_zero}
+        self.plan = MetricPlan(metrics, **self.options)
+
+        # The running sums that are needed by the metrics
+        self.terms = []
+        for metric, (metric_func, params) in zip(self.plan.metrics, self.plan.functions):
+            if metric_func not in _STREAMING_METRICS or params.get('obs_bar_p', 0) is None:
+                raise ValueError("{!r} cannot be computed from running statistics.".format(metric))
+            for name in _STREAMING_METRICS[metric_func][0]:
+                key = self._key(name, params)
+                if key not in self.terms:
+                    self.terms.append(key)
+        self.lag = mase_m
+        # Number of values kept from each end of the record to join it with the neighbouring records
+        self.edge = max(mase_m, 1)
+
+        self._reset()
+
+    def _reset(self):
+        self.n = 0
+        # Running means and co-moments of the simulated values, observed values and the log errors
+        self.mean = np.zeros(3)
+        self.comoment = np.zeros((3, 3))
+        # Running means and co-moments of the observed and simulated gradients
+        self.n_grad = 0
+        self.grad_mean = np.zeros(2)
+        self.grad_comoment = np.zeros((2, 2))
+        self.sums = dict.fromkeys(self.terms, 0.)
+        self.lag_sum = 0.
+        self.obs_min = np.inf
+        self.obs_max = -np.inf
+        self.ratio_min = np.inf
+        self.ratio_max = -np.inf
+        # The first and last values of the cleaned record
+        self.head_sim = np.empty(0)
+        self.head_obs = np.empty(0)
+        self.tail_sim = np.empty(0)
+        self.tail_obs = np.empty(0)
+
+    @staticmethod
+    def _key(name, params):
+        if name in _PARAMETRIC_TERMS:
+            return name, tuple(sorted(params.items()))
+        return name, ()
+
+    def term(self, name, **params):
+        """The running sum of one of the elementwise terms."""
+        return self.sums[self._key(name, params)]
+
+    def _empty(self):
+        # An accumulator with the same metrics and options, without any data
+        empty = copy.copy(self)
+        empty._reset()
+        return empty
+
+    def _from_statistics(self, stats):
+        # The partial state of a single cleaned chunk
+        part = self._empty()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            part.n, part.mean, part.comoment = _moments(np.vstack((stats.sim, stats.obs, stats.log_diff)))
+            for key in self.terms:
+                name, params = key
+                part.sums[key] = np.sum(_RUNNING_TERMS[name](stats, **dict(params)))
+            part.obs_min = np.min(stats.obs)
+            part.obs_max = np.max(stats.obs)
+            part.ratio_min = np.min(stats.ratio)
+            part.ratio_max = np.max(stats.ratio)
+
+        if stats.n > 1:
+            part.n_grad, part.grad_mean, part.grad_comoment = _moments(np.vstack((np.diff(stats.obs),
+                                                                                  np.diff(stats.sim))))
+        if stats.n > self.lag:
+            part.lag_sum = np.sum(np.abs(stats.obs[self.lag:] - stats.obs[:stats.n - self.lag]))
+        part.head_sim = stats.sim[:self.edge]
+        part.head_obs = stats.obs[:self.edge]
+        part.tail_sim = stats.sim[-self.edge:]
+        part.tail_obs = stats.obs[-self.edge:]
+        return part
+
+    def _absorb(self, other):
+        # Appends the record of another accumulator to the end of this one
+        if other.n == 0:
+            return
+        if self.n == 0:
+            self.__dict__.update(copy.deepcopy(other.__dict__))
+            return
+
+        # The gradient and the lagged differences across the boundary of the two records
+        boundary = np.array([other.head_obs[0] - self.tail_obs[-1], other.head_sim[0] - self.tail_sim[-1]])
+        self.n_grad, self.grad_mean, self.grad_comoment = _combine_moments(
+            self.n_grad, self.grad_mean, self.grad_comoment, 1, boundary, np.zeros((2, 2)))
+        self.n_grad, self.grad_mean, self.grad_comoment = _combine_moments(
+            self.n_grad, self.grad_mean, self.grad_comoment, other.n_grad, other.grad_mean, other.grad_comoment)
+        edges = np.concatenate((self.tail_obs, other.head_obs))
+        first = np.arange(max(self.tail_obs.size - self.lag, 0), min(self.tail_obs.size, edges.size - self.lag))
+        self.lag_sum += other.lag_sum + np.sum(np.abs(edges[first + self.lag] - edges[first]))
+
+        self.n, self.mean, self.comoment = _combine_moments(self.n, self.mean, self.comoment,
+                                                            other.n, other.mean, other.comoment)
+        for key in self.terms:
+            self.sums[key] += other.sums[key]
+        self.obs_min = min(self.obs_min, other.obs_min)
+        self.obs_max = max(self.obs_max, other.obs_max)
+        self.ratio_min = min(self.ratio_min, other.ratio_min)
+        self.ratio_max = max(self.ratio_max, other.ratio_max)
+
+        self.head_sim = np.concatenate((self.head_sim, other.head_sim))[:self.edge]
+        self.head_obs = np.concatenate((self.head_obs, other.head_obs))[:self.edge]
+        self.tail_sim = np.concatenate((self.tail_sim, other.tail_sim))[-self.edge:]
+        self.tail_obs = np.concatenate((self.tail_obs, other.tail_obs))[-self.edge:]
+
+    def update(self, sim_chunk, obs_chunk):
+        """Add the next chunk of the simulated and observed series.
+
+        Parameters
+        ----------
+        sim_chunk: 1D ndarray
+            The next values of the simulated series.
+
+        obs_chunk: 1D ndarray
+            The next values of the observed series, at the same time steps as sim_chunk.
+        """
+        stats = self.plan.statistics(sim_chunk, obs_chunk)
+        if stats.n:
+            self._absorb(self._from_statistics(stats))
+
+    def merge(self, other):
+        """Combine the partial state of two consecutive parts of a record.
+
+        The record of other must directly follow the record of this accumulator. Merging is
+        associative, so the partial states of many parts can be computed separately (e.g. by different
+        processes) and merged in any grouping, as long as the order of the parts is kept.
+
+        Parameters
+        ----------
+        other: MetricAccumulator
+            The accumulator of the following part of the record. It must have been created with the
+            same metrics and options.
+
+        Returns
+        -------
+        MetricAccumulator
+            A new accumulator with the state of both parts, the two accumulators are not changed.
+
+        Examples
+        --------
+        >>> import numpy as np
+        >>> import hydrostats.metrics as hm
+        >>> sim = np.array([5, 7, 9, 2, 4.5, 6.7])
+        >>> obs = np.array([4.7, 6, 10, 2.5, 4, 6.8])
+        >>> first = hm.MetricAccumulator(['RMSE', 'IRMSE'], abbr=True)
+        >>> second = hm.MetricAccumulator(['RMSE', 'IRMSE'], abbr=True)
+        >>> first.update(sim[:3], obs[:3])
+        >>> second.update(sim[3:], obs[3:])
+        >>> first.merge(second).values()
+        [0.6582805886043833, 0.14438269394140332]
+        """
+        if (self.plan.functions != other.plan.functions or self.plan.cleaning != other.plan.cleaning or
+                self.lag != other.lag):
+            raise ValueError("Only accumulators with the same metrics and options can be merged.")
+        merged = copy.deepcopy(self)
+        merged._absorb(other)
+        return merged
+
+    def to_dict(self):
+        """The options and the partial state of the accumulator, as a JSON serializable dictionary."""
+        return {
+            'metrics': self.plan.metrics,
+            'options': self.options,
+            'n': self.n,
+            'mean': self.mean.tolist(),
+            'comoment': self.comoment.tolist(),
+            'n_grad': self.n_grad,
+            'grad_mean': self.grad_mean.tolist(),
+            'grad_comoment': self.grad_comoment.tolist(),
+            'sums': [[name, [list(param) for param in params], float(value)]
+                     for (name, params), value in self.sums.items()],
+            'lag_sum': float(self.lag_sum),
+            'obs_min': float(self.obs_min),
+            'obs_max': float(self.obs_max),
+            'ratio_min': float(self.ratio_min),
+            'ratio_max': float(self.ratio_max),
+            'head_sim': self.head_sim.tolist(),
+            'head_obs': self.head_obs.tolist(),
+            'tail_sim': self.tail_sim.tolist(),
+            'tail_obs': self.tail_obs.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        """Recreate an accumulator from the dictionary given by to_dict."""
+        accumulator = cls(state['metrics'], **state['options'])
+        accumulator.n = state['n']
+        accumulator.n_grad = state['n_grad']
+        accumulator.sums = {(name, tuple(tuple(param) for param in params)): value
+                            for name, params, value in state['sums']}
+        for name in ('lag_sum', 'obs_min', 'obs_max', 'ratio_min', 'ratio_max'):
+            setattr(accumulator, name, state[name])
+        for name in ('mean', 'comoment', 'grad_mean', 'grad_comoment', 'head_sim', 'head_obs', 'tail_sim',
+                     'tail_obs'):
+            setattr(accumulator, name, np.array(state[name], dtype=np.float64))
+        return accumulator
+
+    def values(self):
+        """The current values of the metrics, in the order that they were given."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return [_STREAMING_METRICS[metric_func][1](self, **params) for metric_func, params in self.plan.functions]
+
+    # The statistics used by the metric derivations
+    sim_mean = property(lambda self: self.mean[0])
+    obs_mean = property(lambda self: self.mean[1])
+    ss_sim = property(lambda self: self.comoment[0, 0])
+    ss_obs = property(lambda self: self.comoment[1, 1])
+    sp = property(lambda self: self.comoment[0, 1])
+    sim_sd = property(lambda self: np.sqrt(self.ss_sim / (self.n - 1)))
+    obs_sd = property(lambda self: np.sqrt(self.ss_obs / (self.n - 1)))
+    sim_sd_pop = property(lambda self: np.sqrt(self.ss_sim / self.n))
+    obs_sd_pop = property(lambda self: np.sqrt(self.ss_obs / self.n))
+    pearson = property(lambda self: self.sp / (np.sqrt(self.ss_obs) * np.sqrt(self.ss_sim)))
+    sae = property(lambda self: self.term('abs_diff'))
+    sse = property(lambda self: self.term('sq_diff'))
+    mse = property(lambda self: self.sse / self.n)
+    rmse = property(lambda self: np.sqrt(self.mse))
+
+
+class _GroupStatistics(MetricAccumulator):
+    # The statistics of MetricAccumulator for one group of MetricPlan.run_groups, taken from sums
+    # over the time steps of the group instead of being accumulated chunk by chunk
+
+    def __init__(self, stats, selected, n, mean, comoment, sums):
+        self.stats = stats
+        self.selected = selected
+        self.n = n
+        self.mean = mean
+        self.comoment = comoment
+        self.sums = sums
+
+    # The extremes are only found for the few metrics that need them
+    obs_min = property(lambda self: np.min(self.stats.obs[self.selected]))
+    obs_max = property(lambda self: np.max(self.stats.obs[self.selected]))
+    ratio_min = property(lambda self: np.min(self.stats.ratio[self.selected]))
+    ratio_max = property(lambda self: np.max(self.stats.ratio[self.selected]))
+
+    @classmethod
+    def from_membership(cls, stats, membership, functions):
+        # The statistics of every group (row of the membership array) of a cleaned pair
+        keys = []
+        for metric_func, params in functions:
+            for name in _STREAMING_METRICS[metric_func][0]:
+                key = cls._key(name, params)
+                if key not in keys:
+                    keys.append(key)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # The co-moments are summed around the means of all of the values. The log errors are
+            # only included for the metrics that use them.
+            if any(metric_func in (mle, mean_var) for metric_func, params in functions):
+                variables = [stats.sim, stats.obs, stats.log_diff]
+            else:
+                variables = [stats.sim, stats.obs]
+            size = len(variables)
+            pairs = [(i, j) for i in range(size) for j in range(i, size)]
+
+            # One row per summed term, after a row of ones that counts the values of each group
+            columns = np.empty((1 + size + len(pairs) + len(keys), stats.n))
+            columns[0] = 1
+            center = np.array([np.mean(variable) for variable in variables])
+            for i, variable in enumerate(variables):
+                np.subtract(variable, center[i], out=columns[1 + i])
+            for k, (i, j) in enumerate(pairs):
+                np.multiply(columns[1 + i], columns[1 + j], out=columns[1 + size + k])
+            for k, (name, params) in enumerate(keys):
+                columns[1 + size + len(pairs) + k] = _RUNNING_TERMS[name](stats, **dict(params))
+            n, totals = np.split(_group_sums(membership, columns), [1], axis=1)
+            n = n[:, 0]
+
+            offsets = totals[:, :size] / n[:, np.newaxis]
+            means = np.full((membership.shape[0], 3), np.nan)
+            means[:, :size] = center + offsets
+            comoments = np.full((membership.shape[0], 3, 3), np.nan)
+            for k, (i, j) in enumerate(pairs):
+                comoments[:, i, j] = comoments[:, j, i] = (totals[:, size + k] -
+                                                           offsets[:, i] * totals[:, j])
+
+        sums = totals[:, size + len(pairs):]
+        return [cls(stats, membership[row], n[row], means[row], comoments[row], dict(zip(keys, sums[row])))
+                for row in range(membership.shape[0])]
+
+
+def _group_sums(membership, columns):
+    # Sums of each row of columns over the time steps of each group. The time steps are split into
+    # runs where the membership of every group stays the same (e.g. the days between the boundaries
+    # of the seasonal periods), which are summed with np.add.reduceat and then added up for each
+    # group. A masked sum is used instead of a matrix product so that an Inf in one run does not
+    # give NaN (0 * Inf) for the groups without it.
+    if not columns.shape[1]:
+        return np.zeros((membership.shape[0], columns.shape[0]))
+    changes = np.any(membership[:, 1:] != membership[:, :-1], axis=0)
+    starts = np.concatenate(([0], np.flatnonzero(changes) + 1))
+    run_sums = np.add.reduceat(columns, starts, axis=1)
+    return np.sum(np.where(membership[:, np.newaxis, starts], run_sums, 0.), axis=2)
+
+
+# Lags whose sum of squared errors is below this fraction of the sums of squares of the anomalies
+# are recomputed from the pairs by _LagMoments
+_LAG_SSE_RTOL = 1e-6
+
+
+class _LagMoments(object):
+    # Means, sums of squares and cross products of the simulated data shifted by each lag against
+    # the observed data. The sums over the pairs of every lag are taken from cumulative sums of the
+    # anomalies and their squares (which slide with the lag in O(1)) and from one FFT cross
+    # correlation of the anomalies, so all of the lags cost O(n log n + lags) instead of O(n * lags).
+    # With overlap=False the simulated data is rolled around like np.roll and every lag pairs all of
+    # the time steps, otherwise only the time steps where the shifted series overlap are paired.
+    # The arrays may have leading axes (e.g. one row per station), the lags are along the last one.
+    # When valid=(sim_valid, obs_valid) is given, the pairs with an invalid value are left out of
+    # the sums of each lag. The window sums can not skip them, so every sum becomes a cross
+    # correlation of the masked values against the mask of the other series. With valid, the 2D
+    # arrays can also hold series of different lengths (the number of leading time steps of each
+    # row, the rest being invalid padding), which are then rolled around their own lengths.
+
+    def __init__(self, sim_array, obs_array, lags, overlap=False, valid=None, lengths=None):
+        sim = np.asarray(sim_array, dtype=np.float64)
+        obs = np.asarray(obs_array, dtype=np.float64)
+        n = sim.shape[-1]
+        lags = np.asarray(lags)
+        size = 2 * n - 1 if overlap else n
+        if lengths is not None and not overlap:
+            # A roll of a series of length m pairs the lags k and k - m of the linear cross
+            # correlation, with k = lag % m. The padding to 2 * n keeps every lag down to -n apart.
+            size = 2 * n
+            lengths = np.maximum(np.asarray(lengths), 1)[:, np.newaxis]
+            rolled = lags % lengths
+
+        def correlate(x_spectrum, y_spectrum):
+            # Sums of x[i - lag] * y[i] for each lag
+            sums = np.fft.irfft(y_spectrum * np.conj(x_spectrum), size)
+            if lengths is None or overlap:
+                return sums[..., lags % size]
+            return (np.take_along_axis(sums, rolled % size, axis=-1) +
+                    np.take_along_axis(sums, (rolled - lengths) % size, axis=-1))
+
+        if valid is None:
+            # Working with the anomalies from the overall means keeps the sums of squares accurate
+            sim_center = np.mean(sim, axis=-1, keepdims=True)
+            obs_center = np.mean(obs, axis=-1, keepdims=True)
+            a = sim - sim_center
+            b = obs - obs_center
+
+            # The simulated value at i - lag is paired with the observed value at i. Zero padding
+            # turns the circular cross correlation into the sums over the overlaps.
+            sum_ab = correlate(np.fft.rfft(a, size), np.fft.rfft(b, size))
+            if overlap:
+                start = np.clip(lags, 0, n)
+                stop = np.maximum(np.clip(n + np.minimum(lags, 0), 0, n), start)
+                count = stop - start
+                sum_ab = np.where(count > 0, sum_ab, 0.)
+                sim_start = np.where(count > 0, start - lags, 0)
+                sim_range = (sim_start, sim_start + count)
+                obs_range = (start, stop)
             else:
-                index = metric_abbr.index(metric)
-                metric_func = function_list[index]
-                metrics_list.append(
-                    metric_func(sim_array, obs_array, replace_nan=replace_nan,
-                                replace_inf=replace_inf, remove_neg=remove_neg,
-                                remove_zero=remove_zero))
-    return metrics_list
+                count = np.full(lags.shape, n)
+                sim_range = obs_range = (np.zeros(lags.shape, dtype=int), count)
+
+            sum_a, sum_aa = self._window_sums(a, *sim_range)
+            sum_b, sum_bb = self._window_sums(b, *obs_range)
+        else:
+            sim_valid = np.asarray(valid[0], dtype=bool)
+            obs_valid = np.asarray(valid[1], dtype=bool)
+            sim_mask = sim_valid.astype(np.float64)
+            obs_mask = obs_valid.astype(np.float64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                sim_center = np.nan_to_num(np.sum(np.where(sim_valid, sim, 0.), axis=-1, keepdims=True)
+                                           / np.sum(sim_mask, axis=-1, keepdims=True))
+                obs_center = np.nan_to_num(np.sum(np.where(obs_valid, obs, 0.), axis=-1, keepdims=True)
+                                           / np.sum(obs_mask, axis=-1, keepdims=True))
+            a = np.where(sim_valid, sim - sim_center, 0.)
+            b = np.where(obs_valid, obs - obs_center, 0.)
+
+            a_spectrum = np.fft.rfft(a, size)
+            b_spectrum = np.fft.rfft(b, size)
+            sim_mask_spectrum = np.fft.rfft(sim_mask, size)
+            obs_mask_spectrum = np.fft.rfft(obs_mask, size)
+            count = np.rint(correlate(sim_mask_spectrum, obs_mask_spectrum))
+            if overlap:
+                # Lags as long as the series would wrap around the padding
+                count = np.where(np.abs(lags) < n, count, 0.)
+            paired = count > 0
+            sum_a = np.where(paired, correlate(a_spectrum, obs_mask_spectrum), 0.)
+            sum_aa = np.where(paired, correlate(np.fft.rfft(a ** 2, size), obs_mask_spectrum), 0.)
+            sum_b = np.where(paired, correlate(sim_mask_spectrum, b_spectrum), 0.)
+            sum_bb = np.where(paired, correlate(sim_mask_spectrum, np.fft.rfft(b ** 2, size)), 0.)
+            sum_ab = np.where(paired, correlate(a_spectrum, b_spectrum), 0.)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_a = sum_a / count
+            mean_b = sum_b / count
+            self.n = count
+            self.sim_mean = sim_center + mean_a
+            self.obs_mean = obs_center + mean_b
+            self.ss_sim = sum_aa - sum_a * mean_a
+            self.ss_obs = sum_bb - sum_b * mean_b
+            self.sp = sum_ab - sum_a * mean_b
+            # Sum of ((a - b) + (sim_center - obs_center)) ** 2 over the pairs
+            offset = sim_center - obs_center
+            self.sse = (sum_aa + sum_bb - 2 * sum_ab) + 2 * offset * (sum_a - sum_b) + count * offset ** 2
+
+        # When the pairs nearly match, sum_aa + sum_bb - 2 * sum_ab cancels and loses most of its
+        # digits, so the sums of squared errors of those lags are taken directly from the pairs
+        inexact = np.nonzero((count > 0) & (self.sse < _LAG_SSE_RTOL * (sum_aa + sum_bb)))
+        if inexact[0].size:
+            self.sse = np.array(np.broadcast_to(self.sse, np.broadcast(self.sse, count).shape))
+            if valid is None:
+                valid = (np.ones(sim.shape, dtype=bool), np.ones(obs.shape, dtype=bool))
+            for index in zip(*inexact):
+                row = index[:-1]
+                length = n if lengths is None or overlap else int(lengths[row[0], 0])
+                self.sse[index] = self._pair_sse(sim[row], obs[row], valid[0][row], valid[1][row],
+                                                 lags[index[-1]], overlap, length)
+
+    @staticmethod
+    def _pair_sse(sim, obs, sim_valid, obs_valid, lag, overlap, length):
+        # Sum of the squared errors of the valid pairs of one 1D series at one lag
+        if not overlap:
+            sim = np.roll(sim[:length], lag)
+            sim_valid = np.roll(sim_valid[:length], lag)
+            obs = obs[:length]
+            obs_valid = obs_valid[:length]
+        else:
+            n = sim.size
+            if lag >= 0:
+                sim, sim_valid = sim[:n - lag], sim_valid[:n - lag]
+                obs, obs_valid = obs[lag:], obs_valid[lag:]
+            else:
+                sim, sim_valid = sim[-lag:], sim_valid[-lag:]
+                obs, obs_valid = obs[:n + lag], obs_valid[:n + lag]
+        paired = sim_valid & obs_valid
+        return np.sum((sim[paired] - obs[paired]) ** 2)
+
+    @staticmethod
+    def _window_sums(x, start, stop):
+        # Sums of x and x ** 2 over x[..., start:stop] for each pair of bounds, from cumulative sums
+        zeros = np.zeros(x.shape[:-1] + (1,))
+        cumulative = np.concatenate((zeros, np.cumsum(x, axis=-1)), axis=-1)
+        cumulative_sq = np.concatenate((zeros, np.cumsum(x ** 2, axis=-1)), axis=-1)
+        return (cumulative[..., stop] - cumulative[..., start],
+                cumulative_sq[..., stop] - cumulative_sq[..., start])
+
+    sim_sd = property(lambda self: np.sqrt(self.ss_sim / (self.n - 1)))
+    obs_sd = property(lambda self: np.sqrt(self.ss_obs / (self.n - 1)))
+    sim_sd_pop = property(lambda self: np.sqrt(self.ss_sim / self.n))
+    obs_sd_pop = property(lambda self: np.sqrt(self.ss_obs / self.n))
+    pearson = property(lambda self: self.sp / (np.sqrt(self.ss_obs) * np.sqrt(self.ss_sim)))
+    mse = property(lambda self: self.sse / self.n)
+    rmse = property(lambda self: np.sqrt(self.mse))
+
+    def compute(self, metric_func, **params):
+        """Compute a metric in _LAG_METRICS for every lag, NaN where less than two values are paired."""
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(self.n >= 2, _LAG_METRICS[metric_func](self, **params), np.nan)
+
+
+# Metrics that only depend on the means, sums of squares and cross products of the pairs, and can
+# therefore be computed for every lag at once by _LagMoments
+_LAG_METRICS = {
+    me: lambda a: a.sim_mean - a.obs_mean,
+    mse: lambda a: a.mse,
+    rmse: lambda a: a.rmse,
+    ed: lambda a: np.sqrt(a.sse),
+    ned: _STREAMING_METRICS[ned][1],
+    nrmse_mean: lambda a: a.rmse / a.obs_mean,
+    r_squared: lambda a: a.sp ** 2 / (a.ss_obs * a.ss_sim),
+    pearson_r: lambda a: a.pearson,
+    acc: lambda a: a.sp / (a.obs_sd * a.sim_sd * a.n),
+    watt_m: _STREAMING_METRICS[watt_m][1],
+    nse: lambda a: 1 - (a.sse / a.ss_obs),
+    kge_2009: lambda a, s=(1, 1, 1): _running_kge(a, s, a.sim_sd / a.obs_sd, (a.obs_mean == 0) | (a.obs_sd == 0)),
+    kge_2012: lambda a, s=(1, 1, 1): _running_kge(
+        a, s, (a.sim_sd_pop / a.sim_mean) / (a.obs_sd_pop / a.obs_mean),
+        (a.obs_mean == 0) | (a.obs_sd == 0) | (a.sim_mean == 0)),
+    sa: _STREAMING_METRICS[sa][1],
+    sc: _STREAMING_METRICS[sc][1],
+}
+
+
+def list_of_metrics(metrics, sim_array, obs_array, abbr=False, mase_m=1, dmod_j=1,
+                    nse_mod_j=1, h6_mhe_k=1, h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None,
+                    lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1), kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None, remove_neg=False,
+                    remove_zero=False, cache=None, out=None):
+    """Compute a list of metrics for a pair of simulated and observed arrays.
+
+    The arrays are cleaned once and the intermediate statistics (residuals, anomalies, ratios, etc.)
+    are shared between all of the metrics, see MetricPlan.
+
+    Parameters
+    ----------
+    metrics: list of str
+        The names (or abbreviations if abbr is True) of the metrics to compute.
+
+    sim_array: 1D ndarray
+        Array of simulated data.
+
+    obs_array: 1D ndarray
+        Array of observed data.
+
+    abbr: bool, optional
+        If True, the metrics are given as abbreviations instead of full names.
+
+    mase_m: int, Optional
+        Parameter for the mean absolute scaled error (MASE) metric.
+
+    dmod_j: int or float, optional
+        Parameter for the modified index of agreement (dmod) metric.
+
+    nse_mod_j: int or float, optional
+        Parameter for the modified Nash-Sutcliffe (nse_mod) metric.
+
+    h6_mhe_k: int or float, optional
+        Parameter for the H6 (MHE) metric.
+
+    h6_ahe_k: int or float, optional
+        Parameter for the H6 (AHE) metric
+
+    h6_rmshe_k: int or float, optional
+        Parameter for the H6 (RMSHE) metric
+
+    d1_p_obs_bar_p: float, optional
+        Parameter fot the Legate McCabe Index of Agreement (d1_p).
+
+    lm_x_obs_bar_p: float, optional
+        Parameter for the Lagate McCabe Efficiency Index (lm_index).
+
+    kge2009_s: tuple of floats
+        A tuple of floats of length three signifying how to weight the three values used in the Kling Gupta (2009)
+        metric.
+
+    kge2012_s: tuple of floats
+        A tuple of floats of length three signifying how to weight the three values used in the Kling Gupta (2012)
+        metric.
+
+    replace_nan: float, optional
+        If given, indicates which value to replace NaN values with in the two arrays. If None, when
+        a NaN value is found at the i-th position in the observed OR simulated array, the i-th value
+        of the observed and simulated array are removed before the computation.
+
+    replace_inf: float, optional
+        If given, indicates which value to replace Inf values with in the two arrays. If None, when
+        an inf value is found at the i-th position in the observed OR simulated array, the i-th
+        value of the observed and simulated array are removed before the computation.
+
+    remove_neg: boolean, optional
+        If True, when a negative value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+
+    remove_zero: boolean, optional
+        If true, when a zero value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+
+    cache: MetricCache, optional
+        If given, the results are looked up in (and stored in) the cache, so that repeated calls
+        with the same arrays and options are not computed again.
+
+    out: ndarray, optional
+        A preallocated buffer that the metric values are written into. Either a float array of shape
+        (len(metrics),) with the values in the order of the metrics, or a structured array (or a
+        record of one) with a field named after each metric. A ValueError is raised if the buffer
+        does not fit the metrics.
+
+    Returns
+    -------
+    list of float or ndarray
+        The values of the metrics in the order they were given. If out is given, out is returned
+        with the values written into it.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> sim = np.array([5, 7, 9, 2, 4.5, 6.7])
+    >>> obs = np.array([4.7, 6, 10, 2.5, 4, 6.8])
+    >>> hm.list_of_metrics(['ME', 'NSE'], sim, obs, abbr=True)
+    [0.03333333333333336, 0.923333988598388]
+
+    Writing the values into one row of a preallocated table
+
+    >>> table = np.empty((3, 2))
+    >>> hm.list_of_metrics(['ME', 'NSE'], sim, obs, abbr=True, out=table[0])
+    array([0.03333333, 0.92333399])
+    """
+    plan = MetricPlan(metrics, abbr=abbr, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
+                      replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+                      remove_zero=remove_zero)
+
+    if cache is not None:
+        return cache.run(plan, sim_array, obs_array, out=out)
+    return plan.run(sim_array, obs_array, out=out)
+
+
+def batch_metrics(metrics, sim_array, obs_array, mask=None, abbr=False, mase_m=1, dmod_j=1, nse_mod_j=1,
+                  h6_mhe_k=1, h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None, lm_x_obs_bar_p=None,
+                  kge2009_s=(1, 1, 1), kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None, remove_neg=False,
+                  remove_zero=False):
+    """Compute a list of metrics for many simulated and observed series at once.
+
+    This is the batched counterpart of list_of_metrics. Each row of the input arrays is a separate
+    series (e.g. a river reach or a station), and all of the series are cleaned and evaluated with
+    vectorized reductions along the time axis instead of a Python loop over the series.
+
+    Parameters
+    ----------
+    metrics: list of str
+        The names (or abbreviations if abbr is True) of the metrics to compute.
+
+    sim_array: 2D ndarray
+        Array of simulated data of dimension n_series x n_time.
+
+    obs_array: 1D or 2D ndarray
+        Array of observed data of dimension n_series x n_time, or a 1D array of length n_time with
+        the observed data of every series (see BatchStatistics).
+
+    mask: 2D ndarray of bool, optional
+        If given, only the values where the mask is True are used in each series (e.g. to exclude
+        the time steps before a gauge was installed). Must be the same shape as the simulated array.
+
+    abbr: bool, optional
+        If True, the metrics are given as abbreviations instead of full names.
+
+    mase_m: int, Optional
+        Parameter for the mean absolute scaled error (MASE) metric.
+
+    dmod_j: int or float, optional
+        Parameter for the modified index of agreement (dmod) metric.
+
+    nse_mod_j: int or float, optional
+        Parameter for the modified Nash-Sutcliffe (nse_mod) metric.
+
+    h6_mhe_k: int or float, optional
+        Parameter for the H6 (MHE) metric.
+
+    h6_ahe_k: int or float, optional
+        Parameter for the H6 (AHE) metric
+
+    h6_rmshe_k: int or float, optional
+        Parameter for the H6 (RMSHE) metric
+
+    d1_p_obs_bar_p: float, optional
+        Parameter fot the Legate McCabe Index of Agreement (d1_p).
+
+    lm_x_obs_bar_p: float, optional
+        Parameter for the Lagate McCabe Efficiency Index (lm_index).
+
+    kge2009_s: tuple of floats
+        A tuple of floats of length three signifying how to weight the three values used in the Kling Gupta (2009)
+        metric.
+
+    kge2012_s: tuple of floats
+        A tuple of floats of length three signifying how to weight the three values used in the Kling Gupta (2012)
+        metric.
+
+    replace_nan: float, optional
+        If given, indicates which value to replace NaN values with in the two arrays. If None, when
+        a NaN value is found at the i-th position in the observed OR simulated array, the i-th value
+        of the observed and simulated array are removed before the computation.
+
+    replace_inf: float, optional
+        If given, indicates which value to replace Inf values with in the two arrays. If None, when
+        an inf value is found at the i-th position in the observed OR simulated array, the i-th
+        value of the observed and simulated array are removed before the computation.
+
+    remove_neg: boolean, optional
+        If True, when a negative value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+
+    remove_zero: boolean, optional
+        If true, when a zero value is found at the i-th position in the observed OR simulated
+        array, the i-th value of the observed AND simulated array are removed before the
+        computation.
+
+    Returns
+    -------
+    2D ndarray
+        Array of dimension n_series x n_metrics with the metric values of each series. Series without
+        any valid values are given NaN.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> np.random.seed(3849590438)
+    >>> sim = np.random.rand(4, 365) * 100
+    >>> obs = np.random.rand(4, 365) * 100
+    >>> mask = np.ones(sim.shape, dtype=bool)
+    >>> mask[0, :100] = False  # The first station has no data for the first 100 days
+    >>> hm.batch_metrics(['ME', 'NSE', 'KGE (2012)'], sim, obs, mask=mask, abbr=True).shape
+    (4, 3)
+    """
+    plan = MetricPlan(metrics, abbr=abbr, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
+                      replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+                      remove_zero=remove_zero)
+
+    return plan.run_batch(sim_array, obs_array, mask=mask)
+
+
+def parameter_sweep(metrics, sim_array, obs_array, abbr=False, mase_m=1, dmod_j=1, nse_mod_j=1, h6_mhe_k=1,
+                    h6_ahe_k=1, h6_rmshe_k=1, d1_p_obs_bar_p=None, lm_x_obs_bar_p=None, kge2009_s=(1, 1, 1),
+                    kge2012_s=(1, 1, 1), replace_nan=None, replace_inf=None, remove_neg=False, remove_zero=False):
+    """Compute a list of metrics over grids of values of the metric parameters.
+
+    Takes the same arguments as list_of_metrics, but each metric parameter can also be a sequence of
+    values. The data is cleaned once, the intermediate statistics (residuals, anomalies, ratios,
+    etc.) are shared between all of the metrics and parameter values, and the values of a parameter
+    are evaluated together with broadcasted reductions instead of one list_of_metrics call per value.
+
+    Parameters
+    ----------
+    metrics: list of str
+        The names (or abbreviations if abbr is True) of the metrics to compute.
+
+    sim_array: 1D ndarray
+        Array of simulated data.
+
+    obs_array: 1D ndarray
+        Array of observed data.
+
+    abbr: bool, optional
+        If True, the metrics are given as abbreviations instead of full names.
+
+    mase_m, dmod_j, nse_mod_j, h6_mhe_k, h6_ahe_k, h6_rmshe_k, d1_p_obs_bar_p, lm_x_obs_bar_p: scalar or 1D array_like
+        The metric parameters (see list_of_metrics), either a single value or a sequence of values.
+
+    kge2009_s, kge2012_s: tuple of floats or 2D array_like
+        The weights of the Kling-Gupta Efficiency metrics, either a single tuple of length three or an
+        array of dimension n_values x 3.
+
+    replace_nan, replace_inf, remove_neg, remove_zero
+        The data cleaning options, see list_of_metrics.
+
+    Returns
+    -------
+    list
+        The values of the metrics, in the order given. The metrics with a sequence of parameter
+        values have a 1D ndarray with one value per parameter value, the other metrics have a float.
+
+    Examples
+    --------
+    >>> import numpy as np
+    >>> import hydrostats.metrics as hm
+    >>> sim = np.array([5, 7, 9, 2, 4.5, 6.7])
+    >>> obs = np.array([4.7, 6, 10, 2.5, 4, 6.8])
+    >>> hm.parameter_sweep(['NSE', 'd (Mod.)'], sim, obs, abbr=True, dmod_j=[1, 2, 3])
+    [0.923333988598388, array([0.85087719, 0.97897121, 0.99719324])]
+    """
+    plan = MetricPlan(metrics, abbr=abbr, mase_m=mase_m, dmod_j=dmod_j, nse_mod_j=nse_mod_j, h6_mhe_k=h6_mhe_k,
+                      h6_ahe_k=h6_ahe_k, h6_rmshe_k=h6_rmshe_k, d1_p_obs_bar_p=d1_p_obs_bar_p,
+                      lm_x_obs_bar_p=lm_x_obs_bar_p, kge2009_s=kge2009_s, kge2012_s=kge2012_s,
+                      replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+                      remove_zero=remove_zero)
+
+    return plan.sweep(sim_array, obs_array)
 
 
 if __name__ == "__main__":
@@ -16,6 +16,10 @@ import hydrostats.data as hd
 import hydrostats.visual as hv
 import matplotlib.image as mpimg
 import unittest
+import warnings
+import json
+import subprocess
+import timeit
 import numpy as np
 import pandas as pd
 
@@ -110,6 +114,280 @@ class MetricsTests(unittest.TestCase):
         self.assertTrue("The two ndarrays are not the same size." in context.exception.args[0])
         self.assertIsInstance(context.exception, RuntimeError)
 
+    def test_pair_statistics(self):
+        np.random.seed(1)
+        sim = np.random.rand(1000) * 100 + 1
+        obs = sim * (np.random.rand(1000) * 0.4 + 0.8)
+
+        stats = he.PairStatistics(sim, obs)
+        for metric_func in he.function_list:
+            self.assertTrue(np.isclose(metric_func(sim, obs), stats.compute(metric_func)))
+
+        self.assertTrue(np.isclose(he.dmod(sim, obs, j=2), stats.compute(he.dmod, j=2)))
+        self.assertTrue(np.isclose(he.h6_rmshe(sim, obs, k=3), stats.compute(he.h6_rmshe, k=3)))
+        self.assertTrue(np.isclose(he.kge_2009(sim, obs, s=(1.2, 0.8, 0.6)),
+                                   stats.compute(he.kge_2009, s=(1.2, 0.8, 0.6))))
+
+        # The bad data is cleaned only once, when the statistics are created
+        stats_bad_data = he.PairStatistics(self.sim_bad_data, self.obs_bad_data, remove_neg=True, remove_zero=True)
+        self.assertEqual(stats_bad_data.n, 6)
+        self.assertEqual(he.nse(self.sim_bad_data, self.obs_bad_data, remove_neg=True, remove_zero=True),
+                         stats_bad_data.compute(he.nse))
+
+    def test_batch_metrics(self):
+        np.random.seed(1)
+        sim = np.random.rand(20, 200) * 100 + 1
+        obs = sim * (np.random.rand(20, 200) * 0.4 + 0.8)
+        sim[3, 10] = np.nan
+        obs[4, 20] = np.inf
+        sim[5, 30] = 0
+        obs[6, 40] = -1
+        mask = np.random.rand(20, 200) > 0.2
+        mask[7, :] = False
+
+        test_array = he.batch_metrics(he.metric_abbr, sim, obs, mask=mask, abbr=True, mase_m=2,
+                                      remove_neg=True, remove_zero=True)
+        self.assertEqual(test_array.shape, (20, len(he.metric_abbr)))
+
+        for i in range(20):
+            if i == 7:
+                # A series without any valid values
+                self.assertTrue(np.all(np.isnan(test_array[i])))
+                continue
+            expected_list = he.list_of_metrics(he.metric_abbr, sim[i, mask[i]], obs[i, mask[i]], abbr=True, mase_m=2,
+                                               remove_neg=True, remove_zero=True)
+            self.assertTrue(np.all(np.isclose(expected_list, test_array[i])))
+
+        # A 1D observed array is shared by all of the series, and its statistics are only computed
+        # once when every series keeps the same time steps
+        shared_obs = obs[0]
+        stats = he.BatchStatistics(sim[:3], shared_obs)
+        self.assertEqual(stats.obs.shape, (1, 200))
+        self.assertEqual(stats.ss_obs.shape, (1, 1))
+        for sim_rows in [sim[:3], sim[3:7]]:
+            test_array = he.batch_metrics(he.metric_abbr, sim_rows, shared_obs, abbr=True, remove_neg=True,
+                                          remove_zero=True)
+            for i in range(sim_rows.shape[0]):
+                expected_list = he.list_of_metrics(he.metric_abbr, sim_rows[i], shared_obs, abbr=True,
+                                                   remove_neg=True, remove_zero=True)
+                self.assertTrue(np.all(np.isclose(expected_list, test_array[i], equal_nan=True)))
+
+        with self.assertRaises(RuntimeError):
+            he.batch_metrics(['ME'], self.sim, self.obs, abbr=True)
+        with self.assertRaises(RuntimeError):
+            he.batch_metrics(['ME'], sim, obs[:, :100], abbr=True)
+
+    def test_metric_plan(self):
+        plan = he.MetricPlan(he.metric_abbr, abbr=True, mase_m=2, dmod_j=2, h6_ahe_k=3, kge2012_s=(1.2, 0.8, 1))
+        self.assertEqual(len(plan), len(he.metric_abbr))
+
+        # The plan gives the same values every time it is run
+        for _ in range(2):
+            test_list = plan.run(self.sim, self.obs)
+            expected_list = he.list_of_metrics(he.metric_abbr, self.sim, self.obs, abbr=True, mase_m=2, dmod_j=2,
+                                               h6_ahe_k=3, kge2012_s=(1.2, 0.8, 1))
+            self.assertTrue(np.all(np.isclose(expected_list, test_list)))
+
+        # The parameters are bound to the metrics they belong to, for full names and abbreviations
+        name_plan = he.MetricPlan(['Mean Absolute Scaled Error', 'Mean Absolute H6 Error'], mase_m=2, h6_ahe_k=3)
+        abbr_plan = he.MetricPlan(['MASE', 'H6 (MAHE)', 'H6 (AHE)'], abbr=True, mase_m=2, h6_ahe_k=3)
+        expected_list = [he.mase(self.sim, self.obs, m=2), he.h6_mahe(self.sim, self.obs, k=3)]
+        self.assertTrue(np.all(np.isclose(expected_list, name_plan.run(self.sim, self.obs))))
+        self.assertTrue(np.all(np.isclose(expected_list + expected_list[1:], abbr_plan.run(self.sim, self.obs))))
+
+        with self.assertRaises(ValueError):
+            he.MetricPlan(['Not A Metric'])
+        with self.assertRaises(ValueError):
+            he.MetricPlan(['Nash-Sutcliffe Efficiency'], abbr=True)
+
+    def test_treatment_mask(self):
+        sim = np.array([5, np.nan, 9, 2, 4.5, 6.7, -np.inf, 3, 1])
+        obs = np.array([4.7, 6, 10, 0, 4, np.inf, 2, -1, 1])
+
+        expected_flags = np.array([0, 1, 0, 4, 0, 2, 10, 8, 0])
+        np.testing.assert_equal(he.treatment_flags(sim, obs, remove_zero=True, remove_neg=True), expected_flags)
+        np.testing.assert_equal(he.treatment_mask(sim, obs), np.isfinite(sim) & np.isfinite(obs))
+
+        # Rows of a 2D array are flagged if any of their values are flagged
+        fcst_ens = np.column_stack((obs, np.ones(obs.size)))
+        np.testing.assert_equal(he.treatment_mask(fcst_ens, sim, remove_zero=True, remove_neg=True),
+                                expected_flags == 0)
+
+        # Large arrays go through the compiled kernel instead of numpy, with the same flags
+        repeats = he._KERNEL_MIN_SIZE // sim.size + 1
+        np.testing.assert_equal(he.treatment_flags(np.tile(sim, repeats), np.tile(obs, repeats), remove_zero=True,
+                                                   remove_neg=True), np.tile(expected_flags, repeats))
+        np.testing.assert_equal(he.treatment_flags(np.arange(-2, 3), np.array([True, False, True, True, True]),
+                                                   remove_zero=True, remove_neg=True), [8, 12, 4, 0, 0])
+
+        # Same results as the treat_values function from HydroErr
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for remove_zero, remove_neg in [(False, False), (True, False), (False, True), (True, True)]:
+                expected = he.treat_values(sim, obs, remove_zero=remove_zero, remove_neg=remove_neg)
+                test = he.treat_arrays(sim, obs, remove_zero=remove_zero, remove_neg=remove_neg)
+                np.testing.assert_equal(expected, test)
+
+        # Arrays without any values to remove are not copied
+        test_sim, test_obs = he.treat_arrays(self.sim, self.obs)
+        self.assertIs(test_sim, self.sim)
+        self.assertIs(test_obs, self.obs)
+
+    def test_list_of_metrics_out(self):
+        metrics = ['ME', 'NSE', 'KGE (2012)']
+        expected = he.list_of_metrics(metrics, self.sim, self.obs, abbr=True)
+
+        # A row of a preallocated float64 matrix
+        results = np.zeros((2, 3))
+        returned = he.list_of_metrics(metrics, self.sim, self.obs, abbr=True, out=results[1])
+        self.assertIs(returned.base, results)
+        np.testing.assert_array_equal(results, [[0, 0, 0], expected])
+
+        # A record of a structured array with a field for each metric, including cached results
+        table = np.zeros(2, dtype=[('station', 'i4')] + [(metric, 'f8') for metric in metrics])
+        cache = he.MetricCache()
+        for i in range(2):
+            he.list_of_metrics(metrics, self.sim, self.obs, abbr=True, out=table[i], cache=cache)
+        self.assertEqual(cache.hits, 1)
+        for metric, value in zip(metrics, expected):
+            np.testing.assert_array_equal(table[metric], [value, value])
+
+        with self.assertRaises(ValueError):
+            he.list_of_metrics(metrics, self.sim, self.obs, abbr=True, out=np.zeros(2))
+        with self.assertRaises(ValueError):
+            he.list_of_metrics(metrics + ['MAE'], self.sim, self.obs, abbr=True, out=table[0])
+
+    def test_metric_accumulator(self):
+        np.random.seed(2)
+        sim = np.random.rand(2000) * 100 + 1
+        obs = sim * (np.random.rand(2000) * 0.4 + 0.8)
+        sim[100] = np.nan
+        obs[200] = np.inf
+
+        unsupported = ['MdE', 'MdAE', 'MdSE', 'NRMSE (IQR)', 'R (Spearman)', 'd', 'd1', 'd (Mod.)', 'd (Rel.)', 'dr',
+                       '(MB) R', 'NSE (Mod.)']
+        metrics = [metric for metric in he.metric_abbr if metric not in unsupported]
+        params = dict(mase_m=3, h6_mhe_k=2, h6_ahe_k=3, d1_p_obs_bar_p=30, lm_x_obs_bar_p=40,
+                      kge2009_s=(1.2, 0.8, 1))
+
+        accumulator = he.MetricAccumulator(metrics, abbr=True, **params)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            for start in range(0, sim.size, 337):
+                accumulator.update(sim[start:start + 337], obs[start:start + 337])
+            expected_list = he.list_of_metrics(metrics, sim, obs, abbr=True, **params)
+
+        self.assertEqual(accumulator.n, 1998)
+        self.assertTrue(np.all(np.isclose(expected_list, accumulator.values(), rtol=1e-10)))
+
+        for metric in unsupported:
+            with self.assertRaises(ValueError):
+                he.MetricAccumulator([metric], abbr=True)
+        with self.assertRaises(ValueError):
+            he.MetricAccumulator(["E1'"], abbr=True)
+
+    def test_metric_accumulator_merge(self):
+        np.random.seed(3)
+        sim = np.random.rand(3000) * 100 + 1
+        obs = sim * (np.random.rand(3000) * 0.4 + 0.8)
+        metrics = ['ME', 'RMSE', 'IRMSE', 'MASE', 'NSE', 'KGE (2009)', 'SA', 'SGA', 'H6 (MHE)', 'H7 (RMSHE)']
+
+        # Partial states of the parts of the record, sent through JSON like they would be between processes
+        parts = []
+        bounds = [0, 1, 3, 4, 1000, 1002, 2500, 3000]
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            accumulator = he.MetricAccumulator(metrics, abbr=True, mase_m=3, h6_mhe_k=2)
+            accumulator.update(sim[start:end], obs[start:end])
+            parts.append(he.MetricAccumulator.from_dict(json.loads(json.dumps(accumulator.to_dict()))))
+
+        expected_list = he.list_of_metrics(metrics, sim, obs, abbr=True, mase_m=3, h6_mhe_k=2)
+
+        # Merging is associative
+        merged_left = parts[0]
+        for part in parts[1:]:
+            merged_left = merged_left.merge(part)
+        merged_right = parts[-1]
+        for part in parts[-2::-1]:
+            merged_right = part.merge(merged_right)
+
+        for merged in (merged_left, merged_right):
+            self.assertEqual(merged.n, 3000)
+            self.assertTrue(np.all(np.isclose(expected_list, merged.values(), rtol=1e-10)))
+
+        # The merged accumulators are not changed
+        self.assertEqual(parts[0].n, 1)
+
+        with self.assertRaises(ValueError):
+            parts[0].merge(he.MetricAccumulator(metrics, abbr=True, mase_m=2, h6_mhe_k=2))
+
+    def test_parameter_sweep(self):
+        np.random.seed(4)
+        sim = np.random.rand(1000) * 100 + 1
+        obs = sim * (np.random.rand(1000) * 0.4 + 0.8)
+        grid = np.array([0.5, 1, 2, 3])
+        obs_bar_p_grid = [10., 40., 55.]
+        s_grid = np.random.rand(5, 3) + 0.5
+
+        metrics = ['MASE', 'd (Mod.)', 'NSE (Mod.)', 'H6 (MHE)', 'H6 (MAHE)', 'H6 (RMSHE)', "D1'", "E1'", 'KGE (2009)',
+                   'KGE (2012)', 'NSE']
+        test_list = he.parameter_sweep(metrics, sim, obs, abbr=True, mase_m=[1, 2, 5], dmod_j=grid, nse_mod_j=grid,
+                                       h6_mhe_k=grid, h6_ahe_k=grid, h6_rmshe_k=grid, d1_p_obs_bar_p=obs_bar_p_grid,
+                                       lm_x_obs_bar_p=obs_bar_p_grid, kge2009_s=s_grid, kge2012_s=s_grid)
+        expected_list = [
+            [he.mase(sim, obs, m=m) for m in [1, 2, 5]], [he.dmod(sim, obs, j=j) for j in grid],
+            [he.nse_mod(sim, obs, j=j) for j in grid], [he.h6_mhe(sim, obs, k=k) for k in grid],
+            [he.h6_mahe(sim, obs, k=k) for k in grid], [he.h6_rmshe(sim, obs, k=k) for k in grid],
+            [he.d1_p(sim, obs, obs_bar_p=p) for p in obs_bar_p_grid],
+            [he.lm_index(sim, obs, obs_bar_p=p) for p in obs_bar_p_grid],
+            [he.kge_2009(sim, obs, s=tuple(s)) for s in s_grid], [he.kge_2012(sim, obs, s=tuple(s)) for s in s_grid],
+            he.nse(sim, obs)
+        ]
+
+        for expected, test in zip(expected_list, test_list):
+            self.assertTrue(np.allclose(expected, test))
+            self.assertEqual(np.shape(expected), np.shape(test))
+
+        # Single parameter values give the same values as list_of_metrics
+        self.assertEqual(he.parameter_sweep(metrics, sim, obs, abbr=True, dmod_j=2),
+                         he.list_of_metrics(metrics, sim, obs, abbr=True, dmod_j=2))
+
+    def test_import_time(self):
+        # HydroErr (and scipy) are imported first so that only the time spent by hydrostats is measured.
+        # Importing hydrostats and computing the first metrics on a small array should take less time
+        # than importing numba alone, which is what the deferred imports avoid.
+        script = (
+            "import sys, time\n"
+            "import numpy, HydroErr\n"
+            "start = time.time()\n"
+            "import hydrostats, hydrostats.visual, hydrostats.ens_metrics\n"
+            "values = numpy.arange(1., 101.)\n"
+            "hydrostats.list_of_metrics(['ME', 'NSE', 'KGE (2012)'], values, values[::-1], abbr=True)\n"
+            "elapsed = time.time() - start\n"
+            "loaded = [m for m in ('matplotlib', 'pandas', 'numba') if m in sys.modules]\n"
+            "start = time.time()\n"
+            "import numba\n"
+            "print(elapsed, time.time() - start, loaded)\n"
+        )
+        times = []
+        baseline_times = []
+        for _ in range(3):
+            output = subprocess.check_output([sys.executable, '-c', script], cwd=package_path)
+            elapsed, baseline, loaded = output.decode().split(' ', 2)
+            self.assertEqual(loaded.strip(), '[]')
+            times.append(float(elapsed))
+            baseline_times.append(float(baseline))
+        self.assertLess(min(times), min(baseline_times))
+
+        # hydrostats.data is still an attribute of the package, and only the public names are exported
+        script = "import hydrostats\nprint(hydrostats.data.merge_data.__name__, hasattr(hydrostats, 'np'))\n"
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=package_path)
+        self.assertEqual(output.decode().split(), ['merge_data', 'False'])
+
+        # The deferred imports still work once they are needed
+        ens = np.array([[1., 2., 3.], [0.5, 4., 1.]])
+        obs = np.array([2., 3.])
+        self.assertTrue(np.allclose(em.ens_crps(obs, ens)['crps'], em.ens_crps(obs, ens, llvm=False)['crps']))
+
     def tearDown(self):
         del self.sim
         del self.obs
@@ -356,6 +634,139 @@ class AnalysisTests(unittest.TestCase):
 
         self.assertIsNone(pd.testing.assert_frame_equal(test_table, table))
 
+    def test_metric_cache(self):
+        my_metrics = ['MAE', 'r2', 'NSE', 'KGE (2012)']
+        seasonal = [['01-01', '03-31'], ['04-01', '06-30']]
+        cache = he.MetricCache(maxsize=4)
+
+        table = ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, remove_zero=True, cache=cache)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 3, 3))
+        cached_table = ha.make_table(self.merged_df.copy(), my_metrics, seasonal, remove_neg=True, remove_zero=True,
+                                     cache=cache)
+        self.assertEqual((cache.hits, cache.misses), (3, 3))
+        pd.testing.assert_frame_equal(table, cached_table)
+
+        # Different cleaning options, parameters or data are different keys
+        sim = self.merged_df.iloc[:, 0].values
+        obs = self.merged_df.iloc[:, 1].values
+        expected = he.list_of_metrics(my_metrics, sim, obs, abbr=True)
+        self.assertEqual(he.list_of_metrics(my_metrics, sim, obs, abbr=True, cache=cache), expected)
+        self.assertEqual(cache.misses, 4)
+        self.assertEqual(he.list_of_metrics(my_metrics, sim, obs, abbr=True, kge2012_s=(2, 1, 1), cache=cache),
+                         he.list_of_metrics(my_metrics, sim, obs, abbr=True, kge2012_s=(2, 1, 1)))
+        self.assertEqual(cache.misses, 5)
+        self.assertEqual(len(cache), 4)
+
+        # The least recently used result (the first seasonal period) was discarded
+        self.assertEqual(cache.invalidate(sim, obs), 2)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(he.list_of_metrics(my_metrics, sim, obs, abbr=True, cache=cache), expected)
+        self.assertEqual(cache.misses, 6)
+        self.assertEqual(cache.invalidate(), 3)
+        cache.clear()
+        self.assertEqual(cache.info(), {'hits': 0, 'misses': 0, 'maxsize': 4, 'currsize': 0})
+
+    def test_make_table_single_pass(self):
+        my_metrics = ['MAE', 'r2', 'NSE', 'KGE (2012)', 'MdAE', 'MASE']
+        seasonal = [['01-01', '03-31'], ['04-01', '06-30'], ['07-01', '09-30'], ['11-01', '02-28']]
+        table = ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, remove_zero=True,
+                              location='Magdalena')
+        single_pass_table = ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, remove_zero=True,
+                                          location='Magdalena', single_pass=True)
+        self.assertIsNone(pd.testing.assert_frame_equal(table, single_pass_table, rtol=1e-10))
+
+        # A monthly table is computed faster than with one pass per seasonal period
+        months = [['{:02d}-01'.format(month), '{:02d}-28'.format(month)] for month in range(1, 13)]
+        my_metrics = ['ME', 'RMSE', 'NSE', 'KGE (2012)', 'r2']
+        times = {}
+        for single_pass in [False, True]:
+            times[single_pass] = min(timeit.repeat(
+                lambda: ha.make_table(self.merged_df, my_metrics, months, single_pass=single_pass), number=3, repeat=5))
+        self.assertLess(times[True], times[False])
+
+    def test_station_tables(self):
+        my_metrics = ['MAE', 'NSE', 'KGE (2012)']
+        seasonal = [['01-01', '03-31']]
+        second_df = self.merged_df.loc['1990-01-01':'1999-12-31']
+        stations = [('Magdalena', "Files_for_tests/merged_df.pkl"), ('Second', second_df), ('Third', self.merged_df)]
+        expected = pd.concat([
+            ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, location='Magdalena'),
+            ha.make_table(second_df, my_metrics, seasonal, remove_neg=True, location='Second'),
+            ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, location='Third'),
+        ])
+
+        table = ha.station_tables(stations, my_metrics, seasonal, remove_neg=True)
+        self.assertIsNone(pd.testing.assert_frame_equal(expected, table))
+        table = ha.station_tables(dict(stations), my_metrics, seasonal, processes=2, threads=True, chunksize=2,
+                                  remove_neg=True)
+        self.assertIsNone(pd.testing.assert_frame_equal(expected, table))
+
+        streamed = ha.station_tables(stations, my_metrics, seasonal, processes=2, threads=True, stream=True,
+                                     remove_neg=True)
+        self.assertEqual([station for station, _ in streamed], ['Magdalena', 'Second', 'Third'])
+
+        # The process pool is spawned, so it also works after the parallel numba functions have run
+        em.ens_crps(np.array([2., 3.]), np.array([[1., 2., 3.], [0.5, 4., 1.]]))
+        table = ha.station_tables(stations, my_metrics, seasonal, processes=2, remove_neg=True)
+        self.assertIsNone(pd.testing.assert_frame_equal(expected, table))
+
+    def test_model_table(self):
+        my_metrics = ['ME', 'NSE', 'KGE (2012)', 'MdAE', 'MASE']
+        models_df = pd.DataFrame({'Shifted': self.merged_df.iloc[:, 0] + 10, 'Observed': self.merged_df.iloc[:, 1],
+                                  'SFPT': self.merged_df.iloc[:, 0]}, index=self.merged_df.index)
+        models_df.iloc[5:20, 0] = np.nan
+
+        table = ha.model_table(models_df, my_metrics, obs_column=1, remove_neg=True, remove_zero=True,
+                               location='Magdalena')
+        self.assertEqual(list(table.index), ['Shifted', 'SFPT'])
+        self.assertEqual(list(table.columns), ['Location'] + my_metrics)
+        for model in ['Shifted', 'SFPT']:
+            expected = he.list_of_metrics(my_metrics, models_df[model].values, models_df['Observed'].values, abbr=True,
+                                          remove_neg=True, remove_zero=True)
+            self.assertTrue(np.allclose(table.loc[model, my_metrics].values.astype(float), expected))
+
+    def test_annual_table(self):
+        my_metrics = ['ME', 'NSE', 'KGE (2012)', 'MASE']
+        table = ha.annual_table(self.merged_df, my_metrics, remove_neg=True, remove_zero=True)
+        water_year_table = ha.annual_table(self.merged_df, my_metrics, year_start='10-01', remove_neg=True,
+                                           remove_zero=True, location='Magdalena')
+
+        self.assertEqual(table.index.name, 'Year')
+        self.assertEqual(list(table.index), list(range(1980, 2016)))
+        self.assertEqual(water_year_table.index.name, 'Water Year')
+        self.assertEqual(list(water_year_table.columns), ['Location'] + my_metrics)
+
+        for year, start, end in [(1980, '1980-01-01', '1980-12-31'), (2003, '2003-01-01', '2003-12-31')]:
+            season = self.merged_df.loc[start:end]
+            expected = he.list_of_metrics(my_metrics, season.iloc[:, 0].values, season.iloc[:, 1].values, abbr=True,
+                                          remove_neg=True, remove_zero=True)
+            self.assertTrue(np.allclose(table.loc[year].values, expected))
+
+        season = self.merged_df.loc['1995-10-01':'1996-09-30']
+        expected = he.list_of_metrics(my_metrics, season.iloc[:, 0].values, season.iloc[:, 1].values, abbr=True,
+                                      remove_neg=True, remove_zero=True)
+        self.assertTrue(np.allclose(water_year_table.loc[1996, my_metrics].values.astype(float), expected))
+
+    def test_make_table_bootstrap(self):
+        my_metrics = ['MAE', 'NSE', 'KGE (2012)']
+        seasonal = [['01-01', '03-31']]
+        table = ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, remove_zero=True)
+
+        for block_size in (1, 30):
+            bootstrap_table = ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, remove_zero=True,
+                                            bootstrap_samples=100, block_size=block_size, random_state=10)
+            self.assertEqual(bootstrap_table.shape, (2, 9))
+            self.assertIsNone(pd.testing.assert_frame_equal(table, bootstrap_table[my_metrics]))
+
+            for metric in my_metrics:
+                self.assertTrue(np.all(bootstrap_table[metric + ' CI Lower'] < bootstrap_table[metric]))
+                self.assertTrue(np.all(bootstrap_table[metric + ' CI Upper'] > bootstrap_table[metric]))
+
+            # The intervals are reproducible with the same random state
+            repeated_table = ha.make_table(self.merged_df, my_metrics, seasonal, remove_neg=True, remove_zero=True,
+                                           bootstrap_samples=100, block_size=block_size, random_state=10)
+            self.assertIsNone(pd.testing.assert_frame_equal(bootstrap_table, repeated_table))
+
     def test_lag_analysis(self):
         # Running the lag analysis
         time_lag_df, summary_df = ha.time_lag(self.merged_df, metrics=['ME', 'r2', 'RMSE', 'KGE (2012)', 'NSE'])
@@ -368,6 +779,117 @@ class AnalysisTests(unittest.TestCase):
         self.assertIsNone(pd.testing.assert_frame_equal(time_lag_df, time_lag_df_original))
         self.assertIsNone(pd.testing.assert_frame_equal(summary_df, summary_df_original))
 
+    def test_lag_analysis_moments(self):
+        # The metrics built from sums of the pairs are computed for all of the lags at once
+        my_metrics = ['R (Pearson)', 'r2', 'KGE (2009)', 'KGE (2012)', 'ME', 'RMSE', 'NSE', 'SA', 'M', 'MAE']
+        merged_df = self.merged_df.loc['2000-01-01':'2004-12-31']
+        time_lag_df, _ = ha.time_lag(merged_df, metrics=my_metrics, shift_range=(-20, 15))
+
+        interp_df = merged_df.reindex(pd.date_range(merged_df.index[0], merged_df.index[-1], freq='6H'))
+        interp_df = interp_df.interpolate('pchip')
+        sim = interp_df.iloc[:, 0].values
+        obs = interp_df.iloc[:, 1].values
+        expected = [he.list_of_metrics(my_metrics, np.roll(sim, lag), obs, abbr=True)
+                    for lag in range(-20, 16)]
+        self.assertTrue(np.allclose(time_lag_df.values, expected, rtol=1e-10))
+
+    def test_lag_analysis_workers(self):
+        my_metrics = ['MAE', 'MdAE', 'NSE', 'dr']
+        merged_df = self.merged_df.loc['2000-01-01':'2004-12-31']
+        time_lag_df, summary_df = ha.time_lag(merged_df, metrics=my_metrics, shift_range=(-25, 25), overlap=True)
+        pool_time_lag_df, pool_summary_df = ha.time_lag(merged_df, metrics=my_metrics, shift_range=(-25, 25),
+                                                        overlap=True, workers=3)
+        self.assertIsNone(pd.testing.assert_frame_equal(time_lag_df, pool_time_lag_df, check_exact=True))
+        self.assertIsNone(pd.testing.assert_frame_equal(summary_df, pool_summary_df, check_exact=True))
+
+    def test_batch_time_lag(self):
+        my_metrics = ['ME', 'r2', 'KGE (2012)', 'MAE', 'MdAE']
+        offset_df = self.merged_df.loc['2001-03-01':'2001-12-31'].copy()
+        offset_df.index = offset_df.index + pd.Timedelta('3H')
+        stations = {'Full': self.merged_df.loc['2000-01-01':'2002-12-31'],
+                    'Scaled': self.merged_df.loc['2000-01-01':'2002-12-31'] * 1.1,
+                    'Short': self.merged_df.loc['2001-01-01':'2001-12-31'],
+                    'Offset': offset_df}
+
+        # Each station gets the same results as time_lag, whatever its start time and length
+        for overlap in [False, True]:
+            cube, summary_df = ha.batch_time_lag(stations, my_metrics, shift_range=(-10, 10), overlap=overlap)
+            self.assertEqual(cube.shape, (4, 21, 5))
+
+            for i, (station, merged_df) in enumerate(stations.items()):
+                time_lag_df, station_summary_df = ha.time_lag(merged_df, metrics=my_metrics, shift_range=(-10, 10),
+                                                              overlap=overlap)
+                self.assertTrue(np.allclose(cube[i], time_lag_df.values, rtol=1e-9))
+                # The ME of a rolled series is the same at every lag, so its lag numbers are ties
+                compared = station_summary_df.index != 'ME' if not overlap else slice(None)
+                self.assertTrue(np.allclose(summary_df.loc[station].values[compared],
+                                            station_summary_df.values[compared], rtol=1e-9))
+
+        # The pairs with invalid values are left out at their own time steps
+        sim = np.vstack((stations['Full'].iloc[:, 0].values, stations['Scaled'].iloc[:, 0].values))
+        obs = np.vstack((stations['Full'].iloc[:, 1].values, stations['Scaled'].iloc[:, 1].values))
+        sim[0, 100:110] = np.nan
+        cube = ha.lag_cube(sim, obs, my_metrics, shift_range=(-3, 3), overlap=True)
+        n = sim.shape[1]
+        expected = [he.batch_metrics(my_metrics, sim[:, max(-lag, 0):n - max(lag, 0)],
+                                     obs[:, max(lag, 0):n - max(-lag, 0)], abbr=True) for lag in range(-3, 4)]
+        self.assertTrue(np.allclose(cube, np.stack(expected, axis=1), rtol=1e-9))
+
+    def test_lag_analysis_search(self):
+        # The simulated data is 0.3 days (1.2 steps of 6 hours) behind the observed data
+        time = np.arange(2000.)
+        merged_df = pd.DataFrame({'Simulated': 10 + np.sin(2 * np.pi * (time - 0.3) / 50),
+                                  'Observed': 10 + np.sin(2 * np.pi * time / 50)},
+                                 index=pd.date_range('2000-01-01', periods=2000))
+        time_lag_df, summary_df = ha.time_lag(merged_df, metrics=['r2', 'NSE', 'ME'], shift_range=(-30, 30),
+                                              search=True)
+
+        # The lags are evaluated on the daily steps of the data, numbered in steps of 6 hours
+        self.assertEqual(list(time_lag_df.index), list(range(-28, 29, 4)))
+        self.assertTrue(np.allclose(summary_df.loc[['r2', 'NSE'], 'Max Lag Number'], -1.2, atol=0.01))
+        self.assertGreaterEqual(summary_df.loc['r2', 'Max'], time_lag_df['r2'].max())
+        self.assertEqual(summary_df.loc['ME', 'Max'], time_lag_df['ME'].max())
+
+    def test_lag_analysis_precision(self):
+        # Nearly matching series, where the sums of squared errors can not be taken from the moments
+        rng = np.random.RandomState(0)
+        obs = 1e4 * (1 + rng.rand(20000))
+        sim = obs + 1e-3 * rng.randn(obs.size)
+        sim_batch = np.vstack((sim, sim))
+        obs_batch = np.vstack((obs, obs))
+        sim_batch[1, 15000:] = obs_batch[1, 15000:] = np.nan
+        cube = ha.lag_cube(sim_batch, obs_batch, ['RMSE', 'NSE'], shift_range=(-2, 2), lengths=[20000, 15000])
+        for row, n in enumerate([20000, 15000]):
+            for i, lag in enumerate(range(-2, 3)):
+                errors = np.roll(sim[:n], lag) - obs[:n]
+                anomalies = obs[:n] - obs[:n].mean()
+                expected = [np.sqrt(np.mean(errors ** 2)), 1 - np.sum(errors ** 2) / np.sum(anomalies ** 2)]
+                self.assertTrue(np.allclose(cube[row, i], expected, rtol=1e-9))
+
+        # Lags with less than two pairs have no values
+        cube = ha.lag_cube(sim[np.newaxis, :20], obs[np.newaxis, :20], ['RMSE', 'NSE'], shift_range=(-19, 19),
+                           overlap=True)
+        self.assertTrue(np.all(np.isnan(cube[0, [0, -1]])))
+        self.assertTrue(np.allclose(cube[0, [1, -2], 0], [np.sqrt(np.mean((sim[18:20] - obs[:2]) ** 2)),
+                                                          np.sqrt(np.mean((sim[:2] - obs[18:20]) ** 2))], rtol=1e-9))
+
+    def test_lag_analysis_overlap(self):
+        my_metrics = ['ME', 'RMSE', 'NSE', 'KGE (2012)', 'R (Pearson)', 'MAE', 'MASE']
+        merged_df = self.merged_df.loc['2000-01-01':'2001-12-31']
+        time_lag_df, summary_df = ha.time_lag(merged_df, metrics=my_metrics, interp_freq='1D', shift_range=(-40, 25),
+                                              overlap=True)
+
+        sim = merged_df.iloc[:, 0].values
+        obs = merged_df.iloc[:, 1].values
+        for lag in [-40, -3, 0, 1, 25]:
+            if lag >= 0:
+                expected = he.list_of_metrics(my_metrics, sim[:sim.size - lag], obs[lag:], abbr=True)
+            else:
+                expected = he.list_of_metrics(my_metrics, sim[-lag:], obs[:obs.size + lag], abbr=True)
+            self.assertTrue(np.allclose(time_lag_df.loc[lag].values, expected, rtol=1e-10))
+
+        self.assertEqual(summary_df.loc['ME', 'Max'], time_lag_df['ME'].max())
+
     def tearDown(self):
         del self.merged_df
 
@@ -609,6 +1131,53 @@ class DataTests(unittest.TestCase):
 
         # merged_df_1 = hd.merge_data(sim_df=)
 
+    def test_merge_data_date_format(self):
+        sfpt_path = r'../../Sample_data/sfpt_data/magdalena-calamar_interim_data.csv'
+        glofas_path = r'../../Sample_data/GLOFAS_Data/magdalena-calamar_ECMWF_data.csv'
+
+        expected_df = hd.merge_data(sfpt_path, glofas_path, column_names=('SFPT', 'GLOFAS'))
+        test_df = hd.merge_data(sfpt_path, glofas_path, column_names=('SFPT', 'GLOFAS'),
+                                date_format=('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'))
+
+        self.assertIsNone(pd.testing.assert_frame_equal(expected_df, test_df))
+
+    def test_merge_data_interpolate(self):
+        sim_df = pd.DataFrame({'Simulated': np.sin(np.arange(400) / 10) + 2},
+                              index=pd.date_range('1980-01-01', periods=400, freq='D'))
+        obs_df = pd.DataFrame({'Observed': np.random.rand(1500)},
+                              index=pd.date_range('1979-12-25 06:00', periods=1500, freq='6H'))
+
+        for interp_type in ['linear', 'pchip']:
+            # The same values as interpolating the simulated data to a 15 minute grid and joining it
+            expected_df = pd.DataFrame.join(sim_df.resample('15min').interpolate(interp_type), obs_df).dropna()
+            test_df = hd.merge_data(sim_df=sim_df, obs_df=obs_df, interpolate='simulated', interp_type=interp_type)
+
+            self.assertTrue(expected_df.index.equals(test_df.index))
+            self.assertTrue(np.allclose(expected_df.values, test_df.values, rtol=1e-12))
+
+        # Times that are not on a 15 minute grid are interpolated as well
+        obs_df.index = obs_df.index + pd.Timedelta('7min')
+        test_df = hd.merge_data(sim_df=sim_df, obs_df=obs_df, interpolate='simulated', interp_type='linear')
+        inside = (obs_df.index >= sim_df.index[0]) & (obs_df.index <= sim_df.index[-1])
+        self.assertTrue(test_df.index.equals(obs_df.index[inside]))
+
+    def test_merge_data_chunks(self):
+        sfpt_path = r'../../Sample_data/sfpt_data/magdalena-calamar_interim_data.csv'
+        glofas_path = r'../../Sample_data/GLOFAS_Data/magdalena-calamar_ECMWF_data.csv'
+        expected_df = hd.merge_data(sfpt_path, glofas_path)
+
+        accumulator = he.MetricAccumulator(['ME', 'NSE', 'KGE (2012)'], abbr=True)
+        chunks = []
+        for chunk in hd.merge_data_chunks(sfpt_path, glofas_path, chunksize=1000):
+            accumulator.update(chunk.iloc[:, 0].values, chunk.iloc[:, 1].values)
+            chunks.append(chunk)
+
+        self.assertGreater(len(chunks), 1)
+        self.assertIsNone(pd.testing.assert_frame_equal(expected_df, pd.concat(chunks), check_freq=False))
+        expected_list = he.list_of_metrics(['ME', 'NSE', 'KGE (2012)'], expected_df.iloc[:, 0].values,
+                                           expected_df.iloc[:, 1].values, abbr=True)
+        self.assertTrue(np.allclose(expected_list, accumulator.values()))
+
     def test_daily_average(self):
         original_df = pd.read_csv(r'Comparison_Files/daily_average.csv', index_col=0)
         original_df.index = original_df.index.astype(np.object)
@@ -660,6 +1229,34 @@ class DataTests(unittest.TestCase):
 
         self.assertIsNone(pd.testing.assert_frame_equal(original_df, test_df))
 
+    def test_seasonal_period(self):
+        month_day = self.merged_df.index.strftime('%m-%d')
+        for daily_period in [('01-01', '03-31'), ('11-15', '02-10')]:
+            if daily_period[0] < daily_period[1]:
+                mask = (month_day >= daily_period[0]) & (month_day <= daily_period[1])
+            else:
+                mask = (month_day >= daily_period[0]) | (month_day <= daily_period[1])
+            expected_df = self.merged_df.loc[mask]
+
+            seasonal_df = hd.seasonal_period(self.merged_df, daily_period)
+            self.assertIsNone(pd.testing.assert_frame_equal(expected_df, seasonal_df))
+            sim, obs = hd.seasonal_period(self.merged_df, daily_period, numpy=True)
+            np.testing.assert_array_equal(sim, expected_df.iloc[:, 0].values)
+            np.testing.assert_array_equal(obs, expected_df.iloc[:, 1].values)
+
+            # Precomputed month-day keys select the same rows
+            keys = self.merged_df.index.month * 100 + self.merged_df.index.day
+            np.testing.assert_array_equal(hd.seasonal_mask(self.merged_df, daily_period, month_day_keys=keys), mask)
+
+        # A single season is returned as views of the columns with numpy=True
+        expected_df = self.merged_df.loc['1981-04-01':'1981-07-31']
+        seasonal_df = hd.seasonal_period(self.merged_df, ('04-01', '07-31'), time_range=('1981-01-01', '1981-12-31'))
+        self.assertIsNone(pd.testing.assert_frame_equal(expected_df, seasonal_df))
+        sim, obs = hd.seasonal_period(self.merged_df, ('04-01', '07-31'), time_range=('1981-01-01', '1981-12-31'),
+                                      numpy=True)
+        np.testing.assert_array_equal(obs, expected_df.iloc[:, 1].values)
+        self.assertTrue(np.shares_memory(sim, self.merged_df.iloc[:, 0].values))
+
     def test_remove_nan_df(self):
         data = np.random.rand(15, 2)
         data[0, 0] = data[1, 1] = np.nan
@@ -7,13 +7,19 @@ time series data. In some of the visualization functions, metrics can be added t
 more complete summary of the data.
 """
 from __future__ import division
-from hydrostats.metrics import function_list, metric_abbr
-from HydroErr.HydroErr import treat_values
+from hydrostats.metrics import MetricPlan, metric_abbr, treat_arrays
+from hydrostats._lazy import LazyModule
 import numpy as np
-import matplotlib.pyplot as plt
 import calendar
-from pandas.plotting import register_matplotlib_converters
-register_matplotlib_converters()
+
+
+def _register_converters(pyplot):
+    from pandas.plotting import register_matplotlib_converters
+    register_matplotlib_converters()
+
+
+# matplotlib is only imported once a plot is made
+plt = LazyModule('matplotlib.pyplot', setup=_register_converters)
 
 __all__ = ['plot', 'hist', 'scatter', 'qqplot']
 
@@ -227,14 +233,11 @@ def plot(merged_data_df, legend=('Simulated Data', 'Observed Data'), metrics=Non
         for metric in metrics:
             assert metric in function_list_str
 
-        index = []
-        for metric in metrics:
-            index.append(function_list_str.index(metric))
+        metric_values = MetricPlan(metrics, abbr=True).run(sim, obs)
 
         selected_metrics = []
-        for i in index:
-            selected_metrics.append(
-                function_list_str[i] + '=' + str(round(function_list[i](sim, obs), 3)))
+        for metric, value in zip(metrics, metric_values):
+            selected_metrics.append(metric + '=' + str(round(value, 3)))
 
         formatted_selected_metrics = ''
         for i in selected_metrics:
@@ -569,13 +572,10 @@ def scatter(merged_data_df=None, sim_array=None, obs_array=None, grid=False, tit
         assert isinstance(metrics, list)
         for metric in metrics:
             assert metric in function_list_str
-        index = []
-        for metric in metrics:
-            index.append(function_list_str.index(metric))
+        metric_values = MetricPlan(metrics, abbr=True).run(sim, obs)
         selected_metrics = []
-        for i in index:
-            selected_metrics.append(function_list_str[i] + '=' +
-                                    str(round(function_list[i](sim, obs), 3)))
+        for metric, value in zip(metrics, metric_values):
+            selected_metrics.append(metric + '=' + str(round(value, 3)))
         formatted_selected_metrics = ''
         for i in selected_metrics:
             formatted_selected_metrics += i + '\n'
@@ -686,7 +686,7 @@ def qqplot(merged_data_df=None, sim_array=None, obs_array=None, interpolate='lin
     else:
         raise RuntimeError("You must either pass in a dataframe or two arrays.")
 
-    sim, obs = treat_values(sim, obs, replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
+    sim, obs = treat_arrays(sim, obs, replace_nan=replace_nan, replace_inf=replace_inf, remove_neg=remove_neg,
                             remove_zero=remove_zero)
 
     # Finding the size of n and creating a percentile vector: